@@ -2,88 +2,70 @@
 
 """ Reads commands from Twitch chat, and adds the parsed video links to a queue """
 
+import asyncio
+import math
 import socket
-from typing import Tuple 
-from pytube import YouTube
+import time
+import uuid
+from typing import Tuple
 from multiprocessing import Queue
-from pprint import pprint
 
-from bertha2.settings import CHANNEL, NICKNAME, TOKEN, MAX_VIDEO_LENGTH_SECONDS
+from bertha2.settings import CHANNEL, VIDEO_VALIDATION_WORKERS, get_secrets
+from bertha2.utils.fair_queue import PlayRateLimiter, get_priority
+from bertha2.utils.irc import IrcLineReader, parse_irc_message
+from bertha2.utils.queue_state import record_queue_event, record_trace, EVENT_ENQUEUE
 from bertha2.utils.logs import initialize_module_logger, log_if_in_debug_mode
+from bertha2.utils.metrics import get_counter, get_histogram
+from bertha2.utils.video_metadata import VideoMetadataCache, get_invalid_reason
 
 logger = initialize_module_logger(__name__)
 
+CHAT_READ_SIZE = 65536
 
-def is_valid_youtube_video(link: str) -> bool:
 
-    try:
-        yt = YouTube(link)
-    except Exception as e:
-        logger.info(f"CHAT: link is invalid {e}")
-        return False
-
-    try:
-        # this will return None if it's available, and an error if it's not
-        yt.check_availability() 
-    except Exception as e: 
-        # Will raise an exception if members only, live stream. etc.
-        logger.info(f"Invaid video: {e}")
-        return False
-
-    if yt.age_restricted:
-        logger.info(f"Invalid video: {link} is age restricted")
-        return False
+def format_privmsg(message, twitch_channel, reply_id=None) -> str:
+    if reply_id is not None:
+        return f"@reply-parent-msg-id={reply_id} PRIVMSG #{twitch_channel} :{message}\r\n"
+    else:
+        return f"PRIVMSG #{twitch_channel} :{message}\r\n"
 
-    if yt.length >= MAX_VIDEO_LENGTH_SECONDS:
-        logger.info(f"Invalid video: {link} is too long")
-        return False
 
-    return True
+def send_privmsg(sock: socket.socket, message, twitch_channel, reply_id=None) -> None:
+    msg = format_privmsg(message, twitch_channel, reply_id)
+    sock.send(msg.encode("utf-8"))
+    logger.debug(msg)
 
 
-def send_privmsg(sock: socket.socket, message, twitch_channel, reply_id=None) -> None:
-    if reply_id is not None:
-        msg = f"@reply-parent-msg-id={reply_id} PRIVMSG #{twitch_channel} :{message}\r\n"
-        sock.send(msg.encode("utf-8"))
-        logger.debug(msg)
-    else:
-        msg = f"PRIVMSG #{twitch_channel} :{message}\r\n"
-        sock.send(msg.encode("utf-8"))
-        logger.debug(msg)
+def parse_badges(badges: str) -> dict:
+    # e.g. "subscriber/12,premium/1" -> {"subscriber": "12", "premium": "1"}
+    return dict(badge.partition("/")[::2] for badge in badges.split(",") if badge)
 
 
 def parse_privmsg(msg: str) -> dict | None:
-    if not msg or msg == '':
+    if not msg:
         return None
 
-    # Looks like this:
-    # ('@badge-info=;badges=...user-id=142;user-type= :user!user@user.tmi.twitch.tv '
-    # 'PRIVMSG #berthatwo :!play https://www.youtube.com/watch?v=B_i743apHLs&t=12s')]
-    logger.debug(msg)
-    pprint(msg.strip().split(" :"))
-    pprint(msg.strip().split(" :"))
-    pprint(len(msg.strip().split(" :")))
-    message_parts = msg.strip().split(" :");
+    message = parse_irc_message(msg.strip())
 
     # check if privmsg
-    if "PRIVMSG" not in message_parts[1]:
-
+    if message is None or message["command"] != "PRIVMSG" or message["trailing"] is None:
         return None
 
-    # TODO: This could be a regex
-    tags = message_parts[0].split(";")
-    msg_id = tags[8].split("=")[1].strip()
-    username = tags[4].split("=")[1].strip()
+    tags = message["tags"]
+    username = tags.get("display-name")
+    if not username and message["prefix"]:
+        username = message["prefix"].partition("!")[0]
 
-    msg_content = message_parts[2].strip()
+    msg_content = message["trailing"].strip()
     command, command_arg = None, None
     if msg_content[:1] == "!":
-        command = msg_content.split(" ")[0].strip()
-        command_arg = msg_content.split(" ")[1].strip()
+        command, _, command_arg = msg_content.partition(" ")
+        command_arg = command_arg.strip().partition(" ")[0] or None
 
     return {
-        'msg_id': msg_id,
+        'msg_id': tags.get("id"),
         'username': username,
+        'badges': parse_badges(tags.get("badges", "")),
         'msg_content': msg_content,
         'command': command,
         'command_arg': command_arg,
@@ -105,8 +87,9 @@ def connect_to_twitch_irc() -> Tuple[socket.socket, str] | None:
         logger.critical("Capabilities couldn't be requested.")
         raise ConnectionRefusedError
     # Authenticate user
-    sock.send(f"PASS {TOKEN}\n".encode("utf-8"))  
-    sock.send(f"NICK {NICKNAME}\n".encode("utf-8"))
+    secrets = get_secrets()
+    sock.send(f"PASS {secrets.token}\n".encode("utf-8"))
+    sock.send(f"NICK {secrets.nickname}\n".encode("utf-8"))
     resp = sock.recv(2048).decode("utf-8")  # check if auth was successful
     # TODO: More test cases
     if "Improperly formatted auth" in resp:
@@ -120,16 +103,171 @@ def connect_to_twitch_irc() -> Tuple[socket.socket, str] | None:
     return (sock, response)
 
 
-def chat_process(link_q: Queue):
+def create_play_request(message_object: dict, metadata: dict) -> dict:
+    # what's put on link_q, so nothing after chat has to look the video up again
+    return {
+        "id": uuid.uuid4().hex,  # follows the video through the queues, see utils/queue_state.py
+        "link": message_object["command_arg"],
+        "video_id": metadata["video_id"],
+        "title": metadata["title"],
+        "length": metadata["length"],
+        "username": message_object["username"],
+        # the lane it's played in, see utils/fair_queue.py
+        "priority": get_priority(message_object.get("badges", {})),
+    }
+
+
+async def handle_play_command(writer: asyncio.StreamWriter, message_object: dict, link_q: Queue,
+                              metadata_cache: VideoMetadataCache, queue_event_q: Queue = None,
+                              rate_limiter: PlayRateLimiter = None) -> None:
+    logger.debug(message_object["msg_content"])
+    link = message_object["command_arg"]
+
+    # checked before the video is looked up, so spamming !play doesn't make network requests either
+    if rate_limiter is not None:
+        wait_s = rate_limiter.take(message_object["username"], get_priority(message_object.get("badges", {})))
+        if wait_s:
+            logger.info(f"{message_object['username']} is rate limited for {wait_s:.0f} s")
+            get_counter("bertha2_chat_play_commands_total", "!play commands by what became of them",
+                        result="rate_limited").inc()
+            writer.write(format_privmsg(
+                f"Sorry, you've queued a lot of videos, you can queue another one in {math.ceil(wait_s / 60)} min.",
+                CHANNEL,
+                reply_id=message_object["msg_id"]).encode("utf-8"))
+            return
+
+    # looking the video up makes network requests, so it runs in a thread to keep chat moving
+    loop = asyncio.get_running_loop()
+    try:
+        with get_histogram("bertha2_chat_video_lookup_seconds", "Time to look up the video of a !play command").time():
+            metadata = await loop.run_in_executor(None, metadata_cache.get_or_fetch, link)
+        invalid_reason = get_invalid_reason(metadata)
+    except Exception as e:
+        logger.info(f"CHAT: link is invalid {e}")
+        invalid_reason = "it's not a valid YouTube link"
+
+    if invalid_reason:
+        logger.info(f"Invalid video: {link}, {invalid_reason}")
+        get_counter("bertha2_chat_play_commands_total", "!play commands by what became of them", result="invalid").inc()
+
+        writer.write(format_privmsg(
+            f"Sorry, {link} can't be played, {invalid_reason}.",
+            CHANNEL,
+            reply_id=message_object["msg_id"]).encode("utf-8"))
+        return
+
+    # Queue.put adds the request to the global Queue variable, not a local Queue. See
+    #   multiprocessing.Queue for more info.
+    play_request = create_play_request(message_object, metadata)
+    record_queue_event(queue_event_q, EVENT_ENQUEUE, "link_q", play_request)
+    link_q.put(play_request)
+    # from the !play being read to the video being queued, the first stage of its trace
+    record_trace(queue_event_q, play_request, "chat", message_object.get("received_at", time.time()))
+    get_counter("bertha2_chat_play_commands_total", "!play commands by what became of them", result="queued").inc()
+    logger.info(f"The video follow video has been queued: {link}")
+    writer.write(format_privmsg(
+        f"Your video ({metadata['title']}) has been queued.",
+        CHANNEL,
+        reply_id=message_object["msg_id"]).encode("utf-8"))
+
+
+async def validate_play_commands(writer: asyncio.StreamWriter, validation_q: asyncio.Queue, link_q: Queue,
+                                 metadata_cache: VideoMetadataCache, queue_event_q: Queue = None,
+                                 rate_limiter: PlayRateLimiter = None) -> None:
+    # one of several workers, so a slow lookup doesn't hold up the !play commands behind it
+    while True:
+        message_object = await validation_q.get()
+        try:
+            await handle_play_command(writer, message_object, link_q, metadata_cache, queue_event_q, rate_limiter)
+        except Exception as e:
+            logger.warning(f"Could not handle {message_object['msg_content']}. {e}")
+            get_counter("bertha2_chat_play_commands_total", "!play commands by what became of them",
+                        result="error").inc()
+        finally:
+            validation_q.task_done()
+
+
+def create_message_handler(validation_q: asyncio.Queue):
+
+    async def handle_messages(messages: list) -> None:
+        get_counter("bertha2_chat_messages_total", "IRC lines read from Twitch chat, other than PINGs") \
+            .inc(len(messages))
+        for msg in messages:
+            try:
+                message_object = parse_privmsg(msg)
+            except Exception as e:
+                logger.warning(f"Could not parse message {msg}. {e}")
+                continue
+
+            if not message_object:
+                continue
+
+            logger.debug(message_object)
+
+            if message_object["command"] == "!play":
+                message_object["received_at"] = time.time()
+                validation_q.put_nowait(message_object)
+
+    return handle_messages
+
+
+async def read_chat(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, handle_messages) -> None:
+    """
+    Reads IRC lines from Twitch until the connection closes, and hands them to handle_messages in batches
+
+    :param handle_messages: Coroutine function that takes a list of the complete lines of one read
+    """
+    line_reader = IrcLineReader()
+
+    while True:
+        data = await reader.read(CHAT_READ_SIZE)
+        if not data:
+            raise ConnectionError("Twitch closed the chat connection")
+
+        messages = []
+        for line in line_reader.feed(data):
+            # this code ensures the IRC server knows the bot is still listening, it's answered before anything else
+            if line.startswith("PING"):
+                writer.write(f"PONG{line[4:]}\r\n".encode("utf-8"))
+            else:
+                messages.append(line)
+
+        if messages:
+            await handle_messages(messages)
+
+
+async def run_chat(sock: socket.socket, link_q: Queue, queue_event_q: Queue = None) -> None:
+    reader, writer = await asyncio.open_connection(sock=sock)
+
+    validation_q = asyncio.Queue()
+    metadata_cache = VideoMetadataCache()
+    # shared by the workers, which all run on this event loop
+    rate_limiter = PlayRateLimiter()
+    validation_workers = [
+        asyncio.create_task(validate_play_commands(writer, validation_q, link_q, metadata_cache, queue_event_q,
+                                                   rate_limiter))
+        for _ in range(VIDEO_VALIDATION_WORKERS)
+    ]
+
+    try:
+        await read_chat(reader, writer, create_message_handler(validation_q))
+    finally:
+        for worker in validation_workers:
+            worker.cancel()
+
+
+def chat_process(link_q: Queue, queue_event_q: Queue = None):
     """
     Reads through twitch chat and parses out commands
 
     :param: link_q: The queue that the YouTube links from chat should be added to
+    :param: queue_event_q: The queue that queue events are sent to, see utils/queue_state.py
     :return:
     """
     log_if_in_debug_mode(logger, __name__)
 
-    logger.debug(f"Twitch token, nickname: {TOKEN}, {NICKNAME}")
+    secrets = get_secrets()
+    logger.debug(f"Twitch token, nickname: {secrets.token}, {secrets.nickname}")
 
     # https://dev.twitch.tv/docs/irc
 
@@ -143,52 +281,10 @@ def chat_process(link_q: Queue):
 
     logger.info(f"Ready and waiting for twitch commands in [{CHANNEL}]...")
 
-    while True:
-        try:
-            resp = sock.recv(2048).decode("utf-8")
-
-            # this code ensures the IRC server knows the bot is still listening
-            if resp.startswith("PING"):
-                sock.send("PONG\n".encode("utf-8"))
-                continue
-            
-            message_object = parse_privmsg(resp)
-            if not message_object:
-                logger.warning("Could not parse message")
-                continue
-
-            logger.debug(message_object)
-
-            # TODO: Should this be it's own function?
-            if message_object["command"] == "!play":
-
-                logger.debug(message_object["msg_content"])
-                if not is_valid_youtube_video(message_object["command_arg"]):
-                    logger.debug(f"invalid youtube video")
-
-                    send_privmsg(sock,
-                                 f"Sorry, {message_object['command_arg']} is not a valid YouTube link. \
-                                 It's either an invalid link or it's age restricted.",
-                                 CHANNEL,
-                                 reply_id=message_object["msg_id"])
-                    continue
-
-
-                # Queue.put adds command_arg to the global Queue variable, not a local Queue. See
-                #   multiprocessing.Queue for more info.
-                # TODO: we can add video_name_q.put() here instead. just use
-                #   the youtube link that we have here and create a youtube object
-                link_q.put(message_object["command_arg"])
-                logger.info(f"The video follow video has been queued: {message_object['command_arg']}")
-                send_privmsg(
-                        sock, 
-                        f"Your video ({message_object['command_arg']}) has been queued.", 
-                        CHANNEL,
-                        reply_id=message_object["msg_id"])
-
-        except Exception as e:
-            logger.critical(f"Error{e}")
-            pass
+    try:
+        asyncio.run(run_chat(sock, link_q, queue_event_q))
+    except Exception as e:
+        logger.critical(f"Chat connection has been lost. {e}")
 
 if __name__ == "__main__":
     print("Running chat.py as main")
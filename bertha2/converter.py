@@ -1,79 +1,221 @@
 import asyncio
+import functools
+import io
 import logging
+import queue
 import random
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-import wget
-from moviepy.editor import VideoFileClip
-from pyppeteer import launch
 from pytube import YouTube
 from pytube.extract import video_id
 
 from bertha2.settings import (
     MIDI_FILE_PATH,
     AUDIO_FILE_PATH,
-    PROXY_PORT,
-    PROXY_USERNAME,
-    PROXY_PASSWORD,
-    VIDEO_FILE_PATH
+    VIDEO_FILE_PATH,
+    TRANSCRIPTION_BACKEND,
+    CONVERTER_DOWNLOAD_WORKERS,
+    CONVERTER_MIN_AUDIO_KBPS,
+    DISPLAY_VIDEO_MAX_RESOLUTION,
+    TRANSCRIPTION_SAMPLE_RATE,
+    CONVERTER_TRANSCRIBE_WORKERS,
+    CONVERTER_MAX_IN_FLIGHT,
+    get_secrets
 )
+from bertha2.utils.conversion_cache import ConversionCache, get_partial_filename, commit_partial_file, \
+    get_cache_file_stem, remove_partial_files
+from bertha2.utils.fair_queue import ScheduledQueue
+from bertha2.utils.queue_state import QueueState, QueueStateSubscriber, record_queue_event, record_trace, \
+    EVENT_ENQUEUE, EVENT_DEQUEUE, EVENT_COMPLETE
 from bertha2.utils.logs import initialize_module_logger, log_if_in_debug_mode
+from bertha2.utils.metrics import get_counter, get_histogram
+from bertha2.utils.pipeline import OrderedPipeline
+from bertha2.utils.transcription import TranscriptionBackend, SpectralTranscriptionBackend, decode_audio_data
+from bertha2.utils.video_metadata import VideoMetadataCache
 
 logger = initialize_module_logger(__name__)
 
+# created by converter_process, so only the converter process reads and writes the cache index
+conversion_cache = None
+display_video_executor = None
+video_metadata_cache = None
+
 # This is to prevent messy debug logs from pyppeteer
 pptr_logger = logging.getLogger("pyppeteer")
 pptr_logger.setLevel(50)
-pptr_logger.addHandler(logging.StreamHandler())
 
 
-def download_video_audio(youtube_url):
-    logger.debug(f"Converting YouTube URL into audio file...")
+def get_play_request(request):
+    # requests saved before chat looked videos up are just the link
+    if isinstance(request, str):
+        return {"id": request, "link": request, "title": None}
+    # and requests from before they had ids use their link
+    return {"id": request["link"], **request}
 
-    yt = YouTube(youtube_url)
-    file_name = video_id(youtube_url)
 
-    # download video
-    logger.debug(f"Starting video download")
-    yt.streams.first().download(
-        output_path=VIDEO_FILE_PATH, filename=f"{file_name}.mp4"
-    )
+def create_conversion(request):
+    # everything the stages of a conversion need to know about the video, passed from one stage to the next
+    request = get_play_request(request)
+    file_name = get_cache_file_stem(video_id(request["link"]))
+    return {
+        "id": request["id"],
+        "link": request["link"],
+        "video_id": video_id(request["link"]),
+        "title": request.get("title"),
+        # who asked for it, so the play queue can be shared fairly, see utils/fair_queue.py
+        "username": request.get("username"),
+        "length": request.get("length"),
+        "priority": request.get("priority"),
+        "video": os.path.join(VIDEO_FILE_PATH, file_name + ".mp4"),
+        "audio": None,  # only written to disk for backends that can't transcribe decoded audio
+        "audio_data": None,  # the downloaded audio stream, still encoded
+        "audio_extension": None,
+        "midi": os.path.join(MIDI_FILE_PATH, file_name + ".midi"),
+        # (start, end) time.time() of each step. Transcription runs in a worker process, so they're recorded when the
+        #   conversion is published
+        "timings": {},
+        "created_at": time.time(),
+    }
+
+
+def get_bitrate_kbps(stream):
+    # pytube describes bitrates like "48kbps"
+    return int(stream.abr[:-len("kbps")]) if stream.abr else 0
+
+
+def get_resolution(stream):
+    # pytube describes resolutions like "360p"
+    return int(stream.resolution[:-1]) if stream.resolution else 0
+
+
+def choose_audio_stream(audio_streams):
+    # the smallest audio stream that is still good enough to transcribe
+    audio_streams = sorted(audio_streams, key=get_bitrate_kbps)
+    if not audio_streams:
+        raise ValueError("Video has no audio streams")
+
+    suitable_streams = [stream for stream in audio_streams if get_bitrate_kbps(stream) >= CONVERTER_MIN_AUDIO_KBPS]
+    return (suitable_streams or audio_streams)[0]
+
+
+def choose_display_video_stream(video_streams):
+    # the video is only shown in a corner of the stream, so the largest video at or below the maximum resolution is used
+    video_streams = sorted(video_streams, key=get_resolution)
+    if not video_streams:
+        raise ValueError("Video has no video streams with audio")
+
+    small_streams = [stream for stream in video_streams if get_resolution(stream) <= DISPLAY_VIDEO_MAX_RESOLUTION]
+    return small_streams[-1] if small_streams else video_streams[0]
 
-    # convert to mp3
-    # str conversion + brackets are necessary
-    video_clip = VideoFileClip(str(VIDEO_FILE_PATH / (file_name + ".mp4")))
 
-    audio_clip = video_clip.audio
-    # str conversion + brackets are necessary
-    audio_clip.write_audiofile(str(AUDIO_FILE_PATH / (file_name + ".mp3")), verbose=False, logger=None)
+# every file is written under a partial name first, so a crash can't leave a half-written file behind
 
-    audio_clip.close()
-    video_clip.close()
+def download_display_video(yt, conversion):
+    logger.debug(f"Starting display video download")
+
+    stream = choose_display_video_stream(yt.streams.filter(progressive=True, file_extension="mp4"))
+    partial_filename = get_partial_filename(conversion["video"])
+    stream.download(output_path=VIDEO_FILE_PATH, filename=os.path.basename(partial_filename))
+    commit_partial_file(partial_filename, conversion["video"])
+
+
+def download_audio(yt, conversion):
+    logger.debug(f"Starting audio download")
+
+    # the audio is kept in memory, it's decoded straight into samples when it's transcribed
+    stream = choose_audio_stream(yt.streams.filter(only_audio=True))
+    buffer = io.BytesIO()
+    stream.stream_to_buffer(buffer)
+
+    conversion["audio_data"] = buffer.getvalue()
+    conversion["audio_extension"] = stream.subtype
+
+
+def get_video_title(yt, youtube_url):
+    metadata = video_metadata_cache.get(youtube_url) if video_metadata_cache is not None else None
+    return metadata["title"] if metadata is not None else yt.title
+
+
+def download_media(conversion):
+    start_time = time.time()
+    # the streams still need a YouTube object, but the title was already looked up by chat
+    yt = YouTube(conversion["link"])
+    if conversion["title"] is None:
+        conversion["title"] = get_video_title(yt, conversion["link"])
+
+    # the display video downloads at the same time as the audio
+    if display_video_executor is not None:
+        display_video_future = display_video_executor.submit(download_display_video, yt, conversion)
+        download_audio(yt, conversion)
+        display_video_future.result()
+    else:
+        download_audio(yt, conversion)
+        download_display_video(yt, conversion)
 
-    return file_name
+    conversion["timings"]["download"] = (start_time, time.time())
+    return conversion
+
+
+def transcribe_audio(conversion):
+    # runs in a worker process, so it only uses what it's given
+    backend = get_transcription_backend()
+    partial_midi_filename = get_partial_filename(conversion["midi"])
+
+    if backend.accepts_samples:
+        start_time = time.time()
+        samples = decode_audio_data(conversion["audio_data"], TRANSCRIPTION_SAMPLE_RATE)
+        conversion["timings"]["decode"] = (start_time, time.time())
+
+        start_time = time.time()
+        backend.transcribe_samples(samples, TRANSCRIPTION_SAMPLE_RATE, partial_midi_filename)
+        conversion["timings"]["transcription"] = (start_time, time.time())
+    else:
+        audio_filename = f"{get_cache_file_stem(conversion['video_id'])}.{conversion['audio_extension']}"
+        conversion["audio"] = os.path.join(AUDIO_FILE_PATH, audio_filename)
+        partial_audio_filename = get_partial_filename(conversion["audio"])
+        with open(partial_audio_filename, "wb") as f:
+            f.write(conversion["audio_data"])
+        commit_partial_file(partial_audio_filename, conversion["audio"])
+
+        start_time = time.time()
+        backend.transcribe(conversion["audio"], partial_midi_filename)
+        conversion["timings"]["transcription"] = (start_time, time.time())
+
+    commit_partial_file(partial_midi_filename, conversion["midi"])
+
+    # the audio isn't needed anymore, and doesn't have to be sent back from the worker process
+    conversion["audio_data"] = None
+    return conversion
 
 
 # TODO: get this function working
-async def convert_audio_to_midi(file_name):
+async def convert_audio_to_midi(audio_filename, midi_filename):
+    # only this backend needs a browser, so pyppeteer isn't imported by processes that never use it
+    import wget
+    from pyppeteer import launch
+
     log_if_in_debug_mode(logger, __name__)
     logger.debug(f"converting audio to midi")
     # TODO: put some try catches in here to prevent timeouts
 
     proxy_num = random.randrange(0, 100000)
+    secrets = get_secrets()
 
     logger.debug(f"ATTEMPTING TO GET LINK")
     browser = await launch(
         {
             "logLevel": 0,
-            "args": [f"--proxy-server=zproxy.lum-superproxy.io:{PROXY_PORT}"],
+            "args": [f"--proxy-server=zproxy.lum-superproxy.io:{secrets.proxy_port}"],
             # "headless": False,
         }
     )
     page = await browser.newPage()
     await page.authenticate(
         {
-            "username": f"{PROXY_USERNAME}-session-{proxy_num}",
-            "password": PROXY_PASSWORD,
+            "username": f"{secrets.proxy_username}-session-{proxy_num}",
+            "password": secrets.proxy_password,
         }
     )
 
@@ -94,8 +236,7 @@ async def convert_audio_to_midi(file_name):
     logger.debug(f"Opened the webpage successfully")
 
     filechoose = await page.querySelector("#localfile")
-    upload_file = str(AUDIO_FILE_PATH / (file_name + ".mp3"))
-    await filechoose.uploadFile(upload_file)
+    await filechoose.uploadFile(audio_filename)
 
     submit = await page.querySelector("#uploadProgress > p > button")
     await submit.click()
@@ -115,51 +256,233 @@ async def convert_audio_to_midi(file_name):
     logger.debug(f"{link}")
 
     logger.debug(f"Downloading midi file...")
-    wget.download(link, str(MIDI_FILE_PATH / (file_name + ".midi")))
+    wget.download(link, midi_filename)
 
 
-def video_to_midi(youtube_url):
-    # TODO: add a feature that checks if the YouTube video has already been converted
+class ConversionToolTranscriptionBackend(TranscriptionBackend):
+    """ Uploads the audio to conversion-tool.com through a headless browser and a proxy """
+    name = "conversion-tool"
 
-    yt = YouTube(youtube_url)
-    video_name = yt.vid_info['videoDetails']['title']
+    def transcribe(self, audio_filename, midi_filename):
+        asyncio.run(convert_audio_to_midi(audio_filename, midi_filename))
 
-    logger.info(f"Converting YouTube video \"{video_name}\" to a MIDI file")
 
-    # video_name = yt.vid_info
-    # file_name = video_id(youtube_url)
+TRANSCRIPTION_BACKENDS = {
+    backend.name: backend for backend in [SpectralTranscriptionBackend, ConversionToolTranscriptionBackend]
+}
 
-    # if it's been converted and found in files, return filepath (temporarily disabled for testing)
-    # if os.path.isfile(str(midi_file_path / (file_name + ".midi"))):
-    #     return str(midi_file_path / (file_name + ".midi"))
 
-    # TODO: can we convert multiple files at the same time? or can we convert them faster?
-    file_name = download_video_audio(youtube_url)  # store audio file in audio_file_path
+def get_transcription_backend(name=TRANSCRIPTION_BACKEND) -> TranscriptionBackend:
+    try:
+        return TRANSCRIPTION_BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown transcription backend {name}. Choose from {list(TRANSCRIPTION_BACKENDS)}")
 
-    # TODO: if this fails, rerun the function
-    asyncio.run(convert_audio_to_midi(file_name))
 
-    file_name += ".midi"
-    filepath = os.path.join(MIDI_FILE_PATH,  file_name)
+def get_cached_conversion(request):
+    if conversion_cache is None:
+        return None
 
-    return filepath, video_name
+    cached_conversion = conversion_cache.get(video_id(get_play_request(request)["link"]))
+    if cached_conversion is None:
+        return None
 
+    conversion = create_conversion(request)
+    conversion["title"] = cached_conversion["title"]
+    conversion.update(cached_conversion["files"])
+    return conversion
 
-def converter_process(sigint_e, conn, link_q, play_q,):
-    logger.info(f"Converter process has been started.")
-    while not sigint_e.is_set():
-        try:
-            link = link_q.get(timeout=10)
 
-            filepath, video_title = video_to_midi(link)
-            logger.info(f"Successfully converted {video_title} to a MIDI file")
+def video_to_midi(request):
+    """
+    Converts one video without the pipeline
+
+    :param request: Play request from chat, or a YouTube link
+    :return: Paths of the MIDI file and the video, and the title of the video
+    """
+    conversion = get_cached_conversion(request)
+
+    if conversion is None:
+        conversion = create_conversion(request)
+        for stage in [download_media, transcribe_audio]:
+            conversion = stage(conversion)
+        cache_conversion(conversion)
+
+    return conversion["midi"], conversion["video"], conversion["title"]
+
+
+def cache_conversion(conversion):
+    if conversion_cache is not None:
+        files = {kind: conversion[kind] for kind in ["video", "audio", "midi"] if conversion[kind] is not None}
+        conversion_cache.put(conversion["video_id"], conversion["title"], files)
+
+
+def create_play_item(conversion):
+    # what's put on play_q, it keeps the id of the request so the journal can follow it
+    return {"id": conversion["id"], "title": conversion["title"], "midi": conversion["midi"], "video": conversion["video"],
+            "username": conversion.get("username"), "length": conversion.get("length"),
+            "priority": conversion.get("priority")}
+
+
+def reuse_conversion(conversion, converted):
+    # the same video was converted for an earlier request, only who asked for it is different
+    return {**converted, "id": conversion["id"], "username": conversion["username"], "length": conversion["length"],
+            "priority": conversion["priority"], "timings": {}, "created_at": conversion["created_at"], "cached": True}
+
+
+def observe_conversion(conversion, result, queue_event_q=None):
+    for step, (start_time, end_time) in conversion["timings"].items():
+        get_histogram("bertha2_converter_step_seconds", "Time each step of a conversion took", step=step) \
+            .observe(end_time - start_time)
+        record_trace(queue_event_q, conversion, step, start_time, end_time)
+    # including the time spent waiting for a free worker, or for earlier videos to be published
+    get_histogram("bertha2_converter_conversion_seconds", "Time from a link being taken to its video being published",
+                  result=result).observe(time.time() - conversion["created_at"])
+    get_counter("bertha2_converter_conversions_total", "Links taken from link_q by what became of them",
+                result=result).inc()
+
+
+def create_conversion_pipeline(play_q, queue_event_q=None, in_flight_conversions=None):
+    """
+    Downloads and transcriptions of different videos run at the same time. Downloads wait on the network, so they use
+    threads. Decoding and transcription use the CPU, so they use processes. Videos are still published to play_q in
+    the order they were requested.
+
+    :param in_flight_conversions: Dict of MIDI file -> (conversion, future of its result) of the conversion writing
+        it, kept by the converter loop. A conversion is removed once it's published, by then it's in the cache.
+    """
+    if in_flight_conversions is None:
+        in_flight_conversions = {}
+
+    def remove_in_flight_conversion(requested_conversion):
+        # requests that waited for an earlier one were never added
+        if in_flight_conversions.get(requested_conversion["midi"], (None,))[0] is requested_conversion:
+            del in_flight_conversions[requested_conversion["midi"]]
+
+    def publish(requested_conversion, conversion):
+        remove_in_flight_conversion(requested_conversion)
+        if not conversion.get("cached"):
+            # the video can still be played, it's only converted again if it's asked for again
+            try:
+                cache_conversion(conversion)
+            except Exception as e:
+                logger.warning(f"Could not add {conversion['title']} to the conversion cache. {e}")
+        logger.info(f"Successfully converted {conversion['title']} to a MIDI file")
+        observe_conversion(conversion, "cached" if conversion.get("cached") else "converted", queue_event_q)
+
+        # As soon as a video is finished converting, it should be added to the queue because we know it's safe
+        play_item = create_play_item(conversion)
+        # recorded on play_q before it's completed on link_q, so a crash in between can't lose the video
+        record_queue_event(queue_event_q, EVENT_ENQUEUE, "play_q", play_item)
+        play_q.put(play_item)
+        record_queue_event(queue_event_q, EVENT_COMPLETE, "link_q", requested_conversion)
+
+    def report_error(requested_conversion, exception):
+        remove_in_flight_conversion(requested_conversion)
+        logger.error(f"Could not convert {requested_conversion['link']}. {exception}")
+        observe_conversion(requested_conversion, "failed", queue_event_q)
+        record_queue_event(queue_event_q, EVENT_COMPLETE, "link_q", requested_conversion)
+
+    stages = [
+        ("download", download_media, ThreadPoolExecutor(max_workers=CONVERTER_DOWNLOAD_WORKERS)),
+        ("transcribe", transcribe_audio, ProcessPoolExecutor(max_workers=CONVERTER_TRANSCRIBE_WORKERS)),
+    ]
+    return OrderedPipeline(stages, publish, report_error, CONVERTER_MAX_IN_FLIGHT)
+
+
+def submit_conversion(pipeline, in_flight_conversions, conversion):
+    # two requests for the same video would write the same files, so the second one waits for the first instead
+    if conversion["midi"] in in_flight_conversions:
+        logger.info(f"YouTube video {conversion['link']} is already being converted")
+        _, earlier_future = in_flight_conversions[conversion["midi"]]
+        pipeline.submit_after(conversion, earlier_future, functools.partial(reuse_conversion, conversion))
+    else:
+        in_flight_conversions[conversion["midi"]] = (conversion, pipeline.submit(conversion))
+
 
-            conn.send({"title": video_title,
-                       "filepath": f"{os.getcwd()}/files/video/{YouTube(link).video_id}.mp4"})  # This should be here. As soon as a video is finished converting, it should be added to the queue because we know it's safe
+def convert_request(pipeline, in_flight_conversions, request, queue_event_q=None):
+    # the request has been dequeued, so it has to be completed even if it can't be converted
+    try:
+        conversion = get_cached_conversion(request)
+    except Exception as e:
+        logger.warning(f"Could not read the conversion cache. {e}")
+        conversion = None
+
+    if conversion is not None:
+        logger.info(f"YouTube video \"{conversion['title']}\" has already been converted")
+        conversion["cached"] = True
+        pipeline.submit_result(conversion, conversion)
+        return
+
+    # e.g. a malformed link restored from the journal, which would crash the converter every time it's restarted
+    try:
+        conversion = create_conversion(request)
+    except Exception as e:
+        logger.error(f"Could not convert {request}. {e}")
+        record_queue_event(queue_event_q, EVENT_COMPLETE, "link_q", request)
+        return
+    submit_conversion(pipeline, in_flight_conversions, conversion)
+
+
+def get_files_in_use(queue_state: QueueState):
+    """
+    :return: Set of the files of every video that's waiting to be converted, being converted, or waiting to be played
+    """
+    files = set()
+    for request in queue_state.get_items("link_q"):
+        try:
+            conversion = create_conversion(request)
+        except Exception:
+            continue  # not a YouTube link, so it has no files
+        files.update([conversion["video"], conversion["midi"]])
+    for play_item in queue_state.get_items("play_q"):
+        # items saved before play_q held dicts are just the path of the MIDI file
+        files.update([play_item["midi"], play_item["video"]] if isinstance(play_item, dict) else [play_item])
+    return files
+
+
+def converter_process(sigint_e, link_q, play_q, queue_event_q=None, subscription_q=None):
+    """
+    :param subscription_q: Subscription to the queue state (see utils/queue_state.py), so the files of queued videos
+        aren't evicted from the conversion cache
+    """
+    global conversion_cache, display_video_executor, video_metadata_cache
+    subscriber = QueueStateSubscriber(subscription_q) if subscription_q is not None else None
+    conversion_cache = ConversionCache(
+        get_files_in_use=(lambda: get_files_in_use(subscriber.state)) if subscriber is not None else None)
+    video_metadata_cache = VideoMetadataCache()
+    display_video_executor = ThreadPoolExecutor(max_workers=CONVERTER_DOWNLOAD_WORKERS)
+
+    in_flight_conversions = {}  # see submit_conversion
+    pipeline = create_conversion_pipeline(play_q, queue_event_q, in_flight_conversions)
+    # nothing else writes to these, the partial files are left from a converter that was stopped or crashed
+    for directory in [VIDEO_FILE_PATH, AUDIO_FILE_PATH, MIDI_FILE_PATH]:
+        remove_partial_files(directory)
+    # links are converted in the order they're shared fairly between viewers, not the order they were requested
+    link_q = ScheduledQueue(link_q, "link_q", queue_event_q)
 
-            play_q.put(filepath)
-        except:  # this will occur when link_q is empty. not the best way to implement.
+    logger.info(f"Converter process has been started.")
+    while not sigint_e.is_set():
+        # keeps up with the queue state, so it doesn't pile up in the subscription
+        while subscriber is not None and subscriber.receive(timeout=0):
             pass
+        pipeline.publish_ready()
+
+        # the pipeline is full, wait for the oldest video instead of taking more links
+        if not pipeline.has_capacity():
+            pipeline.wait(timeout=1)
+            continue
+
+        try:
+            request = link_q.get(timeout=1)
+        except queue.Empty:
+            continue
+        record_queue_event(queue_event_q, EVENT_DEQUEUE, "link_q", request)
+        convert_request(pipeline, in_flight_conversions, request, queue_event_q)
 
     else:
+        pipeline.join()
+        for _, _, executor in pipeline.stages:
+            executor.shutdown()
+        display_video_executor.shutdown()
         logger.info(f"Converter process has been shut down.")
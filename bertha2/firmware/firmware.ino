@@ -4,6 +4,8 @@
 #define I2C_FREQ 115200
 #define SERIAL_BAUDRATE 115200
 #define PWM_FREQ 1600
+#define FRAME_START 0xFE  // first byte of a bulk update frame. Single updates never start with it.
+#define CRC8_POLYNOMIAL 0x07
 
 PCA9685 pwmController1(B000000);
 PCA9685 pwmController2(B000001);
@@ -17,6 +19,11 @@ byte buff[3];  // position byte, value byte, buffer byte
 byte pos;
 byte val;
 
+// sequence number, number of pairs, (address, pwm) pairs and checksum of a bulk update frame
+byte frame[2 + 2 * NUMBER_OF_CHANNELS + 1];
+byte expected_sequence_number = 0;
+bool skipping_to_frame_start = false;  // after a frame is dropped, the rest of it is thrown away up to the next frame
+
 
 // TODO: Make sure that cur_time can be handled as a super big number. It gets really big. long long int is 25 days of milliseconds. works just fine.
 
@@ -55,6 +62,78 @@ void change_channel_value(int channel, int value){
 }
 
 
+void set_solenoid(int channel, int value){
+  if(channel < 0 || channel >= NUMBER_OF_CHANNELS){
+    return;
+  }
+
+  // this code will set an array value for the time the solenoid turned on.
+  // Going from a strike to a hold keeps the time it was turned on, so held notes are still shut off if on too long.
+  if(value == 0){
+    on_at[channel] = 0;
+  } else if(on_at[channel] == 0){  // turned on from off
+    on_at[channel] = cur_time;
+  }
+
+  change_channel_value(channel, value);
+  return;
+}
+
+
+byte crc8(byte *data, int length){
+  byte crc = 0;
+  for(int i = 0; i < length; i++){
+    crc ^= data[i];
+    for(int bit = 0; bit < 8; bit++){
+      if(crc & 0x80){
+        crc = (crc << 1) ^ CRC8_POLYNOMIAL;
+      } else {
+        crc <<= 1;
+      }
+    }
+  }
+  return crc;
+}
+
+
+// Reads the rest of a bulk update frame after FRAME_START, and applies all of its changes at once.
+// A frame that is cut short or fails the checksum is dropped completely, and false is returned.
+bool read_update_frame(){
+  if(Serial.readBytes(frame, 2) != 2){
+    Serial.println("error: frame header timed out");
+    return false;
+  }
+
+  byte sequence_number = frame[0];
+  int number_of_pairs = frame[1];
+  if(number_of_pairs > NUMBER_OF_CHANNELS){
+    Serial.println("error: frame too long");
+    return false;
+  }
+
+  int length = 2 + 2 * number_of_pairs;
+  if(Serial.readBytes(frame + 2, length - 2 + 1) != length - 2 + 1){
+    Serial.println("error: frame timed out");
+    return false;
+  }
+
+  if(crc8(frame, length) != frame[length]){
+    Serial.println("error: bad checksum");
+    return false;
+  }
+
+  if(sequence_number != expected_sequence_number){
+    Serial.println("error: missed frame");
+  }
+  expected_sequence_number = sequence_number + 1;
+
+  for(int i = 2; i < length; i += 2){
+    set_solenoid(frame[i], frame[i + 1]);
+  }
+  return true;
+}
+
+
 void setup() {
 
   Serial.begin(SERIAL_BAUDRATE);
@@ -124,8 +203,19 @@ void loop() {
 
   if (Serial.available() > 0) {
 
-//    Serial.println("Reading serial data here!");
+    if(Serial.peek() == FRAME_START){
+      Serial.read();
+      skipping_to_frame_start = !read_update_frame();
+      return;
+    }
+
+    // the rest of a dropped frame isn't single updates, it's thrown away like decode_update_frames does
+    if(skipping_to_frame_start){
+      Serial.read();
+      return;
+    }
 
+    // single update: position byte, value byte, end byte. Both values are sent shifted up by 1.
     read_serial_data();
     buff[0] = temp[0];  // channel
     read_serial_data();
@@ -133,30 +223,9 @@ void loop() {
     read_end_byte();
     buff[2] = temp[0];
 
-//    Serial.print(buff[0]);
-//    Serial.print(" ");
-//    Serial.print(buff[1]);
-//    Serial.print(" ");
-//    Serial.print(buff[2]);
-//    Serial.print('\n');
-    
     buff[0] -= 1;
     buff[1] -= 1;
 
-
-    // this code will set an array value for the time the solenoid turned on    
-    if(buff[1] != 0 && on_at[buff[0]] == 0){  // if setting to a non-zero value and ...
-//      Serial.print("Set " + String(buff[0]) + " to ");
-//      Serial.println(cur_time);
-      on_at[buff[0]] = cur_time;
-    } else {
-//      Serial.println("Set " + String(buff[0]) + " to zero.");
-      on_at[buff[0]] = 0;
-    }
-    //////////
-    
-    
-    change_channel_value(buff[0], buff[1]);
-  
+    set_solenoid(buff[0], buff[1]);
   }
 }
@@ -4,7 +4,6 @@
 
 import asyncio
 import socket
-import struct
 import subprocess
 import time
 import os
@@ -13,18 +12,29 @@ import random
 import mido
 import serial
 
-import logging
-
-from bertha2.settings import cli_args, SOLENOID_COOLDOWN_S, LOG_FORMAT
+from bertha2.settings import get_cli_args, SOLENOID_PEAK_TIME_S, STARTING_NOTE, NUMBER_OF_NOTES, \
+    SOLENOID_CALIBRATION_FILENAME, PLAYBACK_PLAN_VERSION, PLAYBACK_ERROR_BUCKETS_S, SOLENOID_HEAT_FILENAME
+from bertha2.utils.envelope import EnvelopeTable, load_calibration
+from bertha2.utils.fair_queue import ScheduledQueue
+from bertha2.utils.thermal import ThermalModel
+from bertha2.utils.voicing import arrange_notes
+from bertha2.utils.queue_state import record_queue_event, record_status, record_trace, EVENT_DEQUEUE, EVENT_COMPLETE
+from bertha2.utils.plan import load_or_compile_plan
+from bertha2.utils.serial_link import encode_update_frame, VirtualPiano, SERIAL_BAUDRATE
+from bertha2.utils.scheduler import build_envelope_event_queue, resolve_event_queue, play_timeline
 from bertha2.utils.logs import initialize_module_logger, log_if_in_debug_mode, initialize_root_logger
+from bertha2.utils.metrics import get_counter, get_gauge, get_histogram
+
+logger = initialize_module_logger(__name__)
 
-# logger = initialize_module_logger(__name__)
-logging.basicConfig(level=10, format=LOG_FORMAT)
-logger = logging.getLogger(__name__)
+# updated while a song plays, so they're looked up once
+frames_sent = get_counter("bertha2_hardware_frames_total", "Frames sent to the solenoids")
+playback_errors = get_histogram("bertha2_hardware_playback_error_seconds",
+                                "How late each wakeup of the playback loop was", buckets=PLAYBACK_ERROR_BUCKETS_S)
 
 ### GLOBAL VARIABLES ###
-starting_note = 41
-number_of_notes = 48
+starting_note = STARTING_NOTE
+number_of_notes = NUMBER_OF_NOTES
 arduino_connection = None
 sock = None
 TEST_FLAG = False
@@ -32,7 +42,16 @@ TEST_FLAG = False
 # TODO: this shouldn't be defined when not in test mode
 last_cl_update = time.time()
 sock = None
+
+# the last value sent to each solenoid, and the changes waiting to be sent with the next frame
 note_values = [0] * number_of_notes
+pending_note_values = {}
+frame_sequence_number = 0
+
+# loaded from the calibration file the first time a song is compiled
+envelope_table = None
+# how hot each solenoid is, created when the first song is played
+thermal_model = None
 
 
 ### TEST PATTERN FUNCTIONS ###
@@ -61,6 +80,7 @@ async def test_every_note_at_once(hold_note_time=10, number_of_notes=5):
 def turn_on_some_notes():
     for note in range(20):
         update_solenoid_value(note, 254)
+    flush_solenoid_updates()
 
 
 '''
@@ -118,68 +138,56 @@ def update_cl_vis(out_str):
 
 ### IMPORTANT MAIN FUNCTIONS ###
 def update_solenoid_value(note_address, pwm_value):
-    if TEST_FLAG:  # when testing, output doesn't go to the actual hardware, it's just visualized on the command line
+    # the change is only staged here, flush_solenoid_updates sends every change of the tick at once
+    # note_address is always a solenoid, notes are fitted onto them when the playback plan is compiled
 
-        # this will ensure pwm_value does not exceed the bounds of 8-bit int
-        if pwm_value > 254: pwm_value = 254
-        if pwm_value < 0: pwm_value = 0
+    # this will ensure pwm_value does not exceed the bounds of 8-bit int
+    if pwm_value > 254: pwm_value = 254
+    if pwm_value < 0: pwm_value = 0
 
-        # if a note is up to an octave below what is available to be played, shift it up an octave
-        if note_address < 0:
-            logger.debug(f"too low! for now... {note_address}")
-            note_address += 24
+    pending_note_values[note_address] = int(pwm_value)
 
-        # if a note is up to an octave below what is available to be played, shift it up an octave
-        if note_address > number_of_notes:
-            logger.debug(f"too high! for now... {note_address}")
-            note_address -= 24
 
-        # this will ensure only valid notes are toggled, preventing memory address not found errors
-        if (note_address < 0) or (note_address > number_of_notes - 1) or (note_address >= 255): return
+def reset_solenoid_state():
+    # for a new connection, where every solenoid starts off
+    global frame_sequence_number
+    note_values[:] = [0] * number_of_notes
+    pending_note_values.clear()
+    frame_sequence_number = 0
 
-        note_values[note_address] = pwm_value
 
-        # logger.debug(note_values)
+def flush_solenoid_updates():
+    global frame_sequence_number
 
-        o = generate_hardware_vis(note_values)
+    # only values that differ from what the solenoid is already set to are sent
+    changes = [(note_address, pwm_value) for note_address, pwm_value in pending_note_values.items()
+               if note_values[note_address] != pwm_value]
+    pending_note_values.clear()
+
+    if not changes:
+        return
+
+    for note_address, pwm_value in changes:
+        note_values[note_address] = pwm_value
+
+    if TEST_FLAG:  # when testing, output doesn't go to the actual hardware, it's just visualized on the command line
         # this part of the code will send hardware outputs to an open netcat terminal
-        update_cl_vis(o)
+        update_cl_vis(generate_hardware_vis(note_values))
 
     else:
-        # ensure that note_address or pwm_value are always between 1 and 255.
-        #   0 must be reserved for error codes in arduino (the stupidest thing I ever heard).
-        note_address += 1
-        pwm_value += 1
-
-        # this will ensure pwm_value does not exceed the bounds of 8-bit int
-        if pwm_value > 254:
-            pwm_value = 254
-        if pwm_value < 1:
-            pwm_value = 1
-
-        # if a note is up to an octave below what is available to be played, shift it up an octave
-        if note_address < 0 + 1:
-            # logger.debug(f"too low! for now... {note_address}")
-            note_address += 24
-
-        # if a note is up to an octave below what is available to be played, shift it up an octave
-        if note_address > number_of_notes + 1:
-            # logger.debug(f"too high! for now... {note_address}")
-            note_address -= 24
-
-        # this will ensure only valid notes are toggled, preventing memory address not found errors
-        if (note_address < 0 + 1) or (note_address > number_of_notes + 1) or (note_address >= 254): return
-
-        logger.debug(f"{note_address}, {int(pwm_value)}")
+        # formatted only if debug logging is on, this runs every tick
+        logger.debug("frame %d: %s", frame_sequence_number, changes)
         if arduino_connection is not None:
-            arduino_connection.write(struct.pack('>3B', int(note_address), int(pwm_value), int(255)))
+            arduino_connection.write(encode_update_frame(frame_sequence_number, changes))
+        frame_sequence_number = (frame_sequence_number + 1) % 256
+        frames_sent.inc()
 
 
 def power_draw_function(velocity, time_passed):
     # create a function that will determine the power emitted at different points in time
     # max output value should be 255?
 
-    cutoff = 0.1  # TODO: find a value for this variable. seconds
+    cutoff = SOLENOID_PEAK_TIME_S
     minimum_power = 100  # TODO: find a value for this variable. minimum amount of power required to depress note
     minimum_hold = 50  # TODO: find a value for this variable. minimum amount of power to keep depressing the note after it's already been depressed initially
     maximum_power = 150
@@ -206,20 +214,24 @@ async def trigger_note(note, init_note_delay=0.0, velocity=255, hold_note_time=1
 
         if passed_time > hold_note_time:
             update_solenoid_value(note, 0)
+            flush_solenoid_updates()
             return
         else:
             y = power_draw_function(velocity, passed_time)
             update_solenoid_value(note, y)
+            flush_solenoid_updates()
 
         await asyncio.sleep(0.01)
 
 
-async def play_midi_file(midi_filename):
-    # TODO: be able to start playback from a certain point in the video (10 seconds in)
-    # TODO: add a 30 second limit to video playback
+def read_midi_notes(midi_filename):
+    """
+    Reads a MIDI file into a list of notes
 
-    tasks = []
-    start_time = time.time()
+    :param midi_filename: Path to the MIDI file
+    :return: List of (note_address, start_time, velocity, hold_note_time) tuples, ordered by note_off
+    """
+    notes = []
     input_time = 0
     mid = mido.MidiFile(midi_filename)
     ticks_per_beat = mid.ticks_per_beat
@@ -241,25 +253,77 @@ async def play_midi_file(midi_filename):
         else:
             if (msg.type == 'note_on') and (msg.velocity != 0):
                 note = msg.note - starting_note
-                logger.debug(f"note_on {note} {msg.velocity} {input_time}")
+                logger.debug("note_on %d %d %f", note, msg.velocity, input_time)
                 temp_lengs.update({note: {"velocity": msg.velocity, "init_note_delay": input_time}})
 
             elif (msg.type == 'note_off') or ((msg.type == 'note_on') and (msg.velocity == 0)):
                 note = msg.note - starting_note
-                logger.debug(f"note_off {note}")
-                # logger.debug(temp_lens)
+                logger.debug("note_off %d", note)
 
-                # TODO: error checks
-                # make sure temp_lens[msg.note] exists and isn't from some past note.
+                # a note_off without a matching note_on can't be played, skip it instead of failing the whole song
+                note_on = temp_lengs.pop(note, None)
+                if note_on is None:
+                    logger.debug("note_off %d has no matching note_on", note)
+                    continue
 
-                init_note_delay = temp_lengs[note]["init_note_delay"]
-                velocity = temp_lengs[note]["velocity"]
-                hold_note_time = input_time - temp_lengs[note]["init_note_delay"]
+                init_note_delay = note_on["init_note_delay"]
+                velocity = note_on["velocity"]
+                hold_note_time = input_time - init_note_delay
 
-                tasks.append(trigger_note(note, init_note_delay, velocity, hold_note_time))
+                notes.append((note, init_note_delay, velocity, hold_note_time))
 
-    # gather tasks and run
-    await asyncio.gather(*tasks)
+    return notes
+
+
+def get_envelope_table() -> EnvelopeTable:
+    global envelope_table
+    if envelope_table is None:
+        envelope_table = EnvelopeTable(load_calibration(SOLENOID_CALIBRATION_FILENAME, number_of_notes))
+    return envelope_table
+
+
+def get_thermal_model() -> ThermalModel:
+    global thermal_model
+    if thermal_model is None:
+        # the heat is saved, so a restarted process doesn't think the solenoids are cold
+        thermal_model = ThermalModel(number_of_notes, filename=SOLENOID_HEAT_FILENAME)
+    return thermal_model
+
+
+def compile_playback_plan(midi_filename):
+    """
+    Turns a MIDI file into the solenoid transitions that play it, with the power envelope already applied
+
+    :return: Lists of (times, note_addresses, pwm_values), ordered by time
+    """
+    notes, stats = arrange_notes(read_midi_notes(midi_filename), get_envelope_table(), number_of_notes)
+    logger.debug("Fitted %d notes onto the solenoids: %d folded, %d merged, %d stolen",
+                 stats["notes"], stats["folded"], stats["merged"], stats["stolen"])
+
+    # every note on, hold and off transition is merged into one queue instead of a task per note. The envelope of
+    #   every note comes from the calibrated lookup table, so tuning a key doesn't cost anything during playback
+    events = build_envelope_event_queue(notes, get_envelope_table(), [note[0] for note in notes])
+    return resolve_event_queue(events)
+
+
+def load_playback_plan(midi_filename):
+    return load_or_compile_plan(midi_filename, compile_playback_plan,
+                                compile_key=f"{PLAYBACK_PLAN_VERSION}:{get_envelope_table().key}")
+
+
+async def play_midi_file(midi_filename):
+    await play_plan(load_playback_plan(midi_filename))
+
+
+async def play_plan(plan):
+    # TODO: be able to start playback from a certain point in the video (10 seconds in)
+    # TODO: add a 30 second limit to video playback
+
+    stats = await play_timeline(plan["time"], plan["address"], plan["pwm"], update_solenoid_value,
+                                flush_function=flush_solenoid_updates, error_histogram=playback_errors)
+
+    logger.debug("Played %d events with %d wakeups, max timing error %.2f ms",
+                 stats["events"], stats["wakeups"], stats["max_error_s"] * 1000)
 
 
 def create_connection_with_piano():
@@ -273,15 +337,15 @@ def create_connection_with_piano():
         potential_ports = subprocess.check_output(["ls -a /dev/cu.usbserial*"], shell=True,
                                                   stderr=subprocess.DEVNULL).decode('ascii')
 
-        logger.debug(f"Setting serial up")
+        logger.debug("Setting serial up")
         arduino_connection = serial.Serial()
         port_to_use = potential_ports.split("\n")[0]
-        logger.debug(f"Setting Arduino port to: {port_to_use}")
+        logger.debug("Setting Arduino port to: %s", port_to_use)
         arduino_connection.port = port_to_use
-        logger.debug(f"Setting Arduino baudrate and timeout: {port_to_use}")
-        arduino_connection.baudrate = 115200
+        logger.debug("Setting Arduino baudrate and timeout: %s", port_to_use)
+        arduino_connection.baudrate = SERIAL_BAUDRATE
         arduino_connection.timeout = 0.1
-        logger.debug(f"Connecting to arduino on port:{port_to_use}")
+        logger.debug("Connecting to arduino on port:%s", port_to_use)
         arduino_connection.open()
 
     except:
@@ -289,15 +353,58 @@ def create_connection_with_piano():
         raise ConnectionRefusedError
 
 
-def hardware_process_loop(hardware_visuals_conn, play_q):
-    filepath = play_q.get(timeout=10)
-    logger.info("Starting playback of song on hardware")
-    hardware_visuals_conn.send("playing")
-    asyncio.run(play_midi_file(filepath))
-    hardware_visuals_conn.send("cooldown")
-    # wait to cool down solenoids
-    time.sleep(SOLENOID_COOLDOWN_S)
-    hardware_visuals_conn.send("waiting")
+def create_connection_with_virtual_piano():
+    global arduino_connection
+    arduino_connection = VirtualPiano(number_of_notes)
+    reset_solenoid_state()
+    logger.info("Playing to a virtual piano, nothing is sent to the hardware")
+
+
+def measure_plan_heat(plan, end_time=None):
+    return get_thermal_model().measure_song_heat(plan["time"], plan["address"], plan["pwm"], end_time=end_time)
+
+
+def hardware_process_loop(play_q, queue_event_q=None):
+    play_item = play_q.get(timeout=1)
+    record_queue_event(queue_event_q, EVENT_DEQUEUE, "play_q", play_item)
+    # items saved before play_q held dicts are just the path of the MIDI file
+    filepath = play_item["midi"] if isinstance(play_item, dict) else play_item
+
+    try:
+        load_start_time = time.time()
+        plan = load_playback_plan(filepath)
+        record_trace(queue_event_q, play_item, "load_plan", load_start_time)
+
+        # wait to cool down solenoids, only as long as the ones this song plays need
+        song_heat = measure_plan_heat(plan)
+        cooldown_s = get_thermal_model().get_cooldown_s(song_heat)
+        get_histogram("bertha2_hardware_cooldown_seconds", "Time spent cooling down before each song") \
+            .observe(cooldown_s)
+        if cooldown_s > 0:
+            logger.info(f"Cooling down for {cooldown_s:.1f} s before the next song")
+            record_status(queue_event_q, "cooldown", cooldown_s=cooldown_s)
+            cooldown_start_time = time.time()
+            time.sleep(cooldown_s)
+            record_trace(queue_event_q, play_item, "cooldown", cooldown_start_time)
+
+        logger.info("Starting playback of song on hardware")
+        record_status(queue_event_q, "playing")
+        start_time = time.monotonic()
+        playback_start_time = time.time()
+        get_thermal_model().save(song_heat, start_time)
+        try:
+            asyncio.run(play_plan(plan))
+        finally:
+            record_trace(queue_event_q, play_item, "playback", playback_start_time)
+            # only what was played heats the solenoids, if the song stopped early
+            get_thermal_model().add_song(measure_plan_heat(plan, end_time=time.monotonic() - start_time), start_time)
+            get_thermal_model().save()
+            get_gauge("bertha2_hardware_max_solenoid_heat", "Heat of the hottest solenoid after the last song, "
+                      "in seconds at full power").set(float(get_thermal_model().heat.max()))
+        get_counter("bertha2_hardware_songs_total", "Songs played to the end").inc()
+    finally:
+        record_queue_event(queue_event_q, EVENT_COMPLETE, "play_q", play_item)
+    record_status(queue_event_q, "waiting")
     logger.info("Finished playback of song on hardware")
 
 
@@ -311,23 +418,32 @@ def create_connection_with_terminal():
         raise ConnectionRefusedError
 
 
-def hardware_process(sigint_e, hardware_visuals_conn, play_q, ):
+def hardware_process(sigint_e, play_q, queue_event_q=None):
     log_if_in_debug_mode(logger, __name__)
 
     global TEST_FLAG
+    cli_args = get_cli_args()
     TEST_FLAG = cli_args.disable_hardware
 
-    if TEST_FLAG:
+    if cli_args.virtual_piano:
+        TEST_FLAG = False
+        create_connection_with_virtual_piano()
+
+    elif TEST_FLAG:
         create_connection_with_terminal()
 
     else:  # test mode is disabled
         create_connection_with_piano()
 
+    # videos are played in the order they're shared fairly between viewers, not the order they were converted
+    play_q = ScheduledQueue(play_q, "play_q", queue_event_q)
+
     while not sigint_e.is_set():
         try:
-            hardware_process_loop(hardware_visuals_conn, play_q)
+            hardware_process_loop(play_q, queue_event_q)
 
-        except:
+        # not SystemExit, which is how the process is terminated
+        except Exception:
             pass
     else:
         logger.info("Hardware process has been shut down.")
@@ -367,6 +483,7 @@ def play_random_real_song():
 
 
 if __name__ == '__main__':
+    initialize_root_logger(__name__)
     logger.info("Running some tests.")
 
     create_connection_with_piano()
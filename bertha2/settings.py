@@ -1,14 +1,12 @@
-import argparse
-from os import getenv, getcwd
+""" Settings of every process. The command line, secrets.env and cuss words are only read when first used """
+
+import functools
 import os
+from os import getenv, getcwd
 from pathlib import Path
+from typing import NamedTuple
 
-from dotenv import load_dotenv
-if os.path.isfile("secrets.env"):
-    load_dotenv("secrets.env")
-else:
-    print("secrets.env not found!")
-    raise FileNotFoundError;
+SECRETS_FILENAME = "secrets.env"
 
 
 # === Bertha2 Details ===
@@ -19,47 +17,74 @@ AUDIO_FILE_PATH = os.path.join(cwd, TEMPORARY_FILES_PATH, "audio")
 VIDEO_FILE_PATH = os.path.join(cwd, TEMPORARY_FILES_PATH, "video")
 DIRS = [MIDI_FILE_PATH, AUDIO_FILE_PATH, VIDEO_FILE_PATH]  # add any other file paths to this variable
 
-QUEUE_SAVE_FILENAME = "saved_queues.json"
+QUEUE_SAVE_FILENAME = "saved_queues.json"  # only read, to load queues saved before there was a journal
+QUEUE_JOURNAL_FILENAME = "queue_journal.jsonl"
+QUEUE_JOURNAL_COMPACT_AFTER_EVENTS = 1000
+TRACE_LOG_FILENAME = "traces.jsonl"  # how long each item spent in each stage, see utils/tracing.py
+TRACE_LOG_MAX_BYTES = 10 * 1024 ** 2  # then it's moved to traces.jsonl.1 and a new one is started
+
+# Supervisor, which restarts processes that crash or stop responding
+SUPERVISOR_CHECK_INTERVAL_S = 0.05
+SUPERVISOR_HEARTBEAT_INTERVAL_S = 1
+SUPERVISOR_HEARTBEAT_TIMEOUT_S = 10  # a process is restarted if its heartbeat is older than this
+SUPERVISOR_MIN_BACKOFF_S = 0.25  # wait before restarting a process that failed again, doubled every time
+SUPERVISOR_MAX_BACKOFF_S = 60
+SUPERVISOR_STABLE_AFTER_S = 60  # the backoff is reset once a process has been up this long
+SUPERVISOR_REPORT_INTERVAL_S = 15 * 60  # restart counts and uptime are logged this often
+SUPERVISOR_STOP_TIMEOUT_S = 5  # a process that's stopped gets this long to exit, then it's terminated, then killed
+SUPERVISOR_SHUTDOWN_TIMEOUT_S = 60  # the same on shutdown, so the converter can finish the videos it's converting
+SUPERVISOR_QUEUE_POLL_INTERVAL_S = 0.05  # how often get_from_queue looks for an item
+
+# Metrics, served in the Prometheus text format at http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+METRICS_REPORT_INTERVAL_S = 5  # each process sends its metrics to the main process this often
 
 # Chat
 # TODO: decide on an appropriate maximum video length
 MAX_VIDEO_LENGTH_SECONDS = 360
+VIDEO_METADATA_CACHE_FILENAME = os.path.join(cwd, TEMPORARY_FILES_PATH, "video_metadata.json")
+VIDEO_METADATA_CACHE_TTL_S = 6 * 60 * 60  # videos can be made private or age restricted later, so entries expire
+VIDEO_VALIDATION_WORKERS = 4  # !play links checked at the same time
+
+# Play queue, shared fairly between viewers, see utils/fair_queue.py
+PLAY_PRIORITY_BADGES = {"broadcaster": 0, "moderator": 0, "vip": 1, "subscriber": 1}  # lower lanes are played first
+PLAY_DEFAULT_PRIORITY = 2  # viewers without any of those badges
+# by priority lane, the !play commands a viewer can make at once, and the seconds until they can make another one.
+#   Lanes that aren't listed aren't limited.
+PLAY_RATE_LIMITS = {1: (5, 120), 2: (3, 300)}
+FAIR_QUEUE_MIN_COST_S = 30  # songs count as at least this long, so short ones can't take a viewer's turn for free
 
 # Converter
 CUSS_WORDS_FILENAME = os.path.join(cwd, "cuss_words.txt")
+TRANSCRIPTION_BACKEND = "spectral"  # "spectral" runs offline, "conversion-tool" uploads to conversion-tool.com
+TRANSCRIPTION_SAMPLE_RATE = 22050
+CONVERTER_VERSION = 1  # bump this when converted files change, so old conversions are not reused
+CONVERSION_CACHE_INDEX_FILENAME = os.path.join(cwd, TEMPORARY_FILES_PATH, "conversion_cache.json")
+CONVERSION_CACHE_MAX_BYTES = 2 * 1024 ** 3  # video, audio and MIDI files together
+# number of videos each stage of the converter works on at the same time
+CONVERTER_DOWNLOAD_WORKERS = 3
+CONVERTER_TRANSCRIBE_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+CONVERTER_MAX_IN_FLIGHT = 8  # links taken from link_q before the oldest one is finished
+CONVERTER_MIN_AUDIO_KBPS = 48  # the smallest audio stream at or above this bitrate is transcribed
+DISPLAY_VIDEO_MAX_RESOLUTION = 360  # the video shown in OBS, in vertical pixels
 
 
 # Hardware
-SOLENOID_COOLDOWN_S = 30
-
-
-# Visuals
-
-def import_cuss_words():
-    global cuss_words
-
-    try:
-        with open(CUSS_WORDS_FILENAME) as f:
-            words = f.read()
-            word_list = words.split("\n")
-            word_list = list(filter(None, word_list))  # Remove blank elements (e.g. "") from array
-            return word_list
-    except Exception as e:
-        print(f"CUSS WORDS NOT ENABLED {e}")
-        return []
-
-CUSS_WORDS = import_cuss_words()
-
-
-# Initialize arguments
-parser = argparse.ArgumentParser(prog='Bertha2')
-parser.add_argument('--disable_hardware', action='store_true')  # checks if the `--disable_hardware` flag is used
-parser.add_argument("--log", action="store")
-parser.add_argument("--debug_visuals", action='store_true')
-parser.add_argument("--debug_converter", action='store_true')
-parser.add_argument("--debug_hardware", action='store_true')
-parser.add_argument("--debug_chat", action='store_true')
-cli_args = parser.parse_args()
+STARTING_NOTE = 41  # MIDI note of the lowest solenoid
+NUMBER_OF_NOTES = 48
+SOLENOID_COOLDOWN_S = 30  # the longest cooldown between songs, the thermal model usually needs less
+SOLENOID_THERMAL_TIME_CONSTANT_S = 60  # a solenoid loses 63% of its heat in this long
+SOLENOID_HEAT_LIMIT = 12  # the most heat a solenoid may have, in seconds at full power (holding a key reaches 11.8)
+SOLENOID_HEAT_FILENAME = "solenoid_heat.json"  # the heat of each solenoid, so it's still known after a restart
+SOLENOID_PEAK_TIME_S = 0.1  # how long a note is driven at peak power before dropping to hold power
+SOLENOID_CALIBRATION_FILENAME = os.path.join(cwd, "files", "solenoid_calibration.json")  # power envelope of each key
+ENVELOPE_BUCKET_S = 0.01  # time resolution of the power envelopes
+MAX_POLYPHONY = 16  # most solenoids on at once
+SOLENOID_CURRENT_BUDGET = 8.0  # most current the power supply delivers, in solenoids at full power (PWM 255)
+DUPLICATE_NOTE_WINDOW_S = 0.01  # notes struck this close together on one solenoid are played as one
+PLAYBACK_PLAN_VERSION = 2  # bump this when compiled playback plans change, so old plans are compiled again
+PLAYBACK_ERROR_BUCKETS_S = (0.0001, 0.00025, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1)
 
 
 # Logging Formatter
@@ -69,25 +94,23 @@ BLUE = "\x1b[34;49;1m"
 GREEN = "\x1b[32;49;1m"
 RESET = "\x1b[0m"
 LOG_FORMAT = f"{BLUE}[%(levelname)s]{MAGENTA}[%(name)s]{RESET} %(message)s     {GREEN}[%(filename)s:%(lineno)d]{RESET}"
+# most debug messages each logger sends a second, the rest are dropped. For loggers that log while a song plays.
+LOG_DEBUG_RATE_LIMITS = {
+    "bertha2.hardware": 50,
+    "bertha2.visuals": 20,
+}
 
 
 # Twitch Details
 CHANNEL = 'berthatwo'  # the channel of which chat is being monitored
 
-# TODO: Check if secrets.env can be found
-
-# Twitch Login Details
-NICKNAME = getenv("NICKNAME")
-TOKEN = getenv("TOKEN")
-CLIENT_ID = getenv("CLIENT_ID")
-
-PROXY_PORT = getenv("PROXY_PORT")
-PROXY_USERNAME = getenv("PROXY_USERNAME")
-PROXY_PASSWORD = getenv("PROXY_PASSWORD")
 
 
 # OBS
 OBS_WEBSOCKET_URL = 'ws://127.0.0.1:4444'
+OBS_REQUEST_TIMEOUT_S = 5
+OBS_RECONNECT_MIN_BACKOFF_S = 0.5  # doubled after every failed attempt to reach OBS
+OBS_RECONNECT_MAX_BACKOFF_S = 30
 SCENE_NAME = 'Scene'
 MEDIA_NAME = 'Video'
 MAX_VIDEO_TITLE_LENGTH_QUEUE = 45
@@ -100,6 +123,7 @@ VISUALS_EMPTY_QUEUE_NEXT_UP_MESSAGE = "Nothing queued."
 VISUALS_NONEMPTY_QUEUE_HEADER_MESSAGE = "Next Up:"
 STATUS_TEXT_OBS_SOURCE_ID = "current_song"
 PLAYING_VIDEO_OBS_SOURCE_ID = "playing_video"
+VISUALS_FRAME_WINDOW_S = 0.1  # changes that arrive this close together are sent to OBS together
 
 
 DEFAULT_VISUALS_STATE = {
@@ -109,7 +133,97 @@ DEFAULT_VISUALS_STATE = {
     "queued_video_metadata_objects": [],  # 0th subscript in this list is the currently playing video
     "is_video_currently_playing": False,
     "is_bertha_on_cooldown": False,
+    "cooldown_s": SOLENOID_COOLDOWN_S,
     "does_next_up_need_update": True,
     "does_status_text_need_update": True
 }
 
+
+# Command line arguments, secrets and cuss words, read the first time they're used so importing a module doesn't
+#   parse arguments or read files. Every process reads them itself, once. NamedTuple is used over dataclass because
+#   dataclasses imports inspect, which is most of the time it takes to import settings.
+
+class CommandLineArguments(NamedTuple):
+    disable_hardware: bool = False  # plays nothing, for running without the piano connected
+    virtual_piano: bool = False  # plays to a piano in memory instead of the hardware
+    log: str = None
+    debug_visuals: bool = False
+    debug_converter: bool = False
+    debug_hardware: bool = False
+    debug_chat: bool = False
+
+
+@functools.lru_cache(maxsize=None)
+def get_cli_args() -> CommandLineArguments:
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='Bertha2')
+    parser.add_argument('--disable_hardware', action='store_true')
+    parser.add_argument('--virtual_piano', action='store_true')
+    parser.add_argument("--log", action="store")
+    parser.add_argument("--debug_visuals", action='store_true')
+    parser.add_argument("--debug_converter", action='store_true')
+    parser.add_argument("--debug_hardware", action='store_true')
+    parser.add_argument("--debug_chat", action='store_true')
+    # arguments meant for something else, like a test runner, are left alone
+    cli_args, _ = parser.parse_known_args()
+    return CommandLineArguments(**vars(cli_args))
+
+
+class Secrets(NamedTuple):
+    nickname: str = None  # Twitch login details
+    token: str = None
+    client_id: str = None
+    proxy_port: str = None
+    proxy_username: str = None
+    proxy_password: str = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_secrets() -> Secrets:
+    if not os.path.isfile(SECRETS_FILENAME):
+        print(f"{SECRETS_FILENAME} not found!")
+        raise FileNotFoundError(SECRETS_FILENAME)
+
+    from dotenv import load_dotenv
+    load_dotenv(SECRETS_FILENAME)
+    return Secrets(
+        nickname=getenv("NICKNAME"),
+        token=getenv("TOKEN"),
+        client_id=getenv("CLIENT_ID"),
+        proxy_port=getenv("PROXY_PORT"),
+        proxy_username=getenv("PROXY_USERNAME"),
+        proxy_password=getenv("PROXY_PASSWORD"),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_cuss_words():
+    try:
+        with open(CUSS_WORDS_FILENAME) as f:
+            words = f.read()
+            word_list = words.split("\n")
+            word_list = list(filter(None, word_list))  # Remove blank elements (e.g. "") from array
+            return word_list
+    except Exception as e:
+        print(f"CUSS WORDS NOT ENABLED {e}")
+        return []
+
+
+# the names these had when they were read at import
+_LAZY_SETTINGS = {
+    "cli_args": get_cli_args,
+    "CUSS_WORDS": get_cuss_words,
+    "NICKNAME": lambda: get_secrets().nickname,
+    "TOKEN": lambda: get_secrets().token,
+    "CLIENT_ID": lambda: get_secrets().client_id,
+    "PROXY_PORT": lambda: get_secrets().proxy_port,
+    "PROXY_USERNAME": lambda: get_secrets().proxy_username,
+    "PROXY_PASSWORD": lambda: get_secrets().proxy_password,
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_SETTINGS:
+        return _LAZY_SETTINGS[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
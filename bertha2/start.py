@@ -12,21 +12,22 @@ Opens up multiple processes that run coresponding tasks.
 import json
 import os
 import signal
-from multiprocessing import Process, Queue, Event, Pipe
+import threading
+from multiprocessing import Queue, Event
 from pathlib import Path
 
-# Get all of the processes that will run async
-from bertha2.chat import chat_process
-from bertha2.converter import converter_process
-from bertha2.hardware import hardware_process
-from bertha2.visuals import visuals_process
-
 from bertha2.settings import DIRS, QUEUE_SAVE_FILENAME
-from bertha2.utils.logs import initialize_root_logger
+from bertha2.utils.journal import QueueJournal
+from bertha2.utils.queue_state import QueueStateService, forward_queue_events, get_item_id, EVENT_ENQUEUE, \
+    EVENT_COMPLETE, EVENT_REQUEUE
+from bertha2.utils.logs import initialize_module_logger, initialize_root_logger, create_log_listener
+from bertha2.utils.metrics import MetricsCollector, start_metrics_server
+from bertha2.utils.supervisor import Supervisor, SupervisedProcess
+from bertha2.utils.tracing import TraceLog
 
 os.environ['IMAGEIO_VAR_NAME'] = 'ffmpeg'
 
-logger = initialize_root_logger(__name__)
+logger = initialize_module_logger(__name__)
 
 
 def create_dirs(DIRS):
@@ -38,53 +39,81 @@ def create_dirs(DIRS):
     logger.info(f"Created directories")
 
 
-def save_queues(link_q: Queue, play_q: Queue):
-    logger.info(f"Saving queues to database.")
-
-    ll = []
-    pl = []
-    
-    while not link_q.empty():
-        ll.append(link_q.get())
-
-    while not play_q.empty():
-        pl.append(play_q.get())
-
-    # save q to json file
-    backup_file_contents = {
-        "play_q": pl,
-        "link_q": ll
-    }
-
-    logger.debug(backup_file_contents)
-
-    with open(QUEUE_SAVE_FILENAME, 'w', encoding='utf-8') as file:
-        json.dump(backup_file_contents, file, ensure_ascii=False, indent=4)
+def load_saved_queues():
+    # queues saved on shutdown, before there was a journal
+    try:
+        with open(QUEUE_SAVE_FILENAME) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as ee:
+        logger.critical(f"Saved queues could not be loaded. {ee}")
+        return {}
+
+
+def load_queues(journal: QueueJournal):
+    logger.info(f"Loading queues from the journal.")
+
+    if os.path.isfile(journal.filename):
+        state = journal.replay()
+    else:
+        state = journal.state
+        for queue_name, items in load_saved_queues().items():
+            for item in items:
+                state.apply({"event": EVENT_ENQUEUE, "queue": queue_name, "id": get_item_id(item), "item": item})
+
+    # a video that was converted right before a crash is on both queues, it only needs to be played
+    play_items = state.get_items("play_q")
+    play_ids = {get_item_id(item) for item in play_items}
+    link_items = []
+    for item in state.get_items("link_q"):
+        if get_item_id(item) in play_ids:
+            state.apply({"event": EVENT_COMPLETE, "queue": "link_q", "id": get_item_id(item)})
+        else:
+            link_items.append(item)
+
+    logger.debug({"link_q": link_items, "play_q": play_items})
+
+    queues = []
+    for items in [link_items, play_items]:
+        q = Queue()
+        for item in items:
+            q.put(item)
+        queues.append(q)
 
-    logger.info(f"Saved queues to database.")
+    logger.info(f"Loaded {len(link_items)} videos to convert and {len(play_items)} to play.")
+    return queues
 
 
-def load_queue(queue_name: str):
-    logger.info(f"Loading queue: {queue_name}")
+def create_requeue_function(queue_state_service: QueueStateService, queue_name, q: Queue):
+    # a process that's restarted loses the items it took from its queue, they're put back at the end of it
+    def requeue_in_progress_items():
+        items = queue_state_service.get_in_progress_items(queue_name)
+        for item in items:
+            # queued again, so another restart before the new process takes it doesn't put it back a second time
+            queue_state_service.publish({"event": EVENT_REQUEUE, "queue": queue_name, "id": get_item_id(item)})
+            q.put(item)
+        if items:
+            logger.info(f"Put {len(items)} unfinished items back on {queue_name}.")
 
-    q = Queue()
+    return requeue_in_progress_items
 
-    try:
-        with open(QUEUE_SAVE_FILENAME) as f:
-            contents = json.load(f)
 
-        logger.debug(contents[queue_name])
+def create_subscription_function(queue_state_service: QueueStateService):
+    # a restarted process gets a new subscription, which starts with a copy of the whole state
+    subscriptions = []
 
-        # save it into a queue
-        for item in contents[queue_name]:
-            q.put(item)
-    except Exception as ee:
-        logger.critical(f"Queue could not be loaded. {ee}")
+    def create_subscription():
+        if subscriptions:
+            queue_state_service.unsubscribe(subscriptions.pop())
+        subscriptions.append(queue_state_service.subscribe())
+        return subscriptions[-1]
 
-    return q
+    return create_subscription
 
 
 if __name__ == '__main__':
+    initialize_root_logger(__name__)
 
     logger.info(f"Initializing Bertha2...")
     create_dirs(DIRS)
@@ -93,45 +122,81 @@ if __name__ == '__main__':
     default_handler = signal.getsignal(signal.SIGINT)
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-    link_q = load_queue("link_q")  # Queue of YouTube links to convert
-    play_q = load_queue("play_q")  # Queue of ready-to-play videos
-
-    # Pipe: converter -> visuals connection
-    cv_parent_conn, cv_child_conn = Pipe()
-    # Pipe: hardware -> visuals connection. Used for the hardware process to tell the visuals process when its doing things
-    hv_child_conn, hv_parent_conn = Pipe()
-
-    sigint_e = Event()
-    
-    # Connect each process that can be. After, it is the process's responsibility to not crash
+    # link_q: Queue of YouTube links to convert
+    # play_q: Queue of ready-to-play videos
+    journal = QueueJournal()
+    link_q, play_q = load_queues(journal)
+    journal.open()
+
+    # every process sends what it does with the queues here. It's written to the journal as it happens, and
+    #   shared with the processes that subscribe to the queue state (visuals and the converter). How long each item
+    #   spent in each stage is written to the trace log.
+    queue_event_q = Queue()
+    queue_state_service = QueueStateService(journal.state.copy())
+    trace_log = TraceLog()
+    trace_log.open()
+    queue_event_thread = threading.Thread(target=forward_queue_events,
+                                          args=(queue_event_q, journal, queue_state_service, trace_log), daemon=True)
+    queue_event_thread.start()
+
+    # every process logs through log_q, and the records are written to the console here
+    log_q = Queue()
+    log_listener = create_log_listener(log_q)
+    log_listener.start()
+
+    # every process sends its metrics through metrics_q, they're added up and served here
+    metrics_q = Queue()
+    metrics_collector = MetricsCollector()
+    metrics_thread = threading.Thread(target=metrics_collector.receive, args=(metrics_q,), daemon=True)
+    metrics_thread.start()
+    start_metrics_server(metrics_collector)
+
+    # Each process is restarted if it crashes or stops responding. They're given the same queues when restarted.
+    #   The converter and the hardware are stopped through their own event, so they can finish what they're doing.
     # TODO: Write a fuction for each to see if it can be booted up
     #   e.g. Is b2 connected, can we connect to obs?
-    # TODO: why does visuals have the parent and child conns, when it is only receiving data?
-    chat_p = Process(target=chat_process, args=(link_q,))
-    converter_p = Process(target=converter_process, args=(sigint_e, cv_child_conn, link_q, play_q,))
-    hardware_p = Process(target=hardware_process, args=(sigint_e, hv_parent_conn, play_q,))
-    visuals_p = Process(target=visuals_process, args=(cv_parent_conn, hv_child_conn,))
-
-    processes = [chat_p, converter_p, hardware_p, visuals_p]
-
-    # Start all of the processes
-    for process in processes:
-        process.daemon = True
-        process.start()
+    chat_p = SupervisedProcess("chat", "bertha2.chat:chat_process", lambda: (link_q, queue_event_q,),
+                               log_q=log_q, metrics_q=metrics_q)
+    # the converter starts its own worker processes, which daemon processes aren't allowed to do.
+    #   It still shuts down with the others when the supervisor stops them.
+    create_converter_subscription = create_subscription_function(queue_state_service)
+    converter_stop_e = Event()
+    converter_p = SupervisedProcess("converter", "bertha2.converter:converter_process",
+                                    lambda: (converter_stop_e, link_q, play_q, queue_event_q,
+                                             create_converter_subscription(),),
+                                    on_restart=create_requeue_function(queue_state_service, "link_q", link_q),
+                                    daemon=False, log_q=log_q, metrics_q=metrics_q, stop_event=converter_stop_e)
+    hardware_stop_e = Event()
+    hardware_p = SupervisedProcess("hardware", "bertha2.hardware:hardware_process",
+                                   lambda: (hardware_stop_e, play_q, queue_event_q,),
+                                   on_restart=create_requeue_function(queue_state_service, "play_q", play_q),
+                                   log_q=log_q, metrics_q=metrics_q, stop_event=hardware_stop_e)
+    create_visuals_subscription = create_subscription_function(queue_state_service)
+    visuals_p = SupervisedProcess("visuals", "bertha2.visuals:visuals_process",
+                                  lambda: (create_visuals_subscription(),),
+                                  log_q=log_q, metrics_q=metrics_q)
+
+    supervisor = Supervisor([chat_p, converter_p, hardware_p, visuals_p])
+    supervisor.start()
 
     # Since we spawned all the necessary processes already,
     #   restore default signal handling for the parent process.
     signal.signal(signal.SIGINT, default_handler)
 
     try:
-        signal.pause()
+        supervisor.run()
     except KeyboardInterrupt:
         logger.info(f"Shutting down gracefully...")
-        sigint_e.set()
-        converter_p.join()
-        hardware_p.join()
+        supervisor.stop()
     except Exception as e:
         logger.critical(f"Error has occurred. {e}")
+        supervisor.stop()
     finally:
-        save_queues(link_q, play_q)
+        supervisor.log_report()
+        queue_event_q.put(None)
+        queue_event_thread.join()
+        metrics_q.put(None)
+        journal.close()
+        trace_log.close()
         logger.info(f"Shut down.")
+        log_listener.stop()
@@ -0,0 +1,89 @@
+# this program replays IRC traffic into the chat reader over a local socket, in randomly sized chunks
+# it checks that every line arrives exactly once and reports how many messages per second are read
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_chat_replay
+# set BENCH_IRC_LOG to replay a recorded log (one raw IRC line per line), otherwise raid-like traffic is generated.
+# set BENCH_MESSAGES to change the number of generated messages
+
+import asyncio
+import os
+import random
+import time
+
+from bertha2.chat import read_chat
+from bertha2.tests.test_chat import generate_privmsg
+
+DEFAULT_NUMBER_OF_MESSAGES = 200000
+PING = "PING :tmi.twitch.tv"
+
+
+def load_traffic():
+    log_filename = os.getenv("BENCH_IRC_LOG")
+    if log_filename:
+        with open(log_filename, encoding="utf-8") as f:
+            return [line.rstrip("\r\n") for line in f if line.strip()]
+
+    random.seed(8)
+    lines = []
+    for index in range(int(os.getenv("BENCH_MESSAGES", DEFAULT_NUMBER_OF_MESSAGES))):
+        if index % 10000 == 0:
+            lines.append(PING)
+        lines.append(generate_privmsg(index))
+    return lines
+
+
+async def replay(lines):
+    data = "".join(f"{line}\r\n" for line in lines).encode("utf-8")
+    pongs = bytearray()
+    replay_finished = asyncio.Event()
+
+    async def send_traffic(reader, writer):
+        # chunks of any size, so lines (and characters) are split across reads
+        index = 0
+        while index < len(data):
+            chunk_size = random.randint(1, 8192)
+            writer.write(data[index:index + chunk_size])
+            index += chunk_size
+            await writer.drain()
+        # closing with unread PONGs would reset the connection, so they're read until the client hangs up
+        writer.write_eof()
+        while chunk := await reader.read(65536):
+            pongs.extend(chunk)
+        writer.close()
+        replay_finished.set()
+
+    server = await asyncio.start_server(send_traffic, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    received = []
+
+    async def handle_messages(messages):
+        received.extend(messages)
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    start_time = time.perf_counter()
+    try:
+        await read_chat(reader, writer, handle_messages)
+    except ConnectionError:
+        pass  # the replay is over
+    elapsed = time.perf_counter() - start_time
+
+    writer.close()
+    await replay_finished.wait()
+    server.close()
+    await server.wait_closed()
+    return received, pongs.decode("utf-8").count("PONG"), elapsed
+
+
+if __name__ == "__main__":
+    lines = load_traffic()
+    expected = [line for line in lines if not line.startswith("PING")]
+
+    received, number_of_pongs, elapsed = asyncio.run(replay(lines))
+
+    lost = len(expected) - len(received)
+    print(f"replayed {len(lines)} lines: {len(received)} messages received in {elapsed:.2f} s "
+          f"({len(received) / elapsed:,.0f} messages/s)")
+    print(f"lost: {lost}   corrupted: {sum(a != b for a, b in zip(expected, received))}   "
+          f"PINGs answered: {number_of_pongs}/{len(lines) - len(expected)}")
@@ -0,0 +1,57 @@
+# this program measures how long it takes to filter the titles of a long queue for one "Next Up" refresh
+# it compares replacing every word of the list one at a time, like visuals used to, with the compiled pattern
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_cuss_filter
+# set BENCH_WORDS and BENCH_QUEUE_LENGTH to change the size of the word list and of the queue
+
+import os
+import random
+import string
+import time
+
+import bertha2.visuals as visuals
+from bertha2.visuals import compile_cuss_word_pattern, filter_cuss_words_from_title, process_title
+
+DEFAULT_WORDS = 10000
+DEFAULT_QUEUE_LENGTH = 500
+
+
+def random_word(min_length=3, max_length=10):
+    return "".join(random.choices(string.ascii_lowercase, k=random.randint(min_length, max_length)))
+
+
+def replace_every_word(title, words):
+    for word in words:
+        title = title.replace(word, "****")
+    return title
+
+
+def measure(function, titles):
+    start_time = time.perf_counter()
+    filtered_titles = [function(title) for title in titles]
+    return time.perf_counter() - start_time, filtered_titles
+
+
+if __name__ == "__main__":
+    random.seed(13)
+    words = [random_word() for _ in range(int(os.getenv("BENCH_WORDS", DEFAULT_WORDS)))]
+    titles = [" ".join(random.choice(words) if random.random() < 0.1 else random_word() for _ in range(8))
+              for _ in range(int(os.getenv("BENCH_QUEUE_LENGTH", DEFAULT_QUEUE_LENGTH)))]
+    print(f"{len(words)} words, {len(titles)} queued titles")
+
+    start_time = time.perf_counter()
+    pattern = compile_cuss_word_pattern(words)
+    print(f"compiling the pattern:     {(time.perf_counter() - start_time) * 1000:8.2f} ms (once, at startup)")
+
+    elapsed, _ = measure(lambda title: replace_every_word(title, words), titles)
+    print(f"replacing every word:      {elapsed * 1000:8.2f} ms per refresh")
+
+    elapsed, _ = measure(lambda title: filter_cuss_words_from_title(title, pattern), titles)
+    print(f"compiled pattern:          {elapsed * 1000:8.2f} ms per refresh")
+
+    visuals.cuss_word_pattern = pattern
+    process_title.cache_clear()
+    measure(process_title, titles)
+    elapsed, _ = measure(process_title, titles)
+    print(f"compiled pattern, cached:  {elapsed * 1000:8.2f} ms per refresh after the first")
@@ -0,0 +1,60 @@
+# this program measures what pushing to and popping from the fair queue costs with a lot of requests waiting
+# BENCH_PENDING requests from BENCH_VIEWERS viewers are queued (a few viewers ask for most of them), then each pop is
+# followed by a push, so the queue stays that long. It also shows how the first hour of songs is shared out.
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_fair_queue
+# set BENCH_MAX_OP_US to exit with an error if a push and a pop take longer than that on average
+
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+from bertha2.utils.fair_queue import FairQueue
+
+DEFAULT_PENDING = 10000
+DEFAULT_VIEWERS = 500
+DEFAULT_OPERATIONS = 100000
+
+
+def create_request(index, number_of_viewers):
+    # the first viewer makes half of all the requests
+    viewer = 0 if random.random() < 0.5 else random.randrange(number_of_viewers)
+    return {"id": str(index), "username": f"viewer{viewer}", "length": random.randint(60, 360),
+            "priority": random.choice([1, 2, 2, 2])}
+
+
+if __name__ == "__main__":
+    random.seed(8)
+    pending = int(os.getenv("BENCH_PENDING", DEFAULT_PENDING))
+    number_of_viewers = int(os.getenv("BENCH_VIEWERS", DEFAULT_VIEWERS))
+    operations = int(os.getenv("BENCH_OPERATIONS", DEFAULT_OPERATIONS))
+
+    fair_queue = FairQueue()
+    for index in range(pending):
+        fair_queue.push(create_request(index, number_of_viewers))
+
+    songs_s = 0
+    first_hour = Counter()
+    while songs_s < 60 * 60:
+        request = fair_queue.pop()
+        first_hour[request["username"]] += 1
+        songs_s += request["length"]
+        fair_queue.push(create_request(pending + len(first_hour), number_of_viewers))
+    print(f"first hour: {sum(first_hour.values())} songs from {len(first_hour)} viewers, "
+          f"at most {max(first_hour.values())} from one viewer (viewer0 asked for half of the queue)")
+
+    requests = [create_request(pending + index, number_of_viewers) for index in range(operations)]
+    start_time = time.perf_counter()
+    for request in requests:
+        fair_queue.pop()
+        fair_queue.push(request)
+    op_us = (time.perf_counter() - start_time) / operations * 1e6
+    print(f"{len(fair_queue)} pending: {op_us:.2f} us for a pop and a push")
+
+    max_op_us = os.getenv("BENCH_MAX_OP_US")
+    if max_op_us is not None and op_us > float(max_op_us):
+        print(f"slower than {max_op_us} us")
+        sys.exit(1)
@@ -0,0 +1,81 @@
+# this program measures how long each process takes to import its module, which is paid again every time the
+# supervisor restarts it. Every module is imported in a fresh interpreter with `python -X importtime`, which reports
+# the cumulative time of each import, so the slowest dependencies of each process are listed as well.
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_importtime
+# set BENCH_RUNS to change how many times each module is imported (the fastest run is reported), and BENCH_TOP to
+# change how many of the slowest dependencies are listed
+# set BENCH_BUDGET_MS to exit with an error if any module takes longer than it to import, or BENCH_BUDGET_<MODULE>_MS
+# (e.g. BENCH_BUDGET_HARDWARE_MS) to give one module its own budget
+
+import os
+import subprocess
+import sys
+
+MODULES = {
+    "settings": "bertha2.settings",
+    "start": "bertha2.start",
+    "chat": "bertha2.chat",
+    "converter": "bertha2.converter",
+    "hardware": "bertha2.hardware",
+    "visuals": "bertha2.visuals",
+}
+DEFAULT_RUNS = 5
+DEFAULT_TOP = 5
+
+
+def import_module(module_name):
+    """
+    :return: Dict of each imported module to its cumulative import time in ms
+    """
+    statement = f"import {module_name}" if module_name else "pass"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                            capture_output=True, text=True, check=True)
+
+    import_times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        import_times[name.strip()] = int(cumulative_us) / 1000
+    return import_times
+
+
+def run(name, module_name, runs, top, startup_modules):
+    fastest = min((import_module(module_name) for _ in range(runs)), key=lambda import_times: import_times[module_name])
+    total_ms = fastest[module_name]
+
+    # only the top level imports, their dependencies are already counted in them. What the interpreter imports on
+    #   startup (e.g. site) isn't part of the module.
+    top_level = [(import_ms, imported) for imported, import_ms in fastest.items()
+                 if imported != module_name and "." not in imported and not imported.startswith("_")
+                 and imported not in startup_modules]
+    slowest = sorted(top_level, reverse=True)[:top]
+
+    print(f"{name:10s} {total_ms:8.1f} ms   " + "   ".join(f"{imported} {import_ms:.1f}" for import_ms, imported in slowest))
+    return total_ms
+
+
+def get_budget_ms(name):
+    budget_ms = os.getenv(f"BENCH_BUDGET_{name.upper()}_MS", os.getenv("BENCH_BUDGET_MS"))
+    return float(budget_ms) if budget_ms is not None else None
+
+
+if __name__ == "__main__":
+    runs = int(os.getenv("BENCH_RUNS", DEFAULT_RUNS))
+    top = int(os.getenv("BENCH_TOP", DEFAULT_TOP))
+
+    startup_modules = set(import_module(None))
+
+    over_budget = []
+    for name, module_name in MODULES.items():
+        total_ms = run(name, module_name, runs, top, startup_modules)
+        budget_ms = get_budget_ms(name)
+        if budget_ms is not None and total_ms > budget_ms:
+            over_budget.append(f"{name} ({total_ms:.1f} ms, budget {budget_ms:.1f} ms)")
+
+    if over_budget:
+        print(f"Over the import time budget: {', '.join(over_budget)}")
+        sys.exit(1)
@@ -0,0 +1,71 @@
+# this program measures what the queue journal costs per event
+# producers (like chat, converter and hardware) each enqueue, dequeue and complete items, and wait until every
+# event is on disk before the next one, which is the worst case. Events that are waiting share one fsync.
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_journal
+# set BENCH_EVENTS to change the number of events for each producer, and BENCH_PRODUCERS the number of producers
+# set BENCH_JOURNAL_DIR to measure on another disk than the temporary directory
+
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from bertha2.utils.journal import QueueJournal
+from bertha2.utils.queue_state import EVENT_ENQUEUE, EVENT_DEQUEUE, EVENT_COMPLETE
+
+DEFAULT_EVENTS = 3000
+DEFAULT_PRODUCERS = 3
+
+
+def produce(journal, producer_index, number_of_events, latencies, wait_until_written):
+    events = [EVENT_ENQUEUE, EVENT_DEQUEUE, EVENT_COMPLETE]
+    for i in range(number_of_events):
+        item_id = f"{producer_index}-{i // 3}"
+        event = {"event": events[i % 3], "queue": "link_q", "id": item_id}
+        if event["event"] == EVENT_ENQUEUE:
+            event["item"] = {"id": item_id, "link": f"https://www.youtube.com/watch?v={i:011d}", "title": "video"}
+
+        start_time = time.perf_counter()
+        journal.append(event)
+        if wait_until_written:
+            journal.flush()
+        latencies.append(time.perf_counter() - start_time)
+
+
+def run(directory, number_of_producers, number_of_events, wait_until_written):
+    journal = QueueJournal(os.path.join(directory, f"journal_{wait_until_written}.jsonl"))
+    journal.replay()
+    journal.open()
+
+    latencies = []
+    threads = [threading.Thread(target=produce, args=(journal, i, number_of_events, latencies, wait_until_written))
+               for i in range(number_of_producers)]
+
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    journal.flush()
+    elapsed = time.perf_counter() - start_time
+    journal.close()
+
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    print(f"{'waiting for fsync' if wait_until_written else 'append only':<18} "
+          f"{len(latencies) / elapsed:9,.0f} events/s   mean: {statistics.mean(latencies_ms):.3f} ms   "
+          f"p99: {latencies_ms[int(len(latencies_ms) * 0.99)]:.3f} ms   "
+          f"events per fsync: {journal.stats['events'] / journal.stats['fsyncs']:.1f}   "
+          f"compactions: {journal.stats['compactions']}")
+
+
+if __name__ == "__main__":
+    number_of_producers = int(os.getenv("BENCH_PRODUCERS", DEFAULT_PRODUCERS))
+    number_of_events = int(os.getenv("BENCH_EVENTS", DEFAULT_EVENTS))
+    print(f"{number_of_producers} producers, {number_of_events} events each")
+
+    with tempfile.TemporaryDirectory(dir=os.getenv("BENCH_JOURNAL_DIR")) as directory:
+        run(directory, number_of_producers, number_of_events, wait_until_written=False)
+        run(directory, number_of_producers, number_of_events, wait_until_written=True)
@@ -0,0 +1,79 @@
+# this program measures how long the hardware takes to send a frame to the solenoids with debug logging on, which
+# logs every frame. Writing straight to a slow terminal, like the hardware used to, is compared with sending the
+# records to a log listener through a queue, like every process started by start.py now does.
+# The slow terminal is a stream that takes BENCH_WRITE_MS to write each line.
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_logging
+# set BENCH_FRAMES to change how many frames are sent, and BENCH_WRITE_MS to change how slow the terminal is
+
+import io
+import logging
+import os
+import time
+from multiprocessing import Queue
+
+from bertha2 import hardware
+from bertha2.utils.logs import initialize_process_logging, create_log_listener
+from bertha2.utils.serial_link import VirtualPiano
+
+DEFAULT_FRAMES = 2000
+DEFAULT_WRITE_MS = 0.2
+
+
+class SlowStream(io.StringIO):
+    def __init__(self, write_s):
+        super().__init__()
+        self.write_s = write_s
+
+    def write(self, text):
+        time.sleep(self.write_s)
+        return super().write(text)
+
+
+def send_frames(frames):
+    hardware.arduino_connection = VirtualPiano(hardware.number_of_notes, baudrate=float("inf"))
+    hardware.reset_solenoid_state()
+
+    durations = []
+    for frame in range(frames):
+        hardware.update_solenoid_value(frame % hardware.number_of_notes, 100 + frame % 50)
+        start_time = time.perf_counter()
+        hardware.flush_solenoid_updates()
+        durations.append(time.perf_counter() - start_time)
+
+    hardware.arduino_connection = None
+    durations.sort()
+    return durations
+
+
+def report(name, durations):
+    print(f"{name:32s} p50: {durations[len(durations) // 2] * 1e6:8.1f} us   "
+          f"p99: {durations[int(len(durations) * 0.99)] * 1e6:8.1f} us   max: {durations[-1] * 1e6:8.1f} us")
+
+
+def set_root_handlers(*handlers):
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+    for handler in handlers:
+        root_logger.addHandler(handler)
+
+
+if __name__ == "__main__":
+    frames = int(os.getenv("BENCH_FRAMES", DEFAULT_FRAMES))
+    write_s = float(os.getenv("BENCH_WRITE_MS", DEFAULT_WRITE_MS)) / 1000
+
+    hardware.logger.setLevel(logging.INFO)
+    report("debug logging off", send_frames(frames))
+
+    hardware.logger.setLevel(logging.DEBUG)
+    set_root_handlers(logging.StreamHandler(SlowStream(write_s)))
+    report("straight to the terminal", send_frames(frames))
+
+    # the listener writes to the same slow terminal, from a thread of its own
+    log_listener = create_log_listener(Queue())
+    initialize_process_logging(log_listener.queue)
+    log_listener.start()
+    report("through the log listener", send_frames(frames))
+    log_listener.stop()
@@ -0,0 +1,77 @@
+# this program measures what recording metrics costs the playback loop, which observes the lateness of every wakeup
+# and counts every frame sent to the solenoids
+# a song is played in real time to a virtual piano with the playback error histogram and without it, and the cost of
+# a single observation is measured on its own, to estimate the share of the loop's CPU time that goes to metrics
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_metrics
+# set BENCH_SECONDS to change how much of the song is played, and BENCH_MIDI_FILE to play another file
+# set BENCH_MAX_OVERHEAD_PERCENT to exit with an error if metrics take more than that share of the loop's CPU time
+
+import asyncio
+import logging
+import os
+import sys
+import time
+import timeit
+
+from bertha2 import hardware
+from bertha2.tests.benchmarks.bench_playback import read_plan
+from bertha2.utils.metrics import Counter, Histogram
+from bertha2.utils.scheduler import play_timeline
+from bertha2.utils.serial_link import VirtualPiano
+
+DEFAULT_MIDI_FILE = "files/midi/tests/dr_dre.mid"
+DEFAULT_SECONDS = 10
+CALLS = 1000000
+
+
+def measure_call_ns(function):
+    return min(timeit.repeat(function, number=CALLS, repeat=5)) / CALLS * 1e9
+
+
+def play(plan, error_histogram):
+    hardware.arduino_connection = VirtualPiano(hardware.number_of_notes, clock=time.monotonic)
+    hardware.reset_solenoid_state()
+
+    start_cpu = time.process_time()
+    stats = asyncio.run(play_timeline(*plan, hardware.update_solenoid_value,
+                                      flush_function=hardware.flush_solenoid_updates, error_histogram=error_histogram))
+    cpu = time.process_time() - start_cpu
+
+    hardware.arduino_connection = None
+    return stats, cpu
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+
+    seconds = float(os.getenv("BENCH_SECONDS", DEFAULT_SECONDS))
+    midi_filename = os.getenv("BENCH_MIDI_FILE", DEFAULT_MIDI_FILE)
+    max_overhead_percent = os.getenv("BENCH_MAX_OVERHEAD_PERCENT")
+
+    histogram = Histogram("playback_error_seconds", "", (), buckets=hardware.playback_errors.buckets)
+    counter = Counter("frames_total", "", ())
+    observe_ns = measure_call_ns(lambda: histogram.observe(0.0004))
+    inc_ns = measure_call_ns(counter.inc)
+    print(f"histogram observe: {observe_ns:6.1f} ns   counter inc: {inc_ns:6.1f} ns")
+
+    plan = read_plan(midi_filename, seconds)
+    frames_before = hardware.frames_sent.value
+    stats, cpu_with_metrics = play(plan, Histogram("playback_error_seconds", "", (),
+                                                   buckets=hardware.playback_errors.buckets))
+    frames = hardware.frames_sent.value - frames_before
+    _, cpu_without_histogram = play(plan, None)
+
+    duration = stats["duration_s"]
+    metrics_cpu = stats["wakeups"] * observe_ns / 1e9 + frames * inc_ns / 1e9
+    overhead_percent = 100 * metrics_cpu / cpu_with_metrics
+    print(f"{midi_filename}: {stats['wakeups']} wakeups and {frames:.0f} frames in {duration:.1f} s")
+    print(f"  cpu per playback second with the error histogram: {cpu_with_metrics / duration * 1000:6.2f} ms   "
+          f"without: {cpu_without_histogram / duration * 1000:6.2f} ms")
+    print(f"  metrics per playback second: {metrics_cpu / duration * 1e6:6.1f} us, "
+          f"{overhead_percent:.3f}% of the loop's cpu time")
+
+    if max_overhead_percent is not None and overhead_percent > float(max_overhead_percent):
+        print(f"Metrics take more than {max_overhead_percent}% of the playback loop's cpu time")
+        sys.exit(1)
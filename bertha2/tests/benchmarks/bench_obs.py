@@ -0,0 +1,73 @@
+# this program measures how long one visuals refresh (next up, status text and video) takes to reach OBS
+# it compares connecting for every source update, like visuals used to, with one open connection sending a RequestBatch
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_obs
+# a fake obs-websocket server is used. set BENCH_OBS_LATENCY_MS to make it answer slower, like a busy OBS,
+# and BENCH_REFRESHES to change the number of refreshes
+
+import asyncio
+import os
+import statistics
+import time
+
+import simpleobsws
+
+from bertha2.tests.fake_obs_websocket import FakeObsWebsocketServer
+from bertha2.utils.obs import ObsClient, create_obs_websocket_client, create_text_source_request, \
+    create_video_source_request
+
+DEFAULT_REFRESHES = 200
+
+
+def create_refresh_requests(index):
+    return [
+        create_text_source_request("queue", f"Next Up:\n1. video {index + 1}"),
+        create_text_source_request("current_song", f"Current Video: video {index}"),
+        create_video_source_request("playing_video", f"temp/video/{index}.mp4"),
+    ]
+
+
+async def connect_for_every_update(url, requests):
+    for request in requests:
+        ws_client = create_obs_websocket_client(url)
+        await ws_client.connect()
+        await ws_client.wait_until_identified()
+        await ws_client.call(request)
+        await ws_client.disconnect()
+
+
+def measure(refresh_function, refreshes):
+    latencies = []
+    for index in range(refreshes):
+        start_time = time.perf_counter()
+        refresh_function(create_refresh_requests(index))
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def print_latencies(name, latencies, server):
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    print(f"{name:<24} mean: {statistics.mean(latencies_ms):7.2f} ms   "
+          f"p95: {latencies_ms[int(len(latencies_ms) * 0.95)]:7.2f} ms   "
+          f"connections: {server.connections}   messages: {server.messages}")
+
+
+if __name__ == "__main__":
+    refreshes = int(os.getenv("BENCH_REFRESHES", DEFAULT_REFRESHES))
+    latency_s = float(os.getenv("BENCH_OBS_LATENCY_MS", 0)) / 1000
+    print(f"{refreshes} visuals refreshes of 3 sources, OBS answering in {latency_s * 1000:.1f} ms")
+
+    with FakeObsWebsocketServer(latency_s=latency_s) as server:
+        loop = asyncio.new_event_loop()
+        latencies = measure(lambda requests: loop.run_until_complete(connect_for_every_update(server.url, requests)),
+                            refreshes)
+        loop.close()
+        print_latencies("connect for every update", latencies, server)
+
+    with FakeObsWebsocketServer(latency_s=latency_s) as server:
+        obs_client = ObsClient(url=server.url)
+        obs_client.call_batch([simpleobsws.Request("GetInputSettings", {"inputName": "queue"})])  # connects
+        latencies = measure(obs_client.call_batch, refreshes)
+        obs_client.close()
+        print_latencies("persistent, batched", latencies, server)
@@ -0,0 +1,150 @@
+# this program plays every test song to a virtual piano and measures how accurately the playback engine keeps time
+# the same song is also played instantly with a virtual clock, which gives the onset every note should have had.
+# Onset jitter is when a solenoid turned on compared to that, including the time the frame takes over the serial link.
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_playback
+# set BENCH_SECONDS to change how much of each song is played (0 plays all of it), BENCH_MIDI_FILES to play other
+# files (a glob), and BENCH_LATE_MS to change when an onset counts as late
+# set BENCH_MAX_P99_MS to exit with an error if the p99 jitter of any song is above it, or if an onset is missed
+
+import asyncio
+import glob
+import logging
+import math
+import os
+import sys
+import time
+
+from bertha2 import hardware
+from bertha2.utils.scheduler import play_timeline
+from bertha2.utils.serial_link import VirtualPiano
+
+DEFAULT_MIDI_FILES = "files/midi/tests/*.mid"
+DEFAULT_SECONDS_PER_SONG = 10
+DEFAULT_LATE_MS = 10
+
+
+def read_plan(midi_filename, seconds):
+    times, note_addresses, pwm_values = hardware.compile_playback_plan(midi_filename)
+    if seconds:
+        number_of_events = len([time for time in times if time < seconds])
+        times, note_addresses, pwm_values = \
+            times[:number_of_events], note_addresses[:number_of_events], pwm_values[:number_of_events]
+    return times, note_addresses, pwm_values
+
+
+def play_instantly(times, note_addresses, pwm_values):
+    # the virtual clock is set to each deadline, so every frame is written exactly on time
+    now = [0.0]
+    piano = VirtualPiano(hardware.number_of_notes, baudrate=math.inf, clock=lambda: now[0])
+    hardware.arduino_connection = piano
+    hardware.reset_solenoid_state()
+
+    for deadline, note_address, pwm_value in zip(times, note_addresses, pwm_values):
+        if deadline != now[0]:
+            hardware.flush_solenoid_updates()
+            now[0] = deadline
+        hardware.update_solenoid_value(note_address, pwm_value)
+    hardware.flush_solenoid_updates()
+
+    return piano
+
+
+def play_in_real_time(times, note_addresses, pwm_values):
+    # asyncio times playback with time.monotonic, so the piano does as well
+    piano = VirtualPiano(hardware.number_of_notes, clock=time.monotonic)
+    hardware.arduino_connection = piano
+    hardware.reset_solenoid_state()
+
+    async def play():
+        start_time = time.monotonic()
+        stats = await play_timeline(times, note_addresses, pwm_values, hardware.update_solenoid_value,
+                                    flush_function=hardware.flush_solenoid_updates)
+        return start_time, stats
+
+    start_cpu = time.process_time()
+    start_time, stats = asyncio.run(play())
+    cpu = time.process_time() - start_cpu
+
+    return piano, start_time, stats, cpu
+
+
+def match_onsets(expected_onsets, actual_onsets, start_time):
+    """
+    :return: List of onset errors in seconds, and the number of expected onsets that never happened
+    """
+    actual_by_note = {}
+    for onset_time, note_address in actual_onsets:
+        actual_by_note.setdefault(note_address, []).append(onset_time - start_time)
+
+    errors = []
+    missed = 0
+    next_index = {}
+    for expected_time, note_address in expected_onsets:
+        actual_times = actual_by_note.get(note_address, [])
+        index = next_index.get(note_address, 0)
+        # an onset before the expected one belongs to an earlier note, which was matched or missed already
+        while index < len(actual_times) and actual_times[index] < expected_time - 0.001:
+            index += 1
+        if index < len(actual_times):
+            errors.append(actual_times[index] - expected_time)
+            index += 1
+        else:
+            missed += 1
+        next_index[note_address] = index
+
+    return errors, missed
+
+
+def get_percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile))]
+
+
+def run(midi_filename, seconds, late_s):
+    plan = read_plan(midi_filename, seconds)
+    if not plan[0]:
+        print(f"{midi_filename}: nothing to play")
+        return None
+
+    expected = play_instantly(*plan)
+    piano, start_time, stats, cpu = play_in_real_time(*plan)
+    hardware.arduino_connection = None
+
+    errors, missed = match_onsets(expected.get_note_onsets(), piano.get_note_onsets(), start_time)
+    errors.sort()
+    late = len([error for error in errors if error > late_s])
+    serial_stats = piano.get_stats()
+    duration = stats["duration_s"]
+
+    print(f"{midi_filename}: {len(errors) + missed} onsets in {duration:.1f} s")
+    print(f"  onset jitter p50: {get_percentile(errors, 0.5) * 1000:6.2f} ms   "
+          f"p99: {get_percentile(errors, 0.99) * 1000:6.2f} ms   max: {max(errors, default=0) * 1000:6.2f} ms   "
+          f"missed: {missed}   late: {late}   lost frames: {piano.lost_frames}")
+    print(f"  serial bytes/s: {serial_stats['bytes_per_second']:8.1f}   frames: {piano.frames}   "
+          f"wakeups: {stats['wakeups']}   cpu per playback second: {cpu / duration * 1000:6.2f} ms")
+
+    return {"p99_s": get_percentile(errors, 0.99), "missed": missed}
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+
+    seconds = float(os.getenv("BENCH_SECONDS", DEFAULT_SECONDS_PER_SONG))
+    late_s = float(os.getenv("BENCH_LATE_MS", DEFAULT_LATE_MS)) / 1000
+    max_p99_ms = os.getenv("BENCH_MAX_P99_MS")
+
+    results = []
+    for midi_filename in sorted(glob.glob(os.getenv("BENCH_MIDI_FILES", DEFAULT_MIDI_FILES))):
+        result = run(midi_filename, seconds, late_s)
+        if result is not None:
+            results.append(result)
+
+    if max_p99_ms is not None:
+        failed = [result for result in results
+                  if result["p99_s"] * 1000 > float(max_p99_ms) or result["missed"]]
+        if failed:
+            print(f"{len(failed)} songs missed onsets or had a p99 jitter above {max_p99_ms} ms")
+            sys.exit(1)
@@ -0,0 +1,94 @@
+# this program compares the per-note task playback with the single-timeline scheduler
+# no hardware is needed, solenoid updates are recorded instead of being sent
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_scheduler
+# set BENCH_SECONDS to change how much of each song is played (bertha2.settings owns the command line arguments)
+
+import asyncio
+import logging
+import os
+import time
+
+from bertha2 import hardware
+from bertha2.settings import SOLENOID_PEAK_TIME_S
+from bertha2.utils.scheduler import build_event_queue, resolve_event_queue, play_timeline
+
+MIDI_FILES = ["files/midi/tests/take5.mid", "files/midi/tests/dr_dre.mid"]
+DEFAULT_SECONDS_PER_SONG = 20
+
+
+def read_song_start(midi_filename, seconds):
+    return [note for note in hardware.read_midi_notes(midi_filename) if note[1] < seconds]
+
+
+def measure_onset_error(notes, updates, start_time):
+    # match each expected note onset with the first update that turns that solenoid on at or after it
+    onsets = {}
+    last_values = {}
+    for timestamp, note_address, pwm_value in updates:
+        if pwm_value > 0 and last_values.get(note_address, 0) == 0:
+            onsets.setdefault(note_address, []).append(timestamp - start_time)
+        last_values[note_address] = pwm_value
+
+    errors = []
+    for note_address, expected_start, _, _ in sorted(notes, key=lambda n: n[1]):
+        actual_onsets = onsets.get(note_address, [])
+        while actual_onsets and actual_onsets[0] < expected_start - 0.001:
+            actual_onsets.pop(0)
+        if actual_onsets:
+            errors.append(actual_onsets.pop(0) - expected_start)
+
+    return errors
+
+
+async def play_with_tasks(notes, record):
+    # every trigger_note task wakes up once per solenoid update
+    hardware.update_solenoid_value = record
+    await asyncio.gather(*[hardware.trigger_note(*note) for note in notes])
+    return None
+
+
+async def play_with_scheduler(notes, record):
+    events = build_event_queue(notes, hardware.power_draw_function, SOLENOID_PEAK_TIME_S)
+    stats = await play_timeline(*resolve_event_queue(events), record)
+    return stats["wakeups"]
+
+
+def run(name, player, notes):
+    updates = []
+
+    def record(note_address, pwm_value):
+        updates.append((time.perf_counter(), note_address, pwm_value))
+
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    wakeups = asyncio.run(player(notes, record))
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+
+    errors = measure_onset_error(notes, updates, start_wall)
+    errors.sort()
+    p50 = errors[len(errors) // 2] * 1000 if errors else 0
+    p99 = errors[int(len(errors) * 0.99)] * 1000 if errors else 0
+
+    if wakeups is None:
+        wakeups = len(updates)
+
+    print(f"  {name:<10} wakeups/s: {wakeups / wall:9.1f}   updates/s: {len(updates) / wall:9.1f}   "
+          f"cpu: {100 * cpu / wall:5.1f}%   onset error p50: {p50:6.2f} ms   p99: {p99:6.2f} ms   max: {max(errors, default=0) * 1000:6.2f} ms")
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+
+    seconds = float(os.getenv("BENCH_SECONDS", DEFAULT_SECONDS_PER_SONG))
+    update_solenoid_value = hardware.update_solenoid_value
+
+    for midi_filename in MIDI_FILES:
+        notes = read_song_start(midi_filename, seconds)
+        print(f"{midi_filename}: {len(notes)} notes in the first {seconds:g} s")
+
+        run("tasks", play_with_tasks, notes)
+        hardware.update_solenoid_value = update_solenoid_value
+        run("scheduler", play_with_scheduler, notes)
@@ -0,0 +1,74 @@
+# this program compares the serial traffic of one 3-byte write per solenoid per tick with delta-only update frames
+# writes go to a simulated 115200 baud serial port, which measures bytes per second and latency
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_serial
+# set BENCH_SECONDS to change how much of each song is played (bertha2.settings owns the command line arguments)
+
+import asyncio
+import logging
+import os
+import struct
+
+from bertha2 import hardware
+from bertha2.utils.serial_link import SimulatedSerial
+
+MIDI_FILES = ["files/midi/tests/take5.mid", "files/midi/tests/dr_dre.mid"]
+DEFAULT_SECONDS_PER_SONG = 10
+
+
+def play_with_single_writes(notes, serial_port):
+    # the previous protocol: every task writes its solenoid value on every 10 ms tick
+    def update_solenoid_value(note_address, pwm_value):
+        if note_address < 0:
+            note_address += 24
+        if note_address > hardware.number_of_notes - 1:
+            note_address -= 24
+        if 0 <= note_address < hardware.number_of_notes:
+            serial_port.write(struct.pack('>3B', note_address + 1, int(min(pwm_value, 253)) + 1, 255))
+
+    async def play():
+        await asyncio.gather(*[hardware.trigger_note(*note) for note in notes])
+
+    update, flush = hardware.update_solenoid_value, hardware.flush_solenoid_updates
+    hardware.update_solenoid_value, hardware.flush_solenoid_updates = update_solenoid_value, lambda: None
+    try:
+        asyncio.run(play())
+    finally:
+        hardware.update_solenoid_value, hardware.flush_solenoid_updates = update, flush
+
+
+def play_with_update_frames(midi_filename, seconds, serial_port):
+    times, note_addresses, pwm_values = hardware.compile_playback_plan(midi_filename)
+    number_of_events = len([time for time in times if time < seconds])
+
+    hardware.arduino_connection = serial_port
+    asyncio.run(hardware.play_timeline(times[:number_of_events], note_addresses[:number_of_events],
+                                       pwm_values[:number_of_events], hardware.update_solenoid_value,
+                                       flush_function=hardware.flush_solenoid_updates))
+    hardware.arduino_connection = None
+
+
+def report(name, serial_port):
+    stats = serial_port.get_stats()
+    print(f"  {name:<15} writes: {stats['writes']:7d}   bytes/s: {stats['bytes_per_second']:9.1f} "
+          f"(link carries {serial_port.baudrate / 10:.0f})   latency mean: {stats['mean_latency_s'] * 1000:9.2f} ms   "
+          f"max: {stats['max_latency_s'] * 1000:9.2f} ms")
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+
+    seconds = float(os.getenv("BENCH_SECONDS", DEFAULT_SECONDS_PER_SONG))
+
+    for midi_filename in MIDI_FILES:
+        notes = [note for note in hardware.read_midi_notes(midi_filename) if note[1] < seconds]
+        print(f"{midi_filename}: {len(notes)} notes in the first {seconds:g} s")
+
+        serial_port = SimulatedSerial()
+        play_with_single_writes(notes, serial_port)
+        report("single writes", serial_port)
+
+        serial_port = SimulatedSerial()
+        play_with_update_frames(midi_filename, seconds, serial_port)
+        report("update frames", serial_port)
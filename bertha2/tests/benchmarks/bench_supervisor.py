@@ -0,0 +1,57 @@
+# this program measures how long it takes for a crashed process to be running again
+# the time is from the crash to the first heartbeat of the new process, which is when it's running Python again
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_supervisor
+# set BENCH_CRASHES to change the number of crashes
+
+import os
+import statistics
+import time
+from multiprocessing import Value
+
+from bertha2.utils.supervisor import Supervisor, SupervisedProcess
+
+DEFAULT_CRASHES = 20
+
+
+def crash_when_told(crash_time):
+    start_time = time.time()
+    while crash_time.value < start_time:
+        time.sleep(0.001)
+    os._exit(1)
+
+
+def main():
+    number_of_crashes = int(os.getenv("BENCH_CRASHES", DEFAULT_CRASHES))
+    crash_time = Value("d", 0.0, lock=False)
+
+    crashing_p = SupervisedProcess("crashing", crash_when_told, lambda: (crash_time,))
+    # no backoff, so every restart is as fast as the first one
+    supervisor = Supervisor([crashing_p], min_backoff_s=0, max_backoff_s=0)
+    supervisor.start()
+
+    restart_times = []
+    for _ in range(number_of_crashes):
+        while crashing_p.heartbeat.value == 0.0:
+            supervisor.check()
+            time.sleep(0.001)
+
+        restarts = crashing_p.restarts
+        crash_time.value = time.time()
+        # the supervisor checks every SUPERVISOR_CHECK_INTERVAL_S in Bertha2, this is counted as well
+        while crashing_p.restarts == restarts or crashing_p.heartbeat.value == 0.0:
+            supervisor.check()
+            time.sleep(0.001)
+        restart_times.append(crashing_p.heartbeat.value - crash_time.value)
+
+    crashing_p.process.kill()
+    crashing_p.process.join()
+
+    print(f"{number_of_crashes} crashes")
+    print(f"restart time: mean {statistics.mean(restart_times) * 1000:.1f} ms, "
+          f"max {max(restart_times) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# this program compares the fixed cooldown between songs with the cooldown the thermal model asks for
+# the test songs are queued one after another, and played with a simulated clock, so nothing has to wait
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_thermal
+# set BENCH_ROUNDS to queue every song more than once (bertha2.settings owns the command line arguments)
+
+import glob
+import logging
+import os
+
+from bertha2 import hardware
+from bertha2.settings import SOLENOID_COOLDOWN_S
+from bertha2.utils.plan import create_plan
+from bertha2.utils.thermal import ThermalModel
+
+MIDI_FILES = "files/midi/tests/*.mid"
+DEFAULT_ROUNDS = 2
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+
+    rounds = int(os.getenv("BENCH_ROUNDS", DEFAULT_ROUNDS))
+    plans = {midi_filename: create_plan(*hardware.compile_playback_plan(midi_filename))
+             for midi_filename in sorted(glob.glob(MIDI_FILES))}
+
+    model = ThermalModel(hardware.number_of_notes)
+    hardware.thermal_model = model
+    now = model.updated_at
+    playing_s = 0.0
+    cooldowns = []
+
+    for _ in range(rounds):
+        for midi_filename, plan in plans.items():
+            cooldown_s = model.get_cooldown_s(hardware.measure_plan_heat(plan), now=now)
+            now += cooldown_s
+            song_heat = hardware.measure_plan_heat(plan)
+            model.add_song(song_heat, start_time=now)
+            now += song_heat["duration_s"]
+            playing_s += song_heat["duration_s"]
+            cooldowns.append(cooldown_s)
+            print(f"  {midi_filename:<50} {song_heat['duration_s']:6.1f} s   cooldown before: {cooldown_s:5.1f} s   "
+                  f"hottest solenoid after: {model.get_heat(now).max():5.2f}")
+
+    fixed_cooldown_s = SOLENOID_COOLDOWN_S * len(cooldowns)
+    print(f"{len(cooldowns)} songs, {playing_s / 60:.1f} minutes of music")
+    print(f"  fixed cooldown:   {fixed_cooldown_s / 60:5.1f} minutes cooling, "
+          f"{len(cooldowns) / (playing_s + fixed_cooldown_s) * 3600:5.1f} songs per hour")
+    print(f"  thermal cooldown: {sum(cooldowns) / 60:5.1f} minutes cooling, "
+          f"{len(cooldowns) / (playing_s + sum(cooldowns)) * 3600:5.1f} songs per hour")
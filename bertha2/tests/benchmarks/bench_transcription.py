@@ -0,0 +1,89 @@
+# this program measures the real-time factor of the offline spectral transcription backend
+# a real-time factor of 0.01 means one minute of audio is transcribed in 0.6 seconds
+#
+# run from the main directory with:
+#   python -m bertha2.tests.benchmarks.bench_transcription
+# by default a random piano-like song is synthesized, so the accuracy of the transcription can be measured too.
+# set BENCH_AUDIO_FILE to transcribe a real audio file instead (needs ffmpeg), and BENCH_SECONDS to change the song length
+# it also prints the peak memory of a transcription, which should stay about the same however long the song is
+
+import os
+import random
+import time
+import tracemalloc
+
+import numpy as np
+
+from bertha2.settings import STARTING_NOTE, NUMBER_OF_NOTES, TRANSCRIPTION_SAMPLE_RATE
+from bertha2.tests.test_transcription import synthesize_tone
+from bertha2.utils.transcription import transcribe_samples, decode_audio_file
+
+DEFAULT_SECONDS = 60
+ONSET_TOLERANCE_S = 0.1
+
+
+def synthesize_song(seconds, sample_rate=TRANSCRIPTION_SAMPLE_RATE):
+    # a note or a two note chord every 250 ms, with some rests
+    random.seed(2)
+    samples = np.zeros(int(seconds * sample_rate) + sample_rate)
+    notes = []
+
+    for step in range(int(seconds * 4)):
+        if random.random() < 0.2:
+            continue
+
+        for note in random.sample(range(STARTING_NOTE, STARTING_NOTE + NUMBER_OF_NOTES), random.choice([1, 1, 2])):
+            start_time = step * 0.25
+            duration = random.choice([0.25, 0.5])
+            start = int(start_time * sample_rate)
+            tone = synthesize_tone(note, duration, sample_rate)
+            samples[start:start + len(tone)] += tone
+            notes.append((note, start_time))
+
+    return samples.astype(np.float32), notes
+
+
+def measure_accuracy(expected_notes, notes):
+    unmatched = list(notes)
+    matched = 0
+    for expected_note, expected_start_time in expected_notes:
+        for i, (note, start_time, _, _) in enumerate(unmatched):
+            if note == expected_note and abs(start_time - expected_start_time) < ONSET_TOLERANCE_S:
+                matched += 1
+                unmatched.pop(i)
+                break
+
+    precision = matched / len(notes) if notes else 0
+    recall = matched / len(expected_notes) if expected_notes else 0
+    return precision, recall
+
+
+if __name__ == "__main__":
+    audio_filename = os.getenv("BENCH_AUDIO_FILE")
+    expected_notes = None
+
+    if audio_filename:
+        samples = decode_audio_file(audio_filename)
+        print(f"{audio_filename}: {len(samples) / TRANSCRIPTION_SAMPLE_RATE:.1f} s of audio")
+    else:
+        samples, expected_notes = synthesize_song(float(os.getenv("BENCH_SECONDS", DEFAULT_SECONDS)))
+        print(f"synthesized song: {len(samples) / TRANSCRIPTION_SAMPLE_RATE:.1f} s of audio, "
+              f"{len(expected_notes)} notes")
+
+    start_time = time.perf_counter()
+    notes = transcribe_samples(samples, TRANSCRIPTION_SAMPLE_RATE)
+    elapsed = time.perf_counter() - start_time
+
+    print(f"transcribed {len(notes)} notes in {elapsed:.3f} s, "
+          f"real-time factor: {elapsed / (len(samples) / TRANSCRIPTION_SAMPLE_RATE):.4f}")
+
+    # measured separately, tracing every allocation slows the transcription down
+    tracemalloc.start()
+    transcribe_samples(samples, TRANSCRIPTION_SAMPLE_RATE)
+    print(f"peak memory while transcribing: {tracemalloc.get_traced_memory()[1] / 1024 ** 2:.1f} MB "
+          f"(not counting the {samples.nbytes / 1024 ** 2:.1f} MB of samples)")
+    tracemalloc.stop()
+
+    if expected_notes is not None:
+        precision, recall = measure_accuracy(expected_notes, notes)
+        print(f"onset precision: {precision:.2f}   recall: {recall:.2f} (within {ONSET_TOLERANCE_S * 1000:.0f} ms)")
@@ -0,0 +1,127 @@
+""" A local stand-in for obs-websocket (protocol v5), for tests and benchmarks that can't have OBS open """
+
+import asyncio
+import json
+import threading
+
+import websockets
+
+# https://github.com/obsproject/obs-websocket/blob/master/docs/generated/protocol.md#websocketopcode
+OP_HELLO = 0
+OP_IDENTIFY = 1
+OP_IDENTIFIED = 2
+OP_REQUEST = 6
+OP_REQUEST_RESPONSE = 7
+OP_REQUEST_BATCH = 8
+OP_REQUEST_BATCH_RESPONSE = 9
+
+STATUS_SUCCESS = 100
+STATUS_UNKNOWN_REQUEST_TYPE = 204
+STATUS_RESOURCE_NOT_FOUND = 600
+
+
+class FakeObsWebsocketServer:
+    """
+    Answers SetInputSettings and GetInputSettings for the given inputs, one request or a RequestBatch at a time
+
+    latency_s is added to every message the server answers, like the time OBS takes to render a frame.
+    """
+
+    def __init__(self, input_names=("queue", "current_song", "playing_video"), latency_s=0.0):
+        self.inputs = {input_name: {} for input_name in input_names}
+        self.latency_s = latency_s
+        self.connections = 0
+        self.messages = 0
+        self.requests = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.server = None
+        self.url = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop.run_forever, name="fake-obs", daemon=True)
+        self.thread.start()
+
+        async def serve():
+            return await websockets.serve(self.handle_connection, "127.0.0.1", 0)
+
+        self.server = asyncio.run_coroutine_threadsafe(serve(), self.loop).result()
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = f"ws://127.0.0.1:{port}"
+        return self
+
+    def stop(self):
+        async def close():
+            self.server.close()
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def drop_connections(self):
+        # closes every open connection, like OBS being restarted
+        async def close():
+            for websocket in list(self.server.websockets):
+                await websocket.close()
+
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def handle_connection(self, websocket, path=None):
+        self.connections += 1
+        await websocket.send(json.dumps({"op": OP_HELLO, "d": {"obsWebSocketVersion": "5.0.0", "rpcVersion": 1}}))
+
+        async for message in websocket:
+            self.messages += 1
+            if self.latency_s:
+                await asyncio.sleep(self.latency_s)
+
+            payload = json.loads(message)
+            data = payload["d"]
+
+            if payload["op"] == OP_IDENTIFY:
+                response = {"op": OP_IDENTIFIED, "d": {"negotiatedRpcVersion": data["rpcVersion"]}}
+            elif payload["op"] == OP_REQUEST:
+                response = {"op": OP_REQUEST_RESPONSE, "d": {"requestId": data["requestId"], **self.handle_request(data)}}
+            elif payload["op"] == OP_REQUEST_BATCH:
+                results = [self.handle_request(request) for request in data["requests"]]
+                response = {"op": OP_REQUEST_BATCH_RESPONSE, "d": {"requestId": data["requestId"], "results": results}}
+            else:
+                continue
+
+            await websocket.send(json.dumps(response))
+
+    def handle_request(self, request):
+        self.requests += 1
+        request_type = request["requestType"]
+        request_data = request.get("requestData") or {}
+
+        if request_type not in ("SetInputSettings", "GetInputSettings"):
+            return create_result(request_type, STATUS_UNKNOWN_REQUEST_TYPE)
+
+        input_settings = self.inputs.get(request_data.get("inputName"))
+        if input_settings is None:
+            return create_result(request_type, STATUS_RESOURCE_NOT_FOUND)
+
+        if request_type == "SetInputSettings":
+            input_settings.update(request_data["inputSettings"])
+            return create_result(request_type, STATUS_SUCCESS)
+
+        return create_result(request_type, STATUS_SUCCESS, {"inputSettings": dict(input_settings)})
+
+
+def create_result(request_type, code, response_data=None):
+    result = {
+        "requestType": request_type,
+        "requestStatus": {"result": code == STATUS_SUCCESS, "code": code},
+    }
+    if response_data is not None:
+        result["responseData"] = response_data
+    return result
@@ -0,0 +1,229 @@
+import asyncio
+import os
+import queue
+import random
+import time
+from unittest import TestCase
+
+from bertha2.chat import read_chat, parse_privmsg, handle_play_command
+from bertha2.utils.fair_queue import PlayRateLimiter
+from bertha2.utils.irc import IrcLineReader, parse_irc_message
+from bertha2.utils.video_metadata import VideoMetadataCache
+from bertha2.tests.test_video_metadata import create_metadata
+
+PARSER_BENCHMARK_MESSAGES = 50000
+
+
+def generate_privmsg(index):
+    username = f"viewer{index % 5000}"
+    content = random.choice([
+        f"!play https://www.youtube.com/watch?v={index:011d}",
+        "PogChamp PogChamp PogChamp",
+        "play take 5 next please 🎹",
+        "how does the piano work?",
+    ])
+    return (f"@badge-info=;badges=subscriber/12;client-nonce={index:032x};color=#1E90FF;display-name={username};"
+            f"emotes=;first-msg=0;flags=;id={index:08x}-b5a1-4c3e-9d1f-2a7b1c9e4f00;mod=0;returning-chatter=0;"
+            f"room-id=142;subscriber=1;tmi-sent-ts=1700000000000;turbo=0;user-id={index};user-type= "
+            f":{username}!{username}@{username}.tmi.twitch.tv PRIVMSG #berthatwo :{content}")
+
+
+def load_chat_corpus(number_of_messages):
+    # set BENCH_IRC_LOG to use a recorded log (one raw IRC line per line), otherwise chat traffic is generated
+    log_filename = os.getenv("BENCH_IRC_LOG")
+    if log_filename:
+        with open(log_filename, encoding="utf-8") as f:
+            return [line.rstrip("\r\n") for line in f if line.strip()]
+
+    random.seed(8)
+    return [generate_privmsg(index) for index in range(number_of_messages)]
+
+
+class FakeWriter:
+    def __init__(self):
+        self.written = bytearray()
+
+    def write(self, data):
+        self.written += data
+
+
+class TestIrcLineReader(TestCase):
+    def test_several_lines_in_one_read(self):
+        reader = IrcLineReader()
+
+        self.assertEqual(["PRIVMSG #a :one", "PRIVMSG #a :two"], reader.feed(b"PRIVMSG #a :one\r\nPRIVMSG #a :two\r\n"))
+
+    def test_line_split_across_reads(self):
+        reader = IrcLineReader()
+
+        self.assertEqual([], reader.feed(b"PRIVMSG #a :o"))
+        self.assertEqual(["PRIVMSG #a :one"], reader.feed(b"ne\r\nPRIVMSG #a :tw"))
+        self.assertEqual(["PRIVMSG #a :two"], reader.feed(b"o\r\n"))
+
+    def test_character_split_across_reads(self):
+        reader = IrcLineReader()
+        data = "PRIVMSG #a :piano 🎹\r\n".encode("utf-8")
+
+        self.assertEqual([], reader.feed(data[:-4]))
+        self.assertEqual(["PRIVMSG #a :piano 🎹"], reader.feed(data[-4:]))
+
+    def test_line_ending_split_across_reads(self):
+        reader = IrcLineReader()
+
+        self.assertEqual([], reader.feed(b"PRIVMSG #a :one\r"))
+        self.assertEqual(["PRIVMSG #a :one"], reader.feed(b"\n"))
+
+    def test_overlong_line_is_dropped(self):
+        reader = IrcLineReader(max_line_bytes=10)
+
+        self.assertEqual([], reader.feed(b"x" * 20))
+        self.assertEqual(["PING"], reader.feed(b"PING\r\n"))
+
+
+class TestReadChat(TestCase):
+    def test_read_chat(self):
+        batches = []
+        writer = FakeWriter()
+
+        async def handle_messages(messages):
+            batches.append(messages)
+
+        async def run():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b"PRIVMSG #a :one\r\nPING :tmi.twitch.tv\r\nPRIVMSG #a :tw")
+            reader.feed_data(b"o\r\n")
+            reader.feed_eof()
+            await read_chat(reader, writer, handle_messages)
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(run())
+
+        self.assertEqual(["PRIVMSG #a :one", "PRIVMSG #a :two"], [msg for batch in batches for msg in batch])
+        self.assertEqual(b"PONG :tmi.twitch.tv\r\n", bytes(writer.written))
+
+
+class TestHandlePlayCommand(TestCase):
+    def handle_play_command(self, metadata, command_arg="https://www.youtube.com/watch?v=B_i743apHLs",
+                            rate_limiter=None, times=1):
+        link_q = queue.Queue()
+        writer = FakeWriter()
+        metadata_cache = VideoMetadataCache(filename=None, fetch_function=lambda link: metadata)
+        message_object = {"msg_id": "1234", "username": "Viewer", "msg_content": f"!play {command_arg}",
+                          "command": "!play", "command_arg": command_arg}
+
+        for _ in range(times):
+            asyncio.run(handle_play_command(writer, message_object, link_q, metadata_cache,
+                                            rate_limiter=rate_limiter))
+        return list(link_q.queue), writer.written.decode("utf-8")
+
+    def test_valid_video(self):
+        requests, reply = self.handle_play_command(create_metadata())
+
+        self.assertTrue(requests[0].pop("id"))
+        self.assertEqual([{
+            "link": "https://www.youtube.com/watch?v=B_i743apHLs",
+            "video_id": "B_i743apHLs",
+            "title": "Take Five",
+            "length": 120,
+            "username": "Viewer",
+            "priority": 2,
+        }], requests)
+        self.assertIn("has been queued", reply)
+
+    def test_rate_limited(self):
+        requests, reply = self.handle_play_command(create_metadata(), rate_limiter=PlayRateLimiter({2: (2, 300)}),
+                                                   times=3)
+
+        self.assertEqual(2, len(requests))
+        self.assertIn("you can queue another one in 5 min", reply)
+
+    def test_invalid_video(self):
+        requests, reply = self.handle_play_command(create_metadata(age_restricted=True))
+
+        self.assertEqual([], requests)
+        self.assertIn("age restricted", reply)
+
+    def test_invalid_link(self):
+        requests, reply = self.handle_play_command(create_metadata(), command_arg=None)
+
+        self.assertEqual([], requests)
+        self.assertIn("not a valid YouTube link", reply)
+
+
+class TestParseIrcMessage(TestCase):
+    def test_tags_prefix_command_and_trailing(self):
+        message = parse_irc_message(
+            "@badges=broadcaster/1;display-name=Bertha;id=abc :bertha!bertha@bertha.tmi.twitch.tv "
+            "PRIVMSG #berthatwo :!play https://youtu.be/B_i743apHLs :)")
+
+        self.assertEqual({"badges": "broadcaster/1", "display-name": "Bertha", "id": "abc"}, message["tags"])
+        self.assertEqual("bertha!bertha@bertha.tmi.twitch.tv", message["prefix"])
+        self.assertEqual("PRIVMSG", message["command"])
+        self.assertEqual(["#berthatwo"], message["params"])
+        self.assertEqual("!play https://youtu.be/B_i743apHLs :)", message["trailing"])
+
+    def test_escaped_tag_values(self):
+        message = parse_irc_message(r"@system-msg=5\sraiders\:\shi\\;empty=;flag PRIVMSG #a :x")
+
+        self.assertEqual({"system-msg": "5 raiders; hi\\", "empty": "", "flag": ""}, message["tags"])
+
+    def test_without_tags_or_trailing(self):
+        message = parse_irc_message(":tmi.twitch.tv CAP * ACK")
+
+        self.assertEqual({}, message["tags"])
+        self.assertEqual("tmi.twitch.tv", message["prefix"])
+        self.assertEqual("CAP", message["command"])
+        self.assertEqual(["*", "ACK"], message["params"])
+        self.assertIsNone(message["trailing"])
+
+    def test_no_command(self):
+        self.assertIsNone(parse_irc_message("@id=abc"))
+        self.assertIsNone(parse_irc_message(":tmi.twitch.tv"))
+
+
+class TestParsePrivmsg(TestCase):
+    def test_play_command(self):
+        message_object = parse_privmsg(
+            "@badge-info=;badges=subscriber/12,premium/1;color=;display-name=Viewer;emotes=;first-msg=0;flags=;"
+            "id=1234;mod=0 :viewer!viewer@viewer.tmi.twitch.tv PRIVMSG #berthatwo "
+            ":!play https://www.youtube.com/watch?v=B_i743apHLs&t=12s")
+
+        self.assertEqual({
+            "msg_id": "1234",
+            "username": "Viewer",
+            "badges": {"subscriber": "12", "premium": "1"},
+            "msg_content": "!play https://www.youtube.com/watch?v=B_i743apHLs&t=12s",
+            "command": "!play",
+            "command_arg": "https://www.youtube.com/watch?v=B_i743apHLs&t=12s",
+        }, message_object)
+
+    def test_tags_in_any_order(self):
+        message_object = parse_privmsg("@id=5678;display-name=Viewer :viewer!viewer@viewer.tmi.twitch.tv "
+                                       "PRIVMSG #berthatwo :hello there")
+
+        self.assertEqual("5678", message_object["msg_id"])
+        self.assertEqual("Viewer", message_object["username"])
+        self.assertIsNone(message_object["command"])
+
+    def test_command_without_argument(self):
+        message_object = parse_privmsg(":viewer!viewer@viewer.tmi.twitch.tv PRIVMSG #berthatwo :!play")
+
+        self.assertEqual("viewer", message_object["username"])
+        self.assertEqual("!play", message_object["command"])
+        self.assertIsNone(message_object["command_arg"])
+
+    def test_not_privmsg(self):
+        self.assertIsNone(parse_privmsg(":tmi.twitch.tv 001 berthatwo :Welcome, GLHF!"))
+        self.assertIsNone(parse_privmsg(""))
+
+
+class TestParsePerformance(TestCase):
+    def test_parse_chat_corpus(self):
+        corpus = load_chat_corpus(PARSER_BENCHMARK_MESSAGES)
+
+        start_time = time.perf_counter()
+        parsed = [parse_privmsg(line) for line in corpus]
+        elapsed = time.perf_counter() - start_time
+
+        print(f"\nparsed {len(corpus)} messages in {elapsed:.3f} s ({len(corpus) / elapsed:,.0f} messages/s)")
+        self.assertEqual(len(corpus), len(parsed))
@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from bertha2.utils import conversion_cache
+from bertha2.utils.conversion_cache import ConversionCache, get_partial_filename, commit_partial_file, \
+    get_cache_file_stem, remove_partial_files
+
+
+class TestConversionCache(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.index_filename = os.path.join(self.temp_dir, "conversion_cache.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def create_files(self, video_id, size=100, stem=None):
+        files = {}
+        for kind, extension in [("video", "mp4"), ("audio", "mp3"), ("midi", "midi")]:
+            files[kind] = os.path.join(self.temp_dir, f"{stem or video_id}.{extension}")
+            with open(files[kind], "wb") as f:
+                f.write(b"0" * size)
+        return files
+
+    def test_put_and_get(self):
+        cache = ConversionCache(self.index_filename)
+        files = self.create_files("abc")
+        cache.put("abc", "Some Title", files)
+
+        # a new cache instance reads the index back from disk
+        entry = ConversionCache(self.index_filename).get("abc")
+
+        self.assertEqual("Some Title", entry["title"])
+        self.assertEqual(files, entry["files"])
+        self.assertIsNone(cache.get("not_converted"))
+
+    def test_missing_files_are_a_miss(self):
+        cache = ConversionCache(self.index_filename)
+        files = self.create_files("abc")
+        cache.put("abc", "Some Title", files)
+        os.remove(files["midi"])
+
+        self.assertIsNone(cache.get("abc"))
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ConversionCache(self.index_filename, max_size_bytes=700)
+        first_files = self.create_files("first")
+        cache.put("first", "First", first_files)
+        cache.put("second", "Second", self.create_files("second"))
+        cache.get("first")
+
+        # the cache can only hold two entries, "second" hasn't been used for the longest
+        cache.put("third", "Third", self.create_files("third"))
+
+        self.assertIsNotNone(cache.get("first"))
+        self.assertIsNone(cache.get("second"))
+        self.assertIsNotNone(cache.get("third"))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, "second.mp4")))
+        self.assertTrue(os.path.exists(first_files["video"]))
+
+    def test_two_versions_of_one_video(self):
+        cache = ConversionCache(self.index_filename, max_size_bytes=700)
+        with mock.patch.object(conversion_cache, "CONVERTER_VERSION", 0):
+            old_files = self.create_files("abc", stem=get_cache_file_stem("abc"))
+            cache.put("abc", "Old", old_files)
+        current_files = self.create_files("abc", stem=get_cache_file_stem("abc"))
+        cache.put("abc", "Current", current_files)
+
+        self.assertTrue(set(old_files.values()).isdisjoint(current_files.values()))
+        self.assertEqual(600, cache.get_size())
+        # the old version is evicted, without taking the files of the current one with it
+        cache.put("other", "Other", self.create_files("other"))
+        self.assertEqual("Current", cache.get("abc")["title"])
+        self.assertFalse(os.path.exists(old_files["midi"]))
+
+    def test_shared_files_are_kept(self):
+        # indexes written before files were named after the whole key have versions that share files
+        cache = ConversionCache(self.index_filename, max_size_bytes=700)
+        files = self.create_files("abc")
+        with mock.patch.object(conversion_cache, "CONVERTER_VERSION", 0):
+            cache.put("abc", "Old", files)
+        cache.put("abc", "Current", files)
+
+        cache.put("other", "Other", self.create_files("other"))
+
+        self.assertEqual("Current", cache.get("abc")["title"])
+
+    def test_files_in_use_are_not_evicted(self):
+        first_files = self.create_files("first")
+        cache = ConversionCache(self.index_filename, max_size_bytes=700,
+                                get_files_in_use=lambda: {first_files["midi"]})
+        cache.put("first", "First", first_files)
+        cache.put("second", "Second", self.create_files("second"))
+
+        cache.put("third", "Third", self.create_files("third"))
+
+        # "first" is waiting to be played, so "second" is evicted instead
+        self.assertIsNotNone(cache.get("first"))
+        self.assertIsNone(cache.get("second"))
+
+    def test_partial_files(self):
+        filename = os.path.join(self.temp_dir, "song.midi")
+        partial_filename = get_partial_filename(filename)
+        # every writer gets its own partial file, with the extension kept at the end
+        self.assertNotEqual(partial_filename, get_partial_filename(filename))
+        self.assertTrue(partial_filename.endswith(".midi"))
+
+        with open(partial_filename, "w") as f:
+            f.write("done")
+        commit_partial_file(partial_filename, filename)
+
+        self.assertTrue(os.path.isfile(filename))
+        self.assertFalse(os.path.exists(partial_filename))
+
+    def test_left_over_partial_files_are_removed(self):
+        filename = os.path.join(self.temp_dir, "song.midi")
+        with open(filename, "w") as f:
+            f.write("done")
+        with open(get_partial_filename(filename), "w") as f:
+            f.write("half")
+
+        remove_partial_files(self.temp_dir)
+
+        self.assertEqual(["song.midi"], os.listdir(self.temp_dir))
@@ -0,0 +1,116 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import TestCase
+
+from bertha2.converter import choose_audio_stream, choose_display_video_stream, create_conversion, get_files_in_use, \
+    create_conversion_pipeline, submit_conversion, convert_request
+from bertha2.utils.conversion_cache import get_cache_file_stem
+from bertha2.utils.queue_state import QueueState, EVENT_ENQUEUE, EVENT_COMPLETE
+
+
+def audio_stream(abr):
+    return SimpleNamespace(abr=abr, resolution=None)
+
+
+def video_stream(resolution):
+    return SimpleNamespace(abr="96kbps", resolution=resolution)
+
+
+class TestChooseStreams(TestCase):
+    def test_choose_audio_stream(self):
+        streams = [audio_stream("160kbps"), audio_stream("48kbps"), audio_stream("128kbps"), audio_stream("32kbps")]
+
+        self.assertEqual("48kbps", choose_audio_stream(streams).abr)
+
+    def test_choose_audio_stream_only_low_bitrates(self):
+        self.assertEqual("24kbps", choose_audio_stream([audio_stream("32kbps"), audio_stream("24kbps")]).abr)
+
+    def test_choose_audio_stream_no_streams(self):
+        with self.assertRaises(ValueError):
+            choose_audio_stream([])
+
+    def test_choose_display_video_stream(self):
+        streams = [video_stream("720p"), video_stream("144p"), video_stream("360p"), video_stream("240p")]
+
+        self.assertEqual("360p", choose_display_video_stream(streams).resolution)
+
+    def test_choose_display_video_stream_only_high_resolutions(self):
+        streams = [video_stream("1080p"), video_stream("720p")]
+
+        self.assertEqual("720p", choose_display_video_stream(streams).resolution)
+
+
+class TestCreateConversion(TestCase):
+    def test_create_conversion(self):
+        conversion = create_conversion("https://www.youtube.com/watch?v=B_i743apHLs&t=12s")
+
+        self.assertEqual("B_i743apHLs", conversion["video_id"])
+        # named after the whole cache key, see utils/conversion_cache.py
+        self.assertTrue(conversion["midi"].endswith(f"{get_cache_file_stem('B_i743apHLs')}.midi"))
+        self.assertTrue(conversion["video"].endswith(f"{get_cache_file_stem('B_i743apHLs')}.mp4"))
+        self.assertIsNone(conversion["audio_data"])
+
+    def test_create_conversion_from_play_request(self):
+        conversion = create_conversion({"link": "https://youtu.be/B_i743apHLs", "title": "Take Five"})
+
+        self.assertEqual("B_i743apHLs", conversion["video_id"])
+        self.assertEqual("Take Five", conversion["title"])
+
+    def test_files_in_use(self):
+        state = QueueState()
+        conversion = create_conversion({"id": "a", "link": "https://youtu.be/B_i743apHLs", "title": "Take Five"})
+        for queue_name, item_id, item in [
+            ("link_q", "a", {"id": "a", "link": "https://youtu.be/B_i743apHLs", "title": "Take Five"}),
+            ("link_q", "b", {"id": "b", "link": "not a link", "title": None}),
+            ("play_q", "c", {"id": "c", "title": "c", "midi": "c.midi", "video": "c.mp4"}),
+            ("play_q", "old.midi", "old.midi"),
+        ]:
+            state.apply({"event": EVENT_ENQUEUE, "queue": queue_name, "id": item_id, "item": item})
+
+        self.assertEqual({conversion["video"], conversion["midi"], "c.midi", "c.mp4", "old.midi"},
+                         get_files_in_use(state))
+
+    def test_same_video_is_converted_once(self):
+        play_q = queue.Queue()
+        in_flight_conversions = {}
+        pipeline = create_conversion_pipeline(play_q, in_flight_conversions=in_flight_conversions)
+        for _, _, executor in pipeline.stages:
+            executor.shutdown()
+        converted = []
+        release = threading.Event()
+
+        def fake_conversion(conversion):
+            release.wait(timeout=5)
+            converted.append(conversion["id"])
+            return {**conversion, "title": "Take Five"}
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        pipeline.stages = [("transcribe", fake_conversion, executor)]
+
+        for request_id, username in [("a", "alice"), ("b", "bob")]:
+            submit_conversion(pipeline, in_flight_conversions, create_conversion(
+                {"id": request_id, "link": "https://youtu.be/B_i743apHLs", "title": None, "username": username}))
+        release.set()
+        pipeline.join()
+
+        self.assertEqual(["a"], converted)
+        play_items = [play_q.get_nowait() for _ in range(2)]
+        self.assertEqual([("a", "alice"), ("b", "bob")], [(item["id"], item["username"]) for item in play_items])
+        self.assertEqual(play_items[0]["midi"], play_items[1]["midi"])
+        self.assertEqual({}, in_flight_conversions)
+
+    def test_malformed_link_is_completed(self):
+        play_q = queue.Queue()
+        queue_event_q = queue.Queue()
+        in_flight_conversions = {}
+        pipeline = create_conversion_pipeline(play_q, queue_event_q, in_flight_conversions)
+        self.addCleanup(lambda: [executor.shutdown() for _, _, executor in pipeline.stages])
+
+        convert_request(pipeline, in_flight_conversions, {"id": "a", "link": "not a link"}, queue_event_q)
+
+        self.assertEqual(0, len(pipeline.in_flight))
+        event = queue_event_q.get_nowait()
+        self.assertEqual((EVENT_COMPLETE, "link_q", "a"), (event["event"], event["queue"], event["id"]))
@@ -0,0 +1,145 @@
+import multiprocessing
+import queue
+import threading
+import time
+from unittest import TestCase
+
+from bertha2.utils.fair_queue import FairQueue, ScheduledQueue, PlayRateLimiter, get_priority
+from bertha2.utils.queue_state import QueueState, EVENT_ENQUEUE, EVENT_DEQUEUE, ITEM_IN_PROGRESS, ITEM_SCHEDULED, \
+    ITEM_QUEUED
+
+
+def create_request(item_id, username, length=180, priority=2):
+    return {"id": item_id, "username": username, "length": length, "priority": priority}
+
+
+def pop_all(fair_queue):
+    return [fair_queue.pop()["id"] for _ in range(len(fair_queue))]
+
+
+class TestFairQueue(TestCase):
+    def test_viewers_take_turns(self):
+        fair_queue = FairQueue()
+        # one viewer queues five videos before anyone else
+        for i in range(5):
+            fair_queue.push(create_request(f"spam{i}", "spammer"))
+        fair_queue.push(create_request("a", "alice"))
+        fair_queue.push(create_request("b", "bob"))
+
+        self.assertEqual(["spam0", "a", "b", "spam1", "spam2", "spam3", "spam4"], pop_all(fair_queue))
+
+    def test_weighted_by_length(self):
+        fair_queue = FairQueue()
+        for i in range(2):
+            fair_queue.push(create_request(f"long{i}", "alice", length=300))
+        for i in range(4):
+            fair_queue.push(create_request(f"short{i}", "bob", length=150))
+
+        self.assertEqual(["long0", "short0", "short1", "long1", "short2", "short3"], pop_all(fair_queue))
+
+    def test_priority_lanes(self):
+        fair_queue = FairQueue()
+        fair_queue.push(create_request("viewer", "alice"))
+        fair_queue.push(create_request("subscriber", "bob", priority=1))
+        fair_queue.push(create_request("mod", "carol", priority=0))
+
+        self.assertEqual(["mod", "subscriber", "viewer"], pop_all(fair_queue))
+
+    def test_late_viewer_waits_behind_current_song(self):
+        fair_queue = FairQueue()
+        for i in range(3):
+            fair_queue.push(create_request(f"a{i}", "alice"))
+        self.assertEqual("a0", fair_queue.pop()["id"])
+        self.assertEqual("a1", fair_queue.pop()["id"])
+
+        # bob hasn't had a turn, but doesn't get to go before what was already popped
+        fair_queue.push(create_request("b", "bob"))
+        self.assertEqual(["b", "a2"], pop_all(fair_queue))
+
+    def test_old_items(self):
+        fair_queue = FairQueue()
+        fair_queue.push("https://youtu.be/a")
+        fair_queue.push({"id": "b", "title": "b", "midi": "b.midi", "video": "b.mp4"})
+
+        self.assertEqual("https://youtu.be/a", fair_queue.pop())
+        self.assertEqual("b", fair_queue.pop()["id"])
+
+    def test_end_times_are_pruned(self):
+        fair_queue = FairQueue()
+        for i in range(3000):
+            fair_queue.push(create_request(str(i), f"viewer{i}"))
+            fair_queue.pop()
+
+        self.assertLess(len(fair_queue.end_times), 1024)
+
+
+class TestScheduledQueue(TestCase):
+    def test_scheduled_order_is_recorded(self):
+        q = queue.Queue()
+        queue_event_q = queue.Queue()
+        scheduled_q = ScheduledQueue(q, "play_q", queue_event_q)
+        state = QueueState()
+        for request in [create_request("a1", "alice"), create_request("a2", "alice"), create_request("b", "bob")]:
+            state.apply({"event": EVENT_ENQUEUE, "queue": "play_q", "id": request["id"], "item": request})
+            q.put(request)
+
+        self.assertEqual("a1", scheduled_q.get(timeout=1)["id"])
+        for _ in range(3):
+            state.apply(queue_event_q.get(timeout=1))
+        state.apply({"event": EVENT_DEQUEUE, "queue": "play_q", "id": "a1"})
+        state.apply({"event": EVENT_ENQUEUE, "queue": "play_q", "id": "c", "item": create_request("c", "carol")})
+
+        # what will be played next, in order, like visuals shows it
+        self.assertEqual([("a1", ITEM_IN_PROGRESS), ("b", ITEM_SCHEDULED), ("a2", ITEM_SCHEDULED), ("c", ITEM_QUEUED)],
+                         [(entry["id"], entry["state"]) for entry in state.get_entries("play_q")])
+
+    def test_get_waits_for_items(self):
+        q = queue.Queue()
+        scheduled_q = ScheduledQueue(q, "play_q")
+
+        with self.assertRaises(queue.Empty):
+            scheduled_q.get(timeout=0.01)
+        threading.Timer(0.05, q.put, args=(create_request("a", "alice"),)).start()
+        self.assertEqual("a", scheduled_q.get(timeout=5)["id"])
+
+    def test_nothing_is_taken_until_an_item_is_asked_for(self):
+        q = multiprocessing.Queue()
+        scheduled_q = ScheduledQueue(q, "play_q")
+        for request in [create_request("a1", "alice"), create_request("a2", "alice"), create_request("b", "bob")]:
+            q.put(request)
+        time.sleep(0.1)  # lets the queue's feeder thread send them
+
+        # a process that's restarted now doesn't lose anything
+        self.assertEqual(0, len(scheduled_q.fair_queue))
+        self.assertEqual(["a1", "b", "a2"], [scheduled_q.get(timeout=1)["id"] for _ in range(3)])
+        with self.assertRaises(queue.Empty):
+            scheduled_q.get(timeout=0.01)
+
+
+class TestPlayRateLimiter(TestCase):
+    def test_burst_then_refill(self):
+        rate_limiter = PlayRateLimiter({2: (3, 300)})
+
+        self.assertEqual([0, 0, 0], [rate_limiter.take("alice", 2, now=0) for _ in range(3)])
+        self.assertEqual(300, rate_limiter.take("alice", 2, now=0))
+        # other viewers have their own bucket
+        self.assertEqual(0, rate_limiter.take("bob", 2, now=0))
+        self.assertEqual(150, rate_limiter.take("alice", 2, now=150))
+        self.assertEqual(0, rate_limiter.take("alice", 2, now=300))
+
+    def test_unlimited_lanes(self):
+        rate_limiter = PlayRateLimiter({2: (1, 300)})
+
+        self.assertEqual([0] * 10, [rate_limiter.take("mod", 0, now=0) for _ in range(10)])
+
+    def test_full_buckets_are_pruned(self):
+        rate_limiter = PlayRateLimiter({2: (1, 10)})
+        for i in range(3000):
+            rate_limiter.take(f"viewer{i}", 2, now=i)
+
+        self.assertLess(len(rate_limiter.buckets), 1024)
+
+    def test_priority_from_badges(self):
+        self.assertEqual(0, get_priority({"moderator": "1", "subscriber": "12"}))
+        self.assertEqual(1, get_priority({"subscriber": "12", "premium": "1"}))
+        self.assertEqual(2, get_priority({"premium": "1"}))
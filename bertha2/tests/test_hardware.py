@@ -0,0 +1,254 @@
+import asyncio
+import heapq
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from bertha2 import hardware
+from bertha2.hardware import power_draw_function, read_midi_notes, compile_playback_plan
+from bertha2.settings import SOLENOID_PEAK_TIME_S
+from bertha2.utils.envelope import EnvelopeTable, load_calibration, DEFAULT_PROFILE
+from bertha2.utils.metrics import Histogram
+from bertha2.utils.plan import load_or_compile_plan
+from bertha2.utils.serial_link import encode_update_frame, decode_update_frames, SimulatedSerial, VirtualPiano, \
+    FRAME_START
+from bertha2.utils.scheduler import build_event_queue, build_envelope_event_queue, resolve_event_queue, \
+    play_timeline, NOTE_ON, NOTE_HOLD, NOTE_OFF
+
+
+class TestEventQueue(TestCase):
+    def test_build_event_queue_order(self):
+        notes = [(3, 0.0, 127, 0.5), (5, 0.0, 64, 0.05)]
+        events = build_event_queue(notes, power_draw_function, SOLENOID_PEAK_TIME_S)
+
+        ordered = [heapq.heappop(events) for _ in range(len(events))]
+        kinds = [(event[1], event[3]) for event in ordered]
+
+        # the short note never reaches hold power
+        self.assertEqual([(NOTE_ON, 3), (NOTE_ON, 5), (NOTE_OFF, 5), (NOTE_HOLD, 3), (NOTE_OFF, 3)], kinds)
+        self.assertEqual(power_draw_function(127, 0), ordered[0][4])
+        self.assertEqual(0, ordered[-1][4])
+
+    def test_resolve_event_queue_overlapping_notes(self):
+        # the second strike of note 1 should not be cut off by the release of the first
+        notes = [(1, 0.0, 127, 0.04), (1, 0.02, 127, 0.04)]
+        events = build_event_queue(notes, power_draw_function, SOLENOID_PEAK_TIME_S)
+
+        times, note_addresses, pwm_values = resolve_event_queue(events)
+
+        self.assertEqual([0.0, 0.02, 0.06], times)
+        self.assertEqual([power_draw_function(127, 0), power_draw_function(127, 0), 0], pwm_values)
+
+    def test_play_timeline(self):
+        updates = []
+
+        stats = asyncio.run(play_timeline([0.0, 0.01, 0.03], [1, 2, 1], [120, 130, 0],
+                                          lambda note, pwm: updates.append((note, pwm))))
+
+        self.assertEqual([(1, 120), (2, 130), (1, 0)], updates)
+        self.assertEqual(3, stats["events"])
+        self.assertLess(stats["max_error_s"], 0.05)
+
+    def test_play_timeline_observes_wakeups(self):
+        histogram = Histogram("playback_error_seconds", "", (), buckets=(0.05,))
+
+        stats = asyncio.run(play_timeline([0.0, 0.0, 0.01], [1, 2, 1], [120, 130, 0], lambda note, pwm: None,
+                                          error_histogram=histogram))
+
+        self.assertEqual(stats["wakeups"], sum(histogram.counts))
+        self.assertEqual(stats["wakeups"], histogram.counts[0])
+
+
+class TestEnvelopeTable(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.calibration_filename = os.path.join(self.temp_dir, "solenoid_calibration.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_default_profile_matches_power_draw_function(self):
+        envelope_table = EnvelopeTable(load_calibration(self.calibration_filename, 4))
+
+        envelopes = envelope_table.get_envelopes([2] * 128, range(128))
+        for velocity in range(128):
+            self.assertEqual(int(power_draw_function(velocity, 0)), envelopes[velocity, 0])
+            self.assertEqual(int(power_draw_function(velocity, SOLENOID_PEAK_TIME_S)), envelopes[velocity, -1])
+
+    def test_load_calibration(self):
+        with open(self.calibration_filename, "w") as f:
+            json.dump({"default": {"hold_power": 60}, "solenoids": {"1": {"peak_time_s": 0.05, "hold_power": 40}}}, f)
+
+        profiles = load_calibration(self.calibration_filename, 3)
+
+        self.assertEqual([60, 40, 60], [profile["hold_power"] for profile in profiles])
+        self.assertEqual([SOLENOID_PEAK_TIME_S, 0.05, SOLENOID_PEAK_TIME_S],
+                         [profile["peak_time_s"] for profile in profiles])
+        self.assertEqual(DEFAULT_PROFILE["maximum_power"], profiles[1]["maximum_power"])
+
+    def test_build_envelope_event_queue_matches_build_event_queue(self):
+        notes = [note for note in read_midi_notes("files/midi/tests/scale.mid")
+                 if 0 <= note[0] < hardware.number_of_notes]
+        envelope_table = EnvelopeTable(load_calibration(self.calibration_filename, hardware.number_of_notes))
+
+        events = build_envelope_event_queue(notes, envelope_table, [note[0] for note in notes])
+        expected_events = build_event_queue(notes, power_draw_function, SOLENOID_PEAK_TIME_S)
+
+        expected_plan = [(time, address, int(pwm)) for time, address, pwm in zip(*resolve_event_queue(expected_events))]
+        self.assertEqual(expected_plan, list(zip(*resolve_event_queue(events))))
+
+    def test_per_solenoid_profile(self):
+        profiles = [dict(DEFAULT_PROFILE), {**DEFAULT_PROFILE, "peak_time_s": 0.03, "velocity_curve": 2.0}]
+        envelope_table = EnvelopeTable(profiles, bucket_s=0.01)
+        notes = [(0, 0.0, 127, 0.5), (1, 0.0, 127, 0.5), (1, 1.0, 0, 0.5)]
+
+        events = build_envelope_event_queue(notes, envelope_table, [0, 1, 1])
+        times, note_addresses, pwm_values = resolve_event_queue(events)
+
+        # solenoid 1 drops to hold power sooner, and its quietest notes are struck at minimum power
+        self.assertEqual([(0.0, 0, 150), (0.0, 1, 150), (0.03, 1, 50), (0.1, 0, 50), (0.5, 0, 0), (0.5, 1, 0),
+                          (1.0, 1, 100), (1.03, 1, 50), (1.5, 1, 0)],
+                         [(round(time, 6), address, pwm)
+                          for time, address, pwm in zip(times, note_addresses, pwm_values)])
+
+    def test_key_changes_with_calibration(self):
+        default_table = EnvelopeTable([dict(DEFAULT_PROFILE)])
+        tuned_table = EnvelopeTable([{**DEFAULT_PROFILE, "hold_power": 55}])
+
+        self.assertEqual(default_table.key, EnvelopeTable([dict(DEFAULT_PROFILE)]).key)
+        self.assertNotEqual(default_table.key, tuned_table.key)
+
+
+class TestReadMidiNotes(TestCase):
+    def test_read_midi_notes_scale(self):
+        notes = read_midi_notes("files/midi/tests/scale.mid")
+
+        self.assertEqual(44, len(notes))
+        for note_address, start_time, velocity, hold_note_time in notes:
+            self.assertGreaterEqual(start_time, 0)
+            self.assertGreater(hold_note_time, 0)
+
+
+class TestPlaybackPlan(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.midi_filename = os.path.join(self.temp_dir, "scale.midi")
+        shutil.copy("files/midi/tests/scale.mid", self.midi_filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_load_or_compile_plan(self):
+        compiled = []
+
+        def compile_function(midi_filename):
+            compiled.append(midi_filename)
+            return compile_playback_plan(midi_filename)
+
+        plan = load_or_compile_plan(self.midi_filename, compile_function)
+        replayed_plan = load_or_compile_plan(self.midi_filename, compile_function)
+
+        # the replay is served from disk without compiling again
+        self.assertEqual(1, len(compiled))
+        self.assertEqual(plan.tolist(), replayed_plan.tolist())
+        self.assertTrue((plan["time"][1:] >= plan["time"][:-1]).all())
+        self.assertEqual(2, len(os.listdir(self.temp_dir)))
+
+    def test_compile_key_recompiles(self):
+        compiled = []
+
+        def compile_function(midi_filename):
+            compiled.append(midi_filename)
+            return compile_playback_plan(midi_filename)
+
+        load_or_compile_plan(self.midi_filename, compile_function, compile_key="a")
+        load_or_compile_plan(self.midi_filename, compile_function, compile_key="b")
+
+        # the plan compiled with the old key is removed
+        self.assertEqual(2, len(compiled))
+        self.assertEqual(2, len(os.listdir(self.temp_dir)))
+
+
+class TestSerialFrames(TestCase):
+    def test_encode_decode_update_frame(self):
+        changes = [(0, 150), (47, 0), (12, 254)]
+        frame = encode_update_frame(7, changes)
+
+        self.assertEqual(FRAME_START, frame[0])
+        self.assertEqual(3 + 2 * len(changes) + 1, len(frame))
+        self.assertEqual([(7, changes)], decode_update_frames(frame))
+
+    def test_decode_skips_corrupted_frames(self):
+        corrupted = bytearray(encode_update_frame(1, [(3, 100)]))
+        corrupted[4] ^= 0xFF
+
+        frames = decode_update_frames(bytes(corrupted) + encode_update_frame(2, [(4, 50)]))
+
+        self.assertEqual([(2, [(4, 50)])], frames)
+
+
+class TestFlushSolenoidUpdates(TestCase):
+    def setUp(self):
+        self.serial_port = SimulatedSerial()
+        hardware.arduino_connection = self.serial_port
+
+    def tearDown(self):
+        hardware.arduino_connection = None
+        hardware.pending_note_values.clear()
+        hardware.note_values[:] = [0] * hardware.number_of_notes
+
+    def test_only_changes_are_sent(self):
+        hardware.update_solenoid_value(1, 120)
+        hardware.update_solenoid_value(2, 120)
+        hardware.flush_solenoid_updates()
+
+        # note 1 doesn't change, so only note 2 is sent
+        hardware.update_solenoid_value(1, 120)
+        hardware.update_solenoid_value(2, 50)
+        hardware.flush_solenoid_updates()
+
+        # nothing changes, so nothing is written
+        hardware.update_solenoid_value(2, 50)
+        hardware.flush_solenoid_updates()
+
+        self.assertEqual(2, len(self.serial_port.writes))
+        self.assertEqual([(1, 120), (2, 120), (2, 50)],
+                         [update[1:] for update in self.serial_port.get_delivered_updates()])
+
+
+class TestVirtualPiano(TestCase):
+    def tearDown(self):
+        hardware.arduino_connection = None
+        hardware.reset_solenoid_state()
+
+    def test_records_solenoid_changes(self):
+        now = [0.0]
+        piano = VirtualPiano(hardware.number_of_notes, clock=lambda: now[0])
+        piano.write(encode_update_frame(0, [(1, 120), (2, 130)]))
+        now[0] = 1.0
+        piano.write(encode_update_frame(1, [(1, 50)]))
+        now[0] = 2.0
+        # frame 2 was lost on the way
+        piano.write(encode_update_frame(3, [(1, 0), (2, 0)]))
+        piano.write(encode_update_frame(4, [(1, 120)]))
+
+        self.assertEqual([120, 0], piano.solenoid_values[1:3])
+        self.assertEqual(4, piano.frames)
+        self.assertEqual(1, piano.lost_frames)
+        # holding note 1 at a lower power isn't a new onset, striking it again is
+        self.assertEqual([1, 2, 1], [note_address for _, note_address in piano.get_note_onsets()])
+        self.assertAlmostEqual(0.0, piano.get_note_onsets()[0][0], delta=0.01)
+
+    def test_playback_to_virtual_piano(self):
+        hardware.create_connection_with_virtual_piano()
+        piano = hardware.arduino_connection
+
+        asyncio.run(play_timeline([0.0, 0.0, 0.02, 0.05], [1, 26, 1, 2], [120, 130, 0, 110],
+                                  hardware.update_solenoid_value, flush_function=hardware.flush_solenoid_updates))
+
+        self.assertEqual([(1, 120), (26, 130), (1, 0), (2, 110)],
+                         [(note_address, pwm_value) for _, note_address, pwm_value in piano.events])
+        self.assertEqual(3, piano.frames)
+        self.assertEqual(0, piano.lost_frames)
@@ -0,0 +1,93 @@
+import json
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from bertha2.utils.journal import QueueJournal
+from bertha2.utils.queue_state import EVENT_ENQUEUE, EVENT_DEQUEUE, EVENT_COMPLETE
+
+
+def create_request(item_id):
+    return {"id": item_id, "link": f"https://youtu.be/{item_id}"}
+
+
+class TestQueueJournal(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "queue_journal.jsonl")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def open_journal(self, **kwargs):
+        journal = QueueJournal(self.filename, **kwargs)
+        journal.replay()
+        journal.open()
+        return journal
+
+    def test_replay_after_crash(self):
+        journal = self.open_journal()
+        for i in range(5):
+            journal.append({"event": EVENT_ENQUEUE, "queue": "link_q", "id": str(i), "item": create_request(str(i))})
+        journal.append({"event": EVENT_DEQUEUE, "queue": "link_q", "id": "0"})
+        journal.append({"event": EVENT_ENQUEUE, "queue": "play_q", "id": "0", "item": {"id": "0", "midi": "0.midi"}})
+        journal.append({"event": EVENT_COMPLETE, "queue": "link_q", "id": "0"})
+        journal.flush()
+
+        # not closed, like a crash
+        state = QueueJournal(self.filename).replay()
+
+        self.assertEqual([create_request(str(i)) for i in range(1, 5)], state.get_items("link_q"))
+        self.assertEqual([{"id": "0", "midi": "0.midi"}], state.get_items("play_q"))
+
+    def test_unfinished_last_line_is_ignored(self):
+        journal = self.open_journal()
+        journal.append({"event": EVENT_ENQUEUE, "queue": "link_q", "id": "a", "item": create_request("a")})
+        journal.flush()
+        with open(self.filename, "a", encoding="utf-8") as f:
+            f.write('{"event": "enqueue", "queue": "link_q", "id": "b", "it')
+
+        journal = QueueJournal(self.filename)
+        state = journal.replay()
+        journal.open()  # rewrites the journal without the unfinished line
+        journal.append({"event": EVENT_ENQUEUE, "queue": "link_q", "id": "c", "item": create_request("c")})
+        journal.close()
+
+        self.assertEqual([create_request("a"), create_request("c")], QueueJournal(self.filename).replay().get_items("link_q"))
+
+    def test_compaction(self):
+        journal = self.open_journal(compact_after_events=10)
+        for i in range(50):
+            item = create_request(str(i))
+            journal.append({"event": EVENT_ENQUEUE, "queue": "link_q", "id": item["id"], "item": item})
+            if i % 2:
+                journal.append({"event": EVENT_COMPLETE, "queue": "link_q", "id": item["id"]})
+        journal.flush()
+
+        with open(self.filename, encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f]
+
+        self.assertGreater(journal.stats["compactions"], 1)
+        self.assertLess(len(lines), 40)
+        expected_items = [create_request(str(i)) for i in range(0, 50, 2)]
+        self.assertEqual(expected_items, QueueJournal(self.filename).replay().get_items("link_q"))
+
+    def test_events_from_threads_share_fsyncs(self):
+        journal = self.open_journal()
+
+        def append_events(thread_index):
+            for i in range(200):
+                item_id = f"{thread_index}-{i}"
+                journal.append({"event": EVENT_ENQUEUE, "queue": "link_q", "id": item_id, "item": item_id})
+
+        threads = [threading.Thread(target=append_events, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        journal.close()
+
+        self.assertEqual(800, journal.stats["events"])
+        self.assertLess(journal.stats["fsyncs"], 800)
+        self.assertEqual(800, len(QueueJournal(self.filename).replay().get_items("link_q")))
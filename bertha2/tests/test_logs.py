@@ -0,0 +1,81 @@
+import logging
+from logging.handlers import QueueListener
+from multiprocessing import Process, Queue
+from unittest import TestCase
+
+from bertha2.utils.logs import DebugRateLimitFilter, initialize_process_logging
+
+
+def create_record(name, created, level=logging.DEBUG, message="tick"):
+    record = logging.LogRecord(name, level, __file__, 0, message, None, None)
+    record.created = created
+    return record
+
+
+def log_from_child(log_q):
+    initialize_process_logging(log_q)
+    logger = logging.getLogger("bertha2.test_child")
+    logger.setLevel(logging.DEBUG)
+    logger.debug("frame %d: %s", 3, [(1, 120)])
+    try:
+        raise ValueError("not picklable on its own")
+    except ValueError:
+        logger.exception("failed")
+
+
+class CollectingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestDebugRateLimitFilter(TestCase):
+    def setUp(self):
+        self.rate_limit_filter = DebugRateLimitFilter({"bertha2.hardware": 10})
+
+    def test_drops_debug_records_over_the_limit(self):
+        passed = [self.rate_limit_filter.filter(create_record("bertha2.hardware", 100 + i * 0.001))
+                  for i in range(100)]
+
+        # a second's worth of records, then nothing until the bucket refills
+        self.assertEqual(10, sum(passed))
+        self.assertEqual(90, self.rate_limit_filter.dropped["bertha2.hardware"])
+
+    def test_reports_dropped_records(self):
+        for i in range(12):
+            self.rate_limit_filter.filter(create_record("bertha2.hardware", 100.0))
+
+        record = create_record("bertha2.hardware", 101.0)
+        self.assertTrue(self.rate_limit_filter.filter(record))
+        self.assertEqual("tick (2 debug messages dropped)", record.getMessage())
+
+    def test_other_records_always_get_through(self):
+        for i in range(100):
+            self.assertTrue(self.rate_limit_filter.filter(create_record("bertha2.hardware", 100.0, logging.INFO)))
+            self.assertTrue(self.rate_limit_filter.filter(create_record("bertha2.chat", 100.0)))
+
+    def test_limits_child_loggers(self):
+        passed = [self.rate_limit_filter.filter(create_record("bertha2.hardware.serial", 100.0)) for i in range(20)]
+
+        self.assertEqual(10, sum(passed))
+
+
+class TestProcessLogging(TestCase):
+    def test_child_logs_through_the_listener(self):
+        log_q = Queue()
+        handler = CollectingHandler()
+        log_listener = QueueListener(log_q, handler)
+        log_listener.start()
+
+        process = Process(target=log_from_child, args=(log_q,))
+        process.start()
+        process.join(timeout=5)
+        log_listener.stop()
+
+        self.assertEqual(["frame 3: [(1, 120)]", "failed"],
+                         [record.getMessage().split("\n")[0] for record in handler.records])
+        self.assertEqual("bertha2.test_child", handler.records[0].name)
+        self.assertIn("ValueError", handler.records[1].getMessage())
@@ -0,0 +1,109 @@
+import time
+import urllib.error
+import urllib.request
+from multiprocessing import Process, Queue
+from unittest import TestCase
+
+from bertha2.utils import metrics
+from bertha2.utils.metrics import MetricsCollector, collect_changes, get_counter, get_gauge, get_histogram, \
+    start_metrics_reporter, start_metrics_server
+from bertha2.utils.queue_state import QueueState, observe_queue_event, EVENT_ENQUEUE, EVENT_DEQUEUE
+
+
+def count_in_child(metrics_q):
+    start_metrics_reporter(metrics_q, interval_s=0.01)
+    get_counter("child_events_total", "Events").inc(3)
+    get_histogram("child_seconds", "Durations", buckets=(1, 2)).observe(1.5)
+    time.sleep(0.2)
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        metrics.registered_metrics.clear()
+
+    def tearDown(self):
+        metrics.registered_metrics.clear()
+
+    def test_collect_changes(self):
+        counter = get_counter("events_total", "Events", kind="test")
+        counter.inc()
+        counter.inc(2)
+        get_gauge("depth", "Depth").set(4)
+
+        self.assertIs(counter, get_counter("events_total", "Events", kind="test"))
+        self.assertEqual([("counter", "events_total", "Events", (("kind", "test"),), None, 3.0),
+                          ("gauge", "depth", "Depth", (), None, 4)], collect_changes())
+        # only what changed since
+        counter.inc()
+        self.assertEqual([("counter", "events_total", "Events", (("kind", "test"),), None, 1.0)], collect_changes())
+        self.assertEqual([], collect_changes())
+
+    def test_histogram_buckets(self):
+        histogram = get_histogram("wait_seconds", "Wait", buckets=(0.1, 1))
+        for value in [0.05, 0.1, 0.5, 5]:
+            histogram.observe(value)
+
+        self.assertEqual([2, 1, 1], histogram.counts)
+        self.assertAlmostEqual(5.65, histogram.sum)
+
+    def test_collector_adds_up_restarted_processes(self):
+        collector = MetricsCollector()
+        # two runs of the same process, the second started from zero again
+        collector.add([("counter", "songs_total", "Songs", (), None, 2.0),
+                       ("histogram", "wait_seconds", "Wait", (), (0.1, 1), ([1, 0, 0], 0.05))])
+        collector.add([("counter", "songs_total", "Songs", (), None, 1.0),
+                       ("histogram", "wait_seconds", "Wait", (), (0.1, 1), ([0, 1, 1], 2.5))])
+
+        text = collector.render_prometheus_text()
+
+        self.assertIn("# TYPE songs_total counter\nsongs_total 3.0\n", text)
+        self.assertIn('wait_seconds_bucket{le="0.1"} 1\n'
+                      'wait_seconds_bucket{le="1.0"} 2\n'
+                      'wait_seconds_bucket{le="+Inf"} 3\n'
+                      'wait_seconds_sum 2.55\n'
+                      'wait_seconds_count 3\n', text)
+
+    def test_label_values_are_escaped(self):
+        get_counter("commands_total", "Commands", command='say "hi"\n').inc()
+
+        self.assertIn('commands_total{command="say \\"hi\\"\\n"} 1.0', MetricsCollector().render_prometheus_text())
+
+    def test_child_process_reports(self):
+        metrics_q = Queue()
+        collector = MetricsCollector()
+
+        process = Process(target=count_in_child, args=(metrics_q,))
+        process.start()
+        process.join(timeout=5)
+        metrics_q.put(None)
+        collector.receive(metrics_q)
+
+        collected = collector.get_metrics()
+        self.assertEqual(3.0, collected[("child_events_total", ())]["value"])
+        self.assertEqual(([0, 1, 0], 1.5), collected[("child_seconds", ())]["value"])
+
+    def test_metrics_server(self):
+        get_gauge("depth", "Depth").set(2)
+        server = start_metrics_server(MetricsCollector(), port=0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_port}"
+
+        with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+            self.assertIn("depth 2.0", response.read().decode("utf-8"))
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other", timeout=5)
+
+    def test_queue_wait(self):
+        state = QueueState()
+        enqueued_at = {}
+        for event in [{"event": EVENT_ENQUEUE, "queue": "play_q", "id": "a", "item": {"id": "a"}},
+                      {"event": EVENT_DEQUEUE, "queue": "play_q", "id": "a"},
+                      # enqueued before the last start
+                      {"event": EVENT_DEQUEUE, "queue": "play_q", "id": "b"}]:
+            state.apply(event)
+            observe_queue_event(event, enqueued_at, state)
+
+        self.assertEqual(1, sum(get_histogram("bertha2_queue_wait_seconds", "", queue="play_q").counts))
+        self.assertEqual(1, get_gauge("bertha2_queue_items", "", queue="play_q").value)
+        self.assertEqual({}, enqueued_at)
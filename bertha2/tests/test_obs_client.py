@@ -0,0 +1,70 @@
+import time
+from unittest import TestCase
+
+import simpleobsws
+
+from bertha2.tests.fake_obs_websocket import FakeObsWebsocketServer
+from bertha2.utils.obs import ObsClient, create_text_source_request, create_video_source_request
+
+
+class TestObsClient(TestCase):
+    def setUp(self):
+        self.server = FakeObsWebsocketServer().start()
+        self.client = ObsClient(url=self.server.url, min_backoff_s=0.05, max_backoff_s=0.2, timeout_s=2)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_batch_is_one_message_on_one_connection(self):
+        for i in range(3):
+            responses = self.client.call_batch([
+                create_text_source_request("queue", f"Next Up: {i}"),
+                create_text_source_request("current_song", f"Current Video: {i}"),
+                create_video_source_request("playing_video", f"video/{i}.mp4"),
+            ])
+            self.assertEqual([True, True, True], [response.ok() for response in responses])
+
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(1 + 3, self.server.messages)  # identify, then one message per batch
+        self.assertEqual("Current Video: 2", self.server.inputs["current_song"]["text"])
+        self.assertEqual("video/2.mp4", self.server.inputs["playing_video"]["local_file"])
+
+    def test_failed_request_doesnt_stop_the_batch(self):
+        responses = self.client.call_batch([
+            create_text_source_request("missing_source", "text"),
+            create_text_source_request("queue", "Next Up:"),
+        ])
+
+        self.assertEqual([False, True], [response.ok() for response in responses])
+        self.assertEqual("Next Up:", self.server.inputs["queue"]["text"])
+
+    def test_reconnects_after_connection_is_lost(self):
+        self.client.call_batch([create_text_source_request("queue", "before")])
+        self.server.drop_connections()
+        time.sleep(0.1)
+
+        responses = self.client.call_batch([create_text_source_request("queue", "after")])
+
+        self.assertTrue(responses[0].ok())
+        self.assertEqual(2, self.server.connections)
+        self.assertEqual("after", self.server.inputs["queue"]["text"])
+
+    def test_backs_off_while_obs_is_closed(self):
+        self.server.stop()
+        self.client.call_batch([create_text_source_request("queue", "text")])
+
+        start_time = time.perf_counter()
+        responses = self.client.call_batch([create_text_source_request("queue", "text")])
+
+        # the second attempt is skipped, instead of waiting for another connection to fail
+        self.assertEqual([], responses)
+        self.assertLess(time.perf_counter() - start_time, 0.05)
+        self.server = FakeObsWebsocketServer().start()  # for tearDown
+
+    def test_get_input_settings(self):
+        self.client.call_batch([create_text_source_request("queue", "Next Up:")])
+
+        response, = self.client.call_batch([simpleobsws.Request("GetInputSettings", {"inputName": "queue"})])
+
+        self.assertEqual({"text": "Next Up:"}, response.responseData["inputSettings"])
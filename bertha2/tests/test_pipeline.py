@@ -0,0 +1,76 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from bertha2.utils.pipeline import OrderedPipeline
+
+
+def slow_double(value):
+    time.sleep(random.uniform(0, 0.02))
+    return value * 2
+
+
+def fail_on_ten(value):
+    if value == 10:
+        raise ValueError("ten")
+    return value + 1
+
+
+class TestOrderedPipeline(TestCase):
+    def setUp(self):
+        self.executors = [ThreadPoolExecutor(max_workers=4), ThreadPoolExecutor(max_workers=4)]
+        self.published = []
+        self.errors = []
+        self.pipeline = OrderedPipeline(
+            [("double", slow_double, self.executors[0]), ("add one", fail_on_ten, self.executors[1])],
+            lambda item, result: self.published.append((item, result)),
+            lambda item, exception: self.errors.append((item, str(exception))),
+            max_in_flight=4
+        )
+
+    def tearDown(self):
+        for executor in self.executors:
+            executor.shutdown()
+
+    def test_results_are_published_in_order(self):
+        for item in range(20):
+            while not self.pipeline.has_capacity():
+                self.pipeline.wait()
+            self.pipeline.submit(item)
+
+        self.pipeline.join()
+
+        self.assertEqual([(item, item * 2 + 1) for item in range(20) if item != 5], self.published)
+        self.assertEqual([(5, "ten")], self.errors)
+
+    def test_finished_results_wait_for_their_turn(self):
+        self.pipeline.submit(1)
+        self.pipeline.submit_result("cached", "cached result")
+        self.pipeline.join()
+
+        self.assertEqual([(1, 3), ("cached", "cached result")], self.published)
+
+    def test_duplicates_wait_for_the_earlier_item(self):
+        first_future = self.pipeline.submit(1)
+        self.pipeline.submit_after("duplicate", first_future, lambda result: f"reused {result}")
+        failing_future = self.pipeline.submit(5)
+        self.pipeline.submit_after("failing duplicate", failing_future, lambda result: result)
+        self.pipeline.join()
+
+        self.assertEqual([(1, 3), ("duplicate", "reused 3")], self.published)
+        self.assertEqual([(5, "ten"), ("failing duplicate", "ten")], self.errors)
+
+    def test_failed_publish_is_reported(self):
+        def publish(item, result):
+            if item == 2:
+                raise OSError("disk full")
+            self.published.append((item, result))
+
+        self.pipeline.publish_function = publish
+        for item in range(4):
+            self.pipeline.submit(item)
+        self.pipeline.join()
+
+        self.assertEqual([(0, 1), (1, 3), (3, 7)], self.published)
+        self.assertEqual([(2, "disk full")], self.errors)
@@ -0,0 +1,79 @@
+import queue
+import tempfile
+import os
+from unittest import TestCase
+
+from bertha2.utils.journal import QueueJournal
+from bertha2.utils.queue_state import QueueState, QueueStateService, QueueStateSubscriber, record_queue_event, \
+    record_status, forward_queue_events, EVENT_ENQUEUE, EVENT_DEQUEUE, EVENT_COMPLETE, ITEM_QUEUED, ITEM_IN_PROGRESS
+
+
+def create_play_item(item_id):
+    return {"id": item_id, "title": f"video {item_id}", "midi": f"{item_id}.midi", "video": f"{item_id}.mp4"}
+
+
+class TestQueueState(TestCase):
+    def test_completed_items_are_removed(self):
+        state = QueueState()
+        for event in [
+            {"event": EVENT_ENQUEUE, "queue": "play_q", "id": "a", "item": create_play_item("a")},
+            {"event": EVENT_ENQUEUE, "queue": "play_q", "id": "b", "item": create_play_item("b")},
+            {"event": EVENT_ENQUEUE, "queue": "play_q", "id": "c", "item": create_play_item("c")},
+            {"event": EVENT_DEQUEUE, "queue": "play_q", "id": "a"},
+            {"event": EVENT_DEQUEUE, "queue": "play_q", "id": "b"},
+            {"event": EVENT_COMPLETE, "queue": "play_q", "id": "b"},
+        ]:
+            state.apply(event)
+
+        # "a" was dequeued, but never completed
+        self.assertEqual([create_play_item("a"), create_play_item("c")], state.get_items("play_q"))
+        self.assertEqual([("a", ITEM_IN_PROGRESS), ("c", ITEM_QUEUED)],
+                         [(entry["id"], entry["state"]) for entry in state.get_entries("play_q")])
+        self.assertEqual(6, state.version)
+
+    def test_completed_before_enqueued(self):
+        state = QueueState()
+        state.apply({"event": EVENT_COMPLETE, "queue": "link_q", "id": "a"})
+        state.apply({"event": EVENT_ENQUEUE, "queue": "link_q", "id": "a", "item": "https://youtu.be/a"})
+
+        self.assertEqual([], state.get_items("link_q"))
+
+
+class TestQueueStateService(TestCase):
+    def test_subscriber_keeps_an_exact_copy(self):
+        state = QueueState()
+        state.apply({"event": EVENT_ENQUEUE, "queue": "play_q", "id": "a", "item": create_play_item("a")})
+        service = QueueStateService(state)
+        queue_event_q = queue.Queue()
+
+        subscriber = QueueStateSubscriber(service.subscribe())
+        record_queue_event(queue_event_q, EVENT_ENQUEUE, "play_q", create_play_item("b"))
+        record_queue_event(queue_event_q, EVENT_DEQUEUE, "play_q", create_play_item("a"))
+        record_status(queue_event_q, "playing")
+        queue_event_q.put(None)
+
+        with tempfile.TemporaryDirectory() as directory:
+            journal = QueueJournal(os.path.join(directory, "queue_journal.jsonl"))
+            journal.open()
+            forward_queue_events(queue_event_q, journal, service)
+            journal.close()
+            journaled_items = QueueJournal(journal.filename).replay().get_items("play_q")
+
+        changes = 0
+        while subscriber.receive(timeout=1):
+            changes += 1
+            if subscriber.state.version == service.state.version:
+                break
+
+        self.assertEqual(1 + 3, changes)  # the snapshot, then one change for each event
+        self.assertEqual(service.state.version, subscriber.state.version)
+        self.assertEqual(service.state.get_entries("play_q"), subscriber.state.get_entries("play_q"))
+        self.assertEqual("playing", subscriber.state.status)
+        # the status isn't journaled, only what happens to the queues
+        self.assertEqual([create_play_item("b")], journaled_items)
+
+    def test_no_changes(self):
+        subscriber = QueueStateSubscriber(QueueStateService(QueueState()).subscribe())
+
+        self.assertTrue(subscriber.receive(timeout=1))
+        self.assertFalse(subscriber.receive(timeout=0.01))
@@ -0,0 +1,56 @@
+import logging
+import subprocess
+import sys
+from unittest import TestCase
+
+from bertha2.utils.supervisor import resolve_target
+
+
+def import_in_new_interpreter(statement, *args):
+    result = subprocess.run([sys.executable, "-c", statement, *args], capture_output=True, text=True, check=True)
+    return result.stdout.strip()
+
+
+class TestLazySettings(TestCase):
+    def test_import_reads_nothing(self):
+        imported = import_in_new_interpreter(
+            "import sys, bertha2.settings; print(sorted({'argparse', 'dotenv'} & set(sys.modules)))")
+
+        self.assertEqual("[]", imported)
+
+    def test_cli_args_read_on_first_use(self):
+        cli_args = import_in_new_interpreter(
+            "import bertha2.settings as settings; print(tuple(settings.get_cli_args()))",
+            "--virtual_piano", "--log", "debug", "--not_for_bertha")
+
+        self.assertEqual(str((False, True, "debug", False, False, False, False)), cli_args)
+
+    def test_old_names_still_work(self):
+        cli_args = import_in_new_interpreter("from bertha2.settings import cli_args; print(cli_args.disable_hardware)",
+                                             "--disable_hardware")
+
+        self.assertEqual("True", cli_args)
+
+    def test_log_levels_set_when_logging_starts(self):
+        levels = import_in_new_interpreter(
+            "import logging, sys, bertha2.start, bertha2.visuals; "
+            "imported = 'argparse' in sys.modules; "
+            "from bertha2.utils.logs import initialize_root_logger; initialize_root_logger('bertha2.start'); "
+            "print(imported, logging.getLogger('bertha2.visuals').getEffectiveLevel(), "
+            "logging.getLogger('bertha2.chat').getEffectiveLevel())",
+            "--debug_visuals", "--log", "warning")
+
+        self.assertEqual(f"False {logging.DEBUG} {logging.WARNING}", levels)
+
+    def test_subsystems_only_import_what_they_use(self):
+        imported = import_in_new_interpreter(
+            "import sys, bertha2.start, bertha2.visuals; "
+            "print(sorted({'numpy', 'pyppeteer', 'mido', 'bertha2.hardware', 'bertha2.converter'} & set(sys.modules)))")
+
+        self.assertEqual("[]", imported)
+
+
+class TestResolveTarget(TestCase):
+    def test_resolve_target(self):
+        self.assertIs(resolve_target, resolve_target("bertha2.utils.supervisor:resolve_target"))
+        self.assertIs(print, resolve_target(print))
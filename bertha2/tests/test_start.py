@@ -1,79 +1,121 @@
+import json
 import os
+import queue
+import tempfile
 import unittest
-from multiprocessing import Queue
+from unittest import mock
 
-from pytube import Playlist
-from pytube.extract import video_id
+from bertha2 import start
+from bertha2.start import load_queues, create_requeue_function
+from bertha2.utils.journal import QueueJournal
+from bertha2.utils.queue_state import QueueState, QueueStateService, EVENT_ENQUEUE, EVENT_DEQUEUE, EVENT_COMPLETE, \
+    EVENT_SCHEDULE, ITEM_QUEUED
 
-from bertha2.settings import queue_save_file
-from bertha2.start import save_queues, load_queue
 
+def create_request(item_id):
+    return {"id": item_id, "link": f"https://youtu.be/{item_id}"}
 
-def convert_queue_to_list(in_queue):
-    out_list = []
 
-    while in_queue.empty() == False:
-        out_list.append(in_queue.get())
+def create_conversion(item_id):
+    return {"id": item_id, "midi": f"{item_id}.midi", "video": f"{item_id}.mp4"}
 
-    return out_list
 
+def convert_queue_to_list(in_queue, length):
+    # multiprocessing queues can't be compared directly, and empty() can be wrong right after a put
+    return [in_queue.get(timeout=1) for _ in range(length)]
 
-def convert_list_to_queue(in_list):
-    out_q = Queue()
-
-    for i in in_list:
-        out_q.put(i)
-
-    return out_q
-
-
-class TestQueueSave(unittest.TestCase):
-    link_list = []
-    play_list = []
 
+class TestLoadQueues(unittest.TestCase):
     def setUp(self):
-
-        # TODO: safely delete existing saved_queues.json file
-        try:
-            os.remove(f"{queue_save_file}.json")
-        except FileNotFoundError:
-            pass
-
-        # create a mock queue with YouTube links in it
-        yt_arr = Playlist(
-            "https://www.youtube.com/watch?v=q6EoRBvdVPQ&list=PLFsQleAWXsj_4yDeebiIADdH5FMayBiJo").video_urls
-
-        for link in yt_arr:
-            self.link_list.append(link)
-
-        for link in yt_arr:
-            self.play_list.append(f"{video_id(link)}.mp4")
-
-    # ensure that after the queues have been saved and loaded, they're the same.
-    def test_queue_save_and_load(self):
-
-        # mp queues cannot be compared directly, instead they must be converted to lists and compared
-        # create queues from lists
-        link_q_save = convert_list_to_queue(self.link_list)
-        play_q_save = convert_list_to_queue(self.play_list)
-
-        # save queues
-        save_queues(link_q_save, play_q_save)
-
-        # load queues
-        link_q_loaded = load_queue("link_q")
-        play_q_loaded = load_queue("play_q")
-
-        # converted loaded queues into lists
-        link_q_loaded_list = convert_queue_to_list(link_q_loaded)
-        play_q_loaded_list = convert_queue_to_list(play_q_loaded)
-
-        # check they're the same
-        self.assertEqual(link_q_loaded_list, self.link_list)
-        self.assertEqual(play_q_loaded_list, self.play_list)
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal_filename = os.path.join(self.directory.name, "queue_journal.jsonl")
+        self.save_filename = os.path.join(self.directory.name, "saved_queues.json")
+        patcher = mock.patch.object(start, "QUEUE_SAVE_FILENAME", self.save_filename)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def tearDown(self):
-        os.remove(f"{queue_save_file}.json")
+        self.directory.cleanup()
+
+    def write_journal(self, events):
+        journal = QueueJournal(self.journal_filename)
+        journal.replay()
+        journal.open()
+        for event in events:
+            journal.append(event)
+        journal.close()
+
+    def test_queues_are_replayed_from_the_journal(self):
+        self.write_journal([{"event": EVENT_ENQUEUE, "queue": "link_q", "id": str(i), "item": create_request(str(i))}
+                            for i in range(3)] +
+                           [{"event": EVENT_DEQUEUE, "queue": "link_q", "id": "0"},
+                            {"event": EVENT_ENQUEUE, "queue": "play_q", "id": "0", "item": create_conversion("0")},
+                            {"event": EVENT_COMPLETE, "queue": "link_q", "id": "0"}])
+        # left over from before the journal, and ignored now that there is one
+        with open(self.save_filename, "w") as f:
+            json.dump({"link_q": ["https://youtu.be/old"], "play_q": []}, f)
+
+        link_q, play_q = load_queues(QueueJournal(self.journal_filename))
+
+        self.assertEqual([create_request("1"), create_request("2")], convert_queue_to_list(link_q, 2))
+        self.assertEqual([create_conversion("0")], convert_queue_to_list(play_q, 1))
+        self.assertTrue(link_q.empty())
+        self.assertTrue(play_q.empty())
+
+    def test_queues_are_loaded_from_the_saved_queues_without_a_journal(self):
+        links = ["https://youtu.be/a", "https://youtu.be/b"]
+        with open(self.save_filename, "w") as f:
+            json.dump({"link_q": links, "play_q": ["c.mp4"]}, f)
+
+        journal = QueueJournal(self.journal_filename)
+        link_q, play_q = load_queues(journal)
+
+        self.assertEqual(links, convert_queue_to_list(link_q, 2))
+        self.assertEqual(["c.mp4"], convert_queue_to_list(play_q, 1))
+        # the loaded items are in the journal's state, so they're written to it when it's opened
+        self.assertEqual(links, journal.state.get_items("link_q"))
+
+    def test_no_saved_queues(self):
+        link_q, play_q = load_queues(QueueJournal(self.journal_filename))
+
+        self.assertTrue(link_q.empty())
+        self.assertTrue(play_q.empty())
+
+    def test_item_on_both_queues_is_only_played(self):
+        # converted right before a crash, so it wasn't taken off link_q yet
+        self.write_journal([{"event": EVENT_ENQUEUE, "queue": "link_q", "id": "a", "item": create_request("a")},
+                            {"event": EVENT_ENQUEUE, "queue": "link_q", "id": "b", "item": create_request("b")},
+                            {"event": EVENT_DEQUEUE, "queue": "link_q", "id": "a"},
+                            {"event": EVENT_ENQUEUE, "queue": "play_q", "id": "a", "item": create_conversion("a")}])
+
+        journal = QueueJournal(self.journal_filename)
+        link_q, play_q = load_queues(journal)
+
+        self.assertEqual([create_request("b")], convert_queue_to_list(link_q, 1))
+        self.assertEqual([create_conversion("a")], convert_queue_to_list(play_q, 1))
+        self.assertTrue(link_q.empty())
+        self.assertEqual([create_request("b")], journal.state.get_items("link_q"))
+
+
+class TestRequeue(unittest.TestCase):
+    def test_items_are_put_back_once(self):
+        service = QueueStateService(QueueState())
+        for item_id in ["a", "b", "c"]:
+            service.publish({"event": EVENT_ENQUEUE, "queue": "link_q", "id": item_id, "item": create_request(item_id)})
+        service.publish({"event": EVENT_DEQUEUE, "queue": "link_q", "id": "a"})
+        service.publish({"event": EVENT_SCHEDULE, "queue": "link_q", "id": "b", "key": [2, 0.0, 1]})
+        q = queue.Queue()
+        requeue_in_progress_items = create_requeue_function(service, "link_q", q)
+
+        # restarted again before the new process took anything, like a crash loop at startup
+        requeue_in_progress_items()
+        requeue_in_progress_items()
+
+        self.assertEqual([create_request("a"), create_request("b")], [q.get_nowait() for _ in range(q.qsize())])
+        # they're at the end of the queue again, behind the one that was never taken
+        self.assertEqual([("c", ITEM_QUEUED), ("a", ITEM_QUEUED), ("b", ITEM_QUEUED)],
+                         [(entry["id"], entry["state"]) for entry in service.state.get_entries("link_q")])
+        self.assertEqual([], service.get_in_progress_items("link_q"))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,240 @@
+import os
+import queue
+import signal
+import time
+from multiprocessing import Queue, Event
+from unittest import TestCase
+
+from bertha2.utils.queue_state import QueueState, QueueStateService, EVENT_ENQUEUE, EVENT_DEQUEUE
+from bertha2.utils.supervisor import Supervisor, SupervisedProcess, get_from_queue
+
+
+def take_one_item_and_crash(q, taken_q):
+    taken_q.put(q.get())
+    raise RuntimeError("crashed on purpose")
+
+
+def take_items(q, taken_q):
+    while True:
+        taken_q.put(get_from_queue(q))
+
+
+def take_items_without_polling(q, taken_q):
+    while True:
+        taken_q.put(q.get())
+
+
+def take_items_until_stopped(stop_e, q, taken_q):
+    while not stop_e.is_set():
+        try:
+            taken_q.put(get_from_queue(q, timeout=0.1))
+        except queue.Empty:
+            pass
+
+
+def run_forever():
+    while True:
+        time.sleep(1)
+
+
+def freeze(started_q):
+    started_q.put(os.getpid())
+    time.sleep(0.2)  # lets the heartbeat thread beat once
+    os.kill(os.getpid(), signal.SIGSTOP)
+
+
+def supervise_until(supervisor, condition, timeout_s=5):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        supervisor.check()
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def stop(supervisor):
+    for supervised_process in supervisor.supervised_processes:
+        if supervised_process.is_alive():
+            supervised_process.process.kill()
+            supervised_process.process.join()
+
+
+class TestSupervisor(TestCase):
+    def test_crashed_process_is_restarted_with_its_queue(self):
+        q = Queue()
+        taken_q = Queue()
+        for i in range(5):
+            q.put(i)
+
+        crashing_p = SupervisedProcess("crashing", take_one_item_and_crash, lambda: (q, taken_q))
+        supervisor = Supervisor([crashing_p], min_backoff_s=0.01, max_backoff_s=0.01)
+        supervisor.start()
+        try:
+            self.assertTrue(supervise_until(supervisor, lambda: crashing_p.restarts >= 3))
+        finally:
+            stop(supervisor)
+
+        # every restart read from the same queue, one item at a time
+        taken = [taken_q.get(timeout=1) for _ in range(3)]
+        self.assertEqual([0, 1, 2], taken)
+        self.assertLess(crashing_p.last_restart_duration_s, 1)
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        crashing_p = SupervisedProcess("crashing", os._exit, lambda: (1,))
+        supervisor = Supervisor([crashing_p], min_backoff_s=0.01, max_backoff_s=0.04)
+        supervisor.start()
+
+        backoffs = []
+        try:
+            for _ in range(5):
+                restarts = crashing_p.restarts
+                self.assertTrue(supervise_until(supervisor, lambda: crashing_p.restarts > restarts))
+                backoffs.append(crashing_p.backoff_s)
+        finally:
+            stop(supervisor)
+
+        # the first restart is immediate
+        self.assertEqual([0.01, 0.02, 0.04, 0.04, 0.04], backoffs)
+
+    def test_frozen_process_is_restarted(self):
+        started_q = Queue()
+        frozen_p = SupervisedProcess("frozen", freeze, lambda: (started_q,), heartbeat_timeout_s=0.5,
+                                     stop_timeout_s=0.1)
+        supervisor = Supervisor([frozen_p])
+        supervisor.start()
+        try:
+            first_pid = started_q.get(timeout=5)
+            self.assertTrue(supervise_until(supervisor, lambda: frozen_p.restarts == 1))
+            self.assertNotEqual(first_pid, started_q.get(timeout=5))
+        finally:
+            stop(supervisor)
+
+    def test_on_restart_is_called_before_restarting(self):
+        calls = []
+        crashing_p = SupervisedProcess("crashing", os._exit, lambda: (1,), on_restart=lambda: calls.append("restart"))
+        supervisor = Supervisor([crashing_p])
+        supervisor.start()
+        try:
+            self.assertTrue(supervise_until(supervisor, lambda: crashing_p.restarts == 1))
+        finally:
+            stop(supervisor)
+
+        self.assertEqual(["restart"], calls)
+
+    def test_report(self):
+        running_p = SupervisedProcess("running", run_forever, lambda: ())
+        supervisor = Supervisor([running_p])
+        supervisor.start()
+        try:
+            supervisor.check()
+            time.sleep(0.1)
+            report = supervisor.get_report()
+        finally:
+            stop(supervisor)
+
+        self.assertTrue(report["processes"]["running"]["alive"])
+        self.assertEqual(0, report["processes"]["running"]["restarts"])
+        self.assertGreater(report["processes"]["running"]["uptime_s"], 0)
+        self.assertGreaterEqual(report["uptime_s"], report["processes"]["running"]["uptime_s"])
+
+
+class TestStoppingProcesses(TestCase):
+    def assert_restarted_process_takes_items(self, supervisor, supervised_process, q, taken_q):
+        self.assertTrue(supervise_until(supervisor, lambda: supervised_process.restarts == 1))
+        q.put("after restart")
+        self.assertEqual("after restart", taken_q.get(timeout=5))
+
+    def test_killed_process_does_not_keep_its_queue(self):
+        q = Queue()
+        taken_q = Queue()
+        taking_p = SupervisedProcess("taking", take_items, lambda: (q, taken_q))
+        supervisor = Supervisor([taking_p], min_backoff_s=0.01, max_backoff_s=0.01)
+        supervisor.start()
+        try:
+            q.put("before kill")
+            self.assertEqual("before kill", taken_q.get(timeout=5))
+            time.sleep(0.2)  # waiting in get_from_queue again
+            taking_p.process.kill()
+
+            self.assert_restarted_process_takes_items(supervisor, taking_p, q, taken_q)
+        finally:
+            stop(supervisor)
+
+    def test_terminated_process_lets_go_of_its_queue(self):
+        q = Queue()
+        taken_q = Queue()
+        taking_p = SupervisedProcess("taking", take_items_without_polling, lambda: (q, taken_q), stop_timeout_s=1)
+        supervisor = Supervisor([taking_p], min_backoff_s=0.01, max_backoff_s=0.01)
+        supervisor.start()
+        try:
+            q.put("before stop")
+            self.assertEqual("before stop", taken_q.get(timeout=5))
+            time.sleep(0.2)  # blocked in Queue.get, holding its reader lock
+            taking_p.stop()
+            self.assertEqual(128 + signal.SIGTERM, taking_p.process.exitcode)
+
+            self.assert_restarted_process_takes_items(supervisor, taking_p, q, taken_q)
+        finally:
+            stop(supervisor)
+
+    def test_process_stops_by_itself_first(self):
+        stop_e = Event()
+        q = Queue()
+        taken_q = Queue()
+        taking_p = SupervisedProcess("taking", take_items_until_stopped, lambda: (stop_e, q, taken_q),
+                                     stop_event=stop_e, stop_timeout_s=5)
+        supervisor = Supervisor([taking_p], min_backoff_s=0.01, max_backoff_s=0.01)
+        supervisor.start()
+        try:
+            q.put("before stop")
+            self.assertEqual("before stop", taken_q.get(timeout=5))
+            taking_p.stop()
+            self.assertEqual(0, taking_p.process.exitcode)
+
+            # the stop event is cleared for the restarted process
+            self.assert_restarted_process_takes_items(supervisor, taking_p, q, taken_q)
+        finally:
+            stop(supervisor)
+
+    def test_frozen_process_is_killed(self):
+        started_q = Queue()
+        frozen_p = SupervisedProcess("frozen", freeze, lambda: (started_q,), stop_timeout_s=0.1)
+        supervisor = Supervisor([frozen_p])
+        supervisor.start()
+        try:
+            started_q.get(timeout=5)
+            time.sleep(0.3)
+            frozen_p.stop()
+            self.assertEqual(-signal.SIGKILL, frozen_p.process.exitcode)
+        finally:
+            stop(supervisor)
+
+    def test_get_from_queue_times_out(self):
+        q = Queue()
+        start_time = time.monotonic()
+        with self.assertRaises(queue.Empty):
+            get_from_queue(q, timeout=0.1)
+        self.assertLess(time.monotonic() - start_time, 1)
+
+        q.put("a")
+        self.assertEqual("a", get_from_queue(q, timeout=5))
+
+
+class TestQueueStateServiceRestarts(TestCase):
+    def test_in_progress_items(self):
+        state = QueueState()
+        for item_id in ["a", "b", "c"]:
+            state.apply({"event": EVENT_ENQUEUE, "queue": "link_q", "id": item_id, "item": item_id})
+        state.apply({"event": EVENT_DEQUEUE, "queue": "link_q", "id": "b"})
+
+        self.assertEqual(["b"], QueueStateService(state).get_in_progress_items("link_q"))
+
+    def test_unsubscribe(self):
+        service = QueueStateService(QueueState())
+        subscription_q = service.subscribe()
+        service.unsubscribe(subscription_q)
+        service.publish({"event": EVENT_ENQUEUE, "queue": "link_q", "id": "a", "item": "a"})
+
+        self.assertEqual("snapshot", subscription_q.get(timeout=1)[0])
+        self.assertTrue(subscription_q.empty())
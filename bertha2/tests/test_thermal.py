@@ -0,0 +1,144 @@
+import math
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from bertha2.utils.thermal import ThermalModel, measure_song_heat
+
+TIME_CONSTANT_S = 60
+HEAT_LIMIT = 15
+
+
+def create_held_note(address, start_time, hold_time, pwm_value=255):
+    return [(start_time, address, pwm_value), (start_time + hold_time, address, 0)]
+
+
+def create_song(*notes):
+    transitions = sorted(transition for note in notes for transition in note)
+    return [list(column) for column in zip(*transitions)]
+
+
+def simulate_peak_heat(starting_heat, times, addresses, pwm_values, step_s=0.01):
+    # steps through the song instead of solving it, to check the model against
+    heat = list(starting_heat)
+    duty = [0.0] * len(heat)
+    peak = max(heat)
+    transitions = list(zip(times, addresses, pwm_values))
+    now = 0.0
+    while transitions or any(duty):
+        while transitions and transitions[0][0] <= now:
+            _, address, pwm_value = transitions.pop(0)
+            duty[address] = pwm_value / 255
+        heat = [h + (d - h / TIME_CONSTANT_S) * step_s for h, d in zip(heat, duty)]
+        peak = max(peak, max(heat))
+        now += step_s
+    return peak
+
+
+class TestThermalModel(TestCase):
+    def setUp(self):
+        self.model = ThermalModel(4, time_constant_s=TIME_CONSTANT_S, heat_limit=HEAT_LIMIT, max_cooldown_s=30)
+
+    def test_heat_of_a_held_note(self):
+        song_heat = measure_song_heat(*create_song(create_held_note(1, 0.0, 10.0, 255)), 4,
+                                      time_constant_s=TIME_CONSTANT_S, heat_limit=HEAT_LIMIT)
+
+        expected_heat = TIME_CONSTANT_S * (1 - math.exp(-10 / TIME_CONSTANT_S))
+        self.assertAlmostEqual(expected_heat, song_heat["end_heat"][1])
+        self.assertEqual([0, 0, 0], [song_heat["end_heat"][address] for address in (0, 2, 3)])
+        # unused solenoids can start at any heat
+        self.assertEqual(math.inf, song_heat["margins"][0])
+        self.assertAlmostEqual((HEAT_LIMIT - expected_heat) * math.exp(10 / TIME_CONSTANT_S), song_heat["margins"][1])
+
+    def test_cold_solenoids_need_no_cooldown(self):
+        song_heat = self.model.measure_song_heat(*create_song(create_held_note(1, 0.0, 10.0)))
+
+        self.assertEqual(0, self.model.get_cooldown_s(song_heat, now=self.model.updated_at))
+
+    def test_cooldown_keeps_the_next_song_under_the_limit(self):
+        song = create_song(create_held_note(1, 0.0, 10.0), create_held_note(2, 5.0, 2.0))
+        song_heat = self.model.measure_song_heat(*song)
+        self.model.add_song(song_heat, start_time=0.0)
+
+        cooldown_s = self.model.get_cooldown_s(song_heat, now=song_heat["duration_s"])
+
+        self.assertGreater(cooldown_s, 0)
+        self.assertLess(cooldown_s, 30)
+        starting_heat = self.model.get_heat(song_heat["duration_s"] + cooldown_s)
+        self.assertLessEqual(simulate_peak_heat(starting_heat, *song), HEAT_LIMIT + 0.01)
+        # a moment sooner would have gone over
+        starting_heat = self.model.get_heat(song_heat["duration_s"] + cooldown_s - 1)
+        self.assertGreater(simulate_peak_heat(starting_heat, *song), HEAT_LIMIT)
+
+    def test_song_on_cool_keys_starts_straight_away(self):
+        song_heat = self.model.measure_song_heat(*create_song(create_held_note(1, 0.0, 10.0)))
+        self.model.add_song(song_heat, start_time=0.0)
+
+        other_song_heat = self.model.measure_song_heat(*create_song(create_held_note(3, 0.0, 10.0)))
+
+        self.assertEqual(0, self.model.get_cooldown_s(other_song_heat, now=song_heat["duration_s"]))
+
+    def test_song_too_hot_for_cold_solenoids(self):
+        song_heat = self.model.measure_song_heat(*create_song(create_held_note(0, 0.0, 60.0)))
+
+        self.assertEqual(30, self.model.get_cooldown_s(song_heat, now=self.model.updated_at))
+
+    def test_song_stopped_early(self):
+        song = create_song(create_held_note(1, 0.0, 10.0))
+        song_heat = self.model.measure_song_heat(*song, end_time=4.0)
+
+        self.assertEqual(4.0, song_heat["duration_s"])
+        self.assertAlmostEqual(TIME_CONSTANT_S * (1 - math.exp(-4 / TIME_CONSTANT_S)), song_heat["end_heat"][1])
+
+
+class TestSavedHeat(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.filename = os.path.join(self.directory.name, "solenoid_heat.json")
+
+    def create_model(self):
+        return ThermalModel(4, time_constant_s=TIME_CONSTANT_S, heat_limit=HEAT_LIMIT, max_cooldown_s=30,
+                            filename=self.filename)
+
+    def test_heat_is_kept_after_a_restart(self):
+        model = self.create_model()
+        song_heat = model.measure_song_heat(*create_song(create_held_note(1, 0.0, 10.0)))
+        model.add_song(song_heat, start_time=time.monotonic() - song_heat["duration_s"])
+        model.save()
+
+        restarted_model = self.create_model()
+
+        self.assertTrue(restarted_model.is_heat_known)
+        now = time.monotonic()
+        self.assertAlmostEqual(model.get_heat(now)[1], restarted_model.get_heat(now)[1], places=2)
+        self.assertAlmostEqual(model.get_cooldown_s(song_heat, now), restarted_model.get_cooldown_s(song_heat, now),
+                               places=2)
+
+    def test_song_stopped_by_a_restart_is_counted_whole(self):
+        model = self.create_model()
+        song_heat = model.measure_song_heat(*create_song(create_held_note(1, 0.0, 10.0)))
+        start_time = time.monotonic()
+        model.save(song_heat, start_time)
+
+        # killed during the song, before add_song
+        restarted_model = self.create_model()
+
+        end_heat = song_heat["end_heat"][1]
+        self.assertAlmostEqual(end_heat, restarted_model.get_heat(start_time + song_heat["duration_s"])[1], places=2)
+
+    def test_no_saved_heat_gets_the_full_cooldown(self):
+        model = self.create_model()
+        song_heat = model.measure_song_heat(*create_song(create_held_note(1, 0.0, 10.0)))
+
+        self.assertFalse(model.is_heat_known)
+        self.assertEqual(30, model.get_cooldown_s(song_heat))
+        model.add_song(song_heat, start_time=time.monotonic())
+        self.assertLess(model.get_cooldown_s(song_heat), 30)
+
+    def test_saved_heat_of_other_solenoids_is_ignored(self):
+        with open(self.filename, "w") as f:
+            f.write('{"heat": [1.0, 2.0], "updated_at": 0}')
+
+        self.assertFalse(self.create_model().is_heat_known)
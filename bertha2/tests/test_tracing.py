@@ -0,0 +1,108 @@
+import os
+import queue
+import tempfile
+from unittest import TestCase
+
+from bertha2.utils.journal import QueueJournal
+from bertha2.utils.queue_state import QueueState, QueueStateService, forward_queue_events, record_trace, \
+    EVENT_ENQUEUE, EVENT_DEQUEUE, EVENT_COMPLETE
+from bertha2.utils.tracing import TraceLog, read_spans, get_stage_durations, format_report, \
+    REQUEST_TO_PLAYBACK_STAGE
+
+
+def create_queue_event(event, queue_name, item_id, event_time):
+    queue_event = {"event": event, "queue": queue_name, "id": item_id, "time": event_time}
+    if event == EVENT_ENQUEUE:
+        queue_event["item"] = {"id": item_id}
+    return queue_event
+
+
+def create_trace(item_id, offset=0.0):
+    # one video going from chat to the end of its playback
+    return [
+        {"event": "trace", "id": item_id, "stage": "chat", "start": offset + 0.0, "end": offset + 1.0},
+        create_queue_event(EVENT_ENQUEUE, "link_q", item_id, offset + 1.0),
+        create_queue_event(EVENT_DEQUEUE, "link_q", item_id, offset + 3.0),
+        {"event": "trace", "id": item_id, "stage": "download", "start": offset + 3.0, "end": offset + 13.0},
+        create_queue_event(EVENT_ENQUEUE, "play_q", item_id, offset + 20.0),
+        create_queue_event(EVENT_COMPLETE, "link_q", item_id, offset + 20.0),
+        create_queue_event(EVENT_DEQUEUE, "play_q", item_id, offset + 50.0),
+        {"event": "trace", "id": item_id, "stage": "playback", "start": offset + 60.0, "end": offset + 120.0},
+        create_queue_event(EVENT_COMPLETE, "play_q", item_id, offset + 120.0),
+    ]
+
+
+class TestTraceLog(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, "traces.jsonl")
+
+    def write_events(self, events, max_bytes=10 ** 6):
+        trace_log = TraceLog(self.filename, max_bytes=max_bytes)
+        trace_log.open()
+        for event in events:
+            trace_log.observe(event)
+        trace_log.close()
+
+    def test_spans_from_queue_events(self):
+        self.write_events(create_trace("a") + [{"event": "status", "status": "playing"}])
+
+        spans = {span["stage"]: (span["start"], span["end"]) for span in read_spans([self.filename])}
+        self.assertEqual({
+            "chat": (0.0, 1.0),
+            "link_q_wait": (1.0, 3.0),
+            "download": (3.0, 13.0),
+            "link_q_work": (3.0, 20.0),
+            "play_q_wait": (20.0, 50.0),
+            "playback": (60.0, 120.0),
+            "play_q_work": (50.0, 120.0),
+        }, spans)
+
+    def test_events_without_times_are_skipped(self):
+        # e.g. the dequeue of an item that was queued before the last start
+        self.write_events([{"event": EVENT_DEQUEUE, "queue": "play_q", "id": "a"},
+                           create_queue_event(EVENT_DEQUEUE, "play_q", "b", 1.0),
+                           create_queue_event(EVENT_COMPLETE, "play_q", "b", 2.0)])
+
+        self.assertEqual([], read_spans([self.filename]))
+
+    def test_rotates_full_log(self):
+        self.write_events(create_trace("a") + create_trace("b"), max_bytes=600)
+
+        self.assertTrue(os.path.exists(self.filename + ".1"))
+        self.assertEqual(14, len(read_spans([self.filename + ".1", self.filename])))
+
+    def test_stage_durations(self):
+        self.write_events(create_trace("a") + create_trace("b", offset=1000.0))
+
+        durations = get_stage_durations(read_spans([self.filename]))
+
+        self.assertEqual([10.0, 10.0], durations["download"])
+        self.assertEqual([30.0, 30.0], durations["play_q_wait"])
+        # from the !play to the playback starting
+        self.assertEqual([60.0, 60.0], durations[REQUEST_TO_PLAYBACK_STAGE])
+        # the stages that take longest first
+        report_stages = [line.split()[0] for line in format_report(durations).split("\n")[1:]]
+        self.assertEqual("play_q_work", report_stages[0])
+        self.assertLess(report_stages.index(REQUEST_TO_PLAYBACK_STAGE), report_stages.index("play_q_wait"))
+
+    def test_forwarded_traces_are_not_published(self):
+        queue_event_q = queue.Queue()
+        service = QueueStateService(QueueState())
+        subscription_q = service.subscribe()
+        record_trace(queue_event_q, {"id": "a"}, "download", 1.0, 2.0)
+        queue_event_q.put(None)
+
+        with tempfile.TemporaryDirectory() as directory:
+            journal = QueueJournal(os.path.join(directory, "queue_journal.jsonl"))
+            journal.open()
+            trace_log = TraceLog(self.filename)
+            trace_log.open()
+            forward_queue_events(queue_event_q, journal, service, trace_log)
+            trace_log.close()
+            journal.close()
+
+        self.assertEqual([{"id": "a", "stage": "download", "start": 1.0, "end": 2.0}], read_spans([self.filename]))
+        self.assertEqual("snapshot", subscription_q.get(timeout=1)[0])
+        self.assertTrue(subscription_q.empty())
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import tracemalloc
+from unittest import TestCase
+
+import mido
+import numpy as np
+
+from bertha2.settings import STARTING_NOTE, NUMBER_OF_NOTES
+from bertha2.utils.transcription import transcribe_samples, write_midi_file, TranscriptionBackend, \
+    SampleTranscriptionBackend
+
+SAMPLE_RATE = 22050
+
+
+def synthesize_tone(note, duration, sample_rate=SAMPLE_RATE):
+    # a decaying tone with a few harmonics, faded out at the end so it doesn't click
+    t = np.arange(int(sample_rate * duration)) / sample_rate
+    frequency = 440 * 2 ** ((note - 69) / 12)
+    envelope = np.exp(-2 * t) * np.minimum(1, (duration - t) / 0.02)
+    return 0.5 * envelope * sum(0.6 ** k * np.sin(2 * np.pi * frequency * (k + 1) * t) for k in range(4))
+
+
+class TestTranscribeSamples(TestCase):
+    def test_melody(self):
+        samples = np.concatenate([synthesize_tone(60, 0.5), synthesize_tone(64, 0.5), synthesize_tone(67, 0.5)])
+
+        notes = transcribe_samples(samples, SAMPLE_RATE)
+
+        self.assertEqual([60, 64, 67], [note[0] for note in notes])
+        for (_, start_time, velocity, duration), expected_start_time in zip(notes, [0.0, 0.5, 1.0]):
+            self.assertAlmostEqual(expected_start_time, start_time, delta=0.1)
+            self.assertTrue(1 <= velocity <= 127)
+            self.assertGreater(duration, 0.2)
+
+    def test_chord(self):
+        notes = transcribe_samples(synthesize_tone(45, 0.6) + synthesize_tone(72, 0.6), SAMPLE_RATE)
+
+        self.assertEqual({45, 72}, {note[0] for note in notes})
+
+    def test_only_playable_notes(self):
+        # the lowest and highest notes on a piano are out of Bertha2's range
+        samples = np.concatenate([synthesize_tone(24, 0.5), synthesize_tone(100, 0.5), synthesize_tone(60, 0.5)])
+
+        for note in transcribe_samples(samples, SAMPLE_RATE):
+            self.assertTrue(STARTING_NOTE <= note[0] < STARTING_NOTE + NUMBER_OF_NOTES)
+
+    def test_silence(self):
+        self.assertEqual([], transcribe_samples(np.zeros(SAMPLE_RATE), SAMPLE_RATE))
+
+    def test_memory_does_not_grow_with_length(self):
+        # several converter workers transcribe at once, so a long video can't take much more memory than a short one
+        def measure_peak_bytes(seconds):
+            samples = np.tile(synthesize_tone(60, 1.0).astype(np.float32), seconds)
+            tracemalloc.start()
+            try:
+                transcribe_samples(samples, SAMPLE_RATE)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        short_peak_bytes = measure_peak_bytes(20)
+        long_peak_bytes = measure_peak_bytes(360)
+
+        self.assertLess(long_peak_bytes, 64 * 1024 ** 2)
+        self.assertLess(long_peak_bytes - short_peak_bytes, 16 * 1024 ** 2)
+
+
+class TestTranscriptionBackend(TestCase):
+    def test_backends_have_to_transcribe(self):
+        class IncompleteBackend(SampleTranscriptionBackend):
+            def transcribe(self, audio_filename, midi_filename):
+                pass
+
+        with self.assertRaises(TypeError):
+            TranscriptionBackend()
+        with self.assertRaises(TypeError):
+            IncompleteBackend()
+
+
+class TestWriteMidiFile(TestCase):
+    def test_write_midi_file(self):
+        notes = [(60, 0.0, 100, 0.5), (64, 0.5, 90, 0.5), (67, 0.5, 80, 1.0)]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            midi_filename = os.path.join(temp_dir, "test.midi")
+            write_midi_file(notes, midi_filename)
+            midi_file = mido.MidiFile(midi_filename)
+
+        messages = [msg for msg in mido.merge_tracks(midi_file.tracks) if msg.type in ("note_on", "note_off")]
+        self.assertEqual(6, len(messages))
+        self.assertAlmostEqual(1.5, midi_file.length, places=2)
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from bertha2.settings import MAX_VIDEO_LENGTH_SECONDS
+from bertha2.utils.video_metadata import VideoMetadataCache, get_invalid_reason
+
+LINK = "https://www.youtube.com/watch?v=B_i743apHLs"
+
+
+def create_metadata(**changes):
+    metadata = {
+        "video_id": "B_i743apHLs",
+        "title": "Take Five",
+        "length": 120,
+        "age_restricted": False,
+        "available": True,
+        "unavailable_reason": None,
+    }
+    metadata.update(changes)
+    return metadata
+
+
+class CountingFetcher:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, link):
+        self.calls += 1
+        return create_metadata()
+
+
+class TestGetInvalidReason(TestCase):
+    def test_valid(self):
+        self.assertIsNone(get_invalid_reason(create_metadata()))
+
+    def test_invalid(self):
+        self.assertIn("unavailable", get_invalid_reason(create_metadata(available=False, unavailable_reason="private")))
+        self.assertIn("age restricted", get_invalid_reason(create_metadata(age_restricted=True)))
+        self.assertIn("too long", get_invalid_reason(create_metadata(length=MAX_VIDEO_LENGTH_SECONDS)))
+
+
+class TestVideoMetadataCache(TestCase):
+    def test_fetches_once_per_video(self):
+        fetcher = CountingFetcher()
+        cache = VideoMetadataCache(filename=None, fetch_function=fetcher)
+
+        cache.get_or_fetch(LINK)
+        metadata = cache.get_or_fetch("https://youtu.be/B_i743apHLs")
+
+        self.assertEqual("Take Five", metadata["title"])
+        self.assertEqual(1, fetcher.calls)
+
+    def test_entries_expire(self):
+        fetcher = CountingFetcher()
+        cache = VideoMetadataCache(filename=None, ttl_s=60, fetch_function=fetcher)
+
+        cache.get_or_fetch(LINK)
+        cache.entries["B_i743apHLs"]["fetched_at"] = time.time() - 61
+
+        self.assertIsNone(cache.get(LINK))
+        cache.get_or_fetch(LINK)
+        self.assertEqual(2, fetcher.calls)
+
+    def test_shared_through_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "video_metadata.json")
+            reading_cache = VideoMetadataCache(filename=filename, fetch_function=CountingFetcher())
+            VideoMetadataCache(filename=filename, fetch_function=CountingFetcher()).get_or_fetch(LINK)
+
+            self.assertEqual("Take Five", reading_cache.get(LINK)["title"])
@@ -1,10 +1,20 @@
+import copy
 import inspect
 import unittest
 from unittest import TestCase, skip
 from multiprocessing import Pipe
 
-from bertha2.settings import visuals_nonempty_queue_header_message, visuals_empty_queue_next_up_message
+from bertha2.settings import VISUALS_NONEMPTY_QUEUE_HEADER_MESSAGE as visuals_nonempty_queue_header_message, \
+    VISUALS_EMPTY_QUEUE_NEXT_UP_MESSAGE as visuals_empty_queue_next_up_message, \
+    DEFAULT_VISUALS_STATE as default_visuals_state
 from bertha2.visuals import *
+from bertha2.tests.fake_obs_websocket import FakeObsWebsocketServer
+from bertha2.utils import obs
+from bertha2.utils.queue_state import QueueState, QueueStateService, QueueStateSubscriber, EVENT_ENQUEUE, \
+    EVENT_DEQUEUE, EVENT_STATUS
+import bertha2.visuals as visuals
+
+initial_visuals_state = copy.deepcopy(default_visuals_state)
 
 if __name__ == '__main__':
     unittest.main()
@@ -19,6 +29,25 @@ class TestVisualsStatelessFunctions(TestCase):
         self.assertEqual("This is such a ****ing waste of my time, I...", process_title(
             "This is such a fucking waste of my time, I have better things to do than deal with this bullshit."))
 
+    def test_filter_cuss_words_from_title(self):
+        pattern = compile_cuss_word_pattern(["darn", "heck", "heckin", "", "d.rn"])
+
+        self.assertEqual("What the ****, that's ****ing great", filter_cuss_words_from_title(
+            "What the HECK, that's Darning great", pattern))
+        self.assertEqual("****! **** **** ****", filter_cuss_words_from_title("heckin! heck D.RN darn", pattern))
+        self.assertEqual("Checkmate, adarn", filter_cuss_words_from_title("Checkmate, adarn", pattern))
+
+    def test_clean_words_that_start_with_a_cuss_word(self):
+        pattern = compile_cuss_word_pattern(["ass", "hell"])
+
+        self.assertEqual("I assume it's a classic, hello", filter_cuss_words_from_title(
+            "I assume it's a classic, hello", pattern))
+        self.assertEqual("****es and ****, what the ****s", filter_cuss_words_from_title(
+            "asses and hell, what the hells", pattern))
+
+    def test_compile_cuss_word_pattern_empty(self):
+        self.assertIsNone(compile_cuss_word_pattern(["", "  "]))
+
     @skip("undeveloped test case")
     def test_create_playing_next_string(self):
 
@@ -180,4 +209,75 @@ class TestVisualsStates2(TestCase):
             })
             visuals_process_loop([cv_child_conn, hv_child_conn])
 
-        self.assertEqual(n, len(visuals_state["queued_video_metadata_objects"]))
\ No newline at end of file
+        self.assertEqual(n, len(visuals_state["queued_video_metadata_objects"]))
+
+class TestRenderLoop(TestCase):
+    def setUp(self):
+        self.server = FakeObsWebsocketServer().start()
+        obs.obs_client = obs.ObsClient(url=self.server.url)
+
+        visuals.visuals_state.clear()
+        visuals.visuals_state.update(copy.deepcopy(initial_visuals_state))
+        visuals.displayed_obs_sources.clear()
+        for key in visuals.render_stats:
+            visuals.render_stats[key] = 0
+
+    def tearDown(self):
+        obs.obs_client.close()
+        obs.obs_client = None
+        self.server.stop()
+
+    def test_burst_is_one_render(self):
+        service = QueueStateService(QueueState())
+        subscriber = QueueStateSubscriber(service.subscribe())
+        subscriber.receive()
+
+        for i in range(20):
+            item = {"id": str(i), "title": f"video {i}", "midi": f"{i}.midi", "video": f"not/real/{i}.mp4"}
+            service.publish({"event": EVENT_ENQUEUE, "queue": "play_q", "id": item["id"], "item": item})
+        service.publish({"event": EVENT_DEQUEUE, "queue": "play_q", "id": "0"})
+        service.publish({"event": EVENT_STATUS, "status": "playing"})
+
+        visuals_process_loop(subscriber, frame_window_s=0.2)
+
+        self.assertEqual(22, visuals.render_stats["state_changes"])
+        self.assertEqual(1, visuals.render_stats["renders"])
+        self.assertEqual(1 + 1, self.server.messages)  # identify, then one batch
+        self.assertEqual("Current Video: video 0", self.server.inputs["current_song"]["text"])
+        self.assertEqual("not/real/0.mp4", self.server.inputs["playing_video"]["local_file"])
+        self.assertIn("1. video 1\n", self.server.inputs["queue"]["text"])
+
+    def test_unchanged_sources_are_suppressed(self):
+        state = QueueState()
+        update_visuals_state_from_queue_state(state)
+        update_onscreen_visuals_from_state()
+        self.assertEqual(3, visuals.render_stats["sent"])
+
+        # nothing on screen changes
+        state.apply({"event": EVENT_STATUS, "status": "waiting"})
+        update_visuals_state_from_queue_state(state)
+        update_onscreen_visuals_from_state()
+
+        self.assertEqual(3, visuals.render_stats["sent"])
+        self.assertEqual(3, visuals.render_stats["suppressed"])
+
+        # the status text and the video change, next up still says nothing is queued
+        item = {"id": "a", "title": "video", "midi": "a.midi", "video": "not/real/path"}
+        state.apply({"event": EVENT_ENQUEUE, "queue": "play_q", "id": "a", "item": item})
+        state.apply({"event": EVENT_STATUS, "status": "playing"})
+        update_visuals_state_from_queue_state(state)
+        update_onscreen_visuals_from_state()
+
+        self.assertEqual(3 + 2, visuals.render_stats["sent"])
+        self.assertEqual(3 + 1, visuals.render_stats["suppressed"])
+        self.assertEqual("not/real/path", self.server.inputs["playing_video"]["local_file"])
+        self.assertEqual(1 + 2, self.server.messages)  # identify, then one batch for each render that changed
+
+    def test_cooldown_length_comes_from_the_hardware(self):
+        state = QueueState()
+        state.apply({"event": EVENT_STATUS, "status": "cooldown", "cooldown_s": 7.2})
+        update_visuals_state_from_queue_state(state)
+        update_onscreen_visuals_from_state()
+
+        self.assertEqual("Bertha2 is cooling down for the next 8 seconds, please wait.",
+                         self.server.inputs["current_song"]["text"])
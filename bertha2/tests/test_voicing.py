@@ -0,0 +1,69 @@
+from unittest import TestCase
+
+from bertha2.utils.envelope import EnvelopeTable, DEFAULT_PROFILE
+from bertha2.utils.voicing import arrange_notes, get_octave_candidates
+
+NUMBER_OF_NOTES = 48
+# at full velocity, a note draws 150 / 255 of a solenoid at full power, then 50 / 255 once it's held
+PEAK_CURRENT = 150 / 255
+
+
+def create_envelope_table():
+    return EnvelopeTable([dict(DEFAULT_PROFILE) for _ in range(NUMBER_OF_NOTES)])
+
+
+def arrange(notes, max_polyphony=NUMBER_OF_NOTES, current_budget=NUMBER_OF_NOTES):
+    return arrange_notes(notes, create_envelope_table(), NUMBER_OF_NOTES, max_polyphony=max_polyphony,
+                         current_budget=current_budget, duplicate_window_s=0.01)
+
+
+class TestFolding(TestCase):
+    def test_octave_candidates(self):
+        self.assertEqual([47, 35, 23, 11], get_octave_candidates(59, NUMBER_OF_NOTES))
+        self.assertEqual([10, 22, 34, 46], get_octave_candidates(-2, NUMBER_OF_NOTES))
+
+    def test_notes_are_folded_to_the_nearest_octave(self):
+        notes, stats = arrange([(-2, 0.0, 100, 0.5), (50, 1.0, 100, 0.5), (20, 2.0, 100, 0.5)])
+
+        self.assertEqual([10, 38, 20], [note[0] for note in notes])
+        self.assertEqual(2, stats["folded"])
+
+    def test_folded_note_avoids_a_sounding_key(self):
+        # 47 is held, so 59 is folded one octave further down instead of merging with it
+        notes, stats = arrange([(47, 0.0, 100, 1.0), (59, 0.0, 100, 1.0)])
+
+        self.assertEqual([47, 35], sorted((note[0] for note in notes), reverse=True))
+        self.assertEqual(0, stats["merged"])
+
+    def test_duplicate_notes_are_merged(self):
+        notes, stats = arrange([(5, 0.0, 60, 0.2), (5, 0.005, 100, 0.5), (5, 1.0, 100, 0.5)])
+
+        self.assertEqual([(5, 0.0, 100, 0.505), (5, 1.0, 100, 0.5)], [(*note[:3], round(note[3], 6)) for note in notes])
+        self.assertEqual(1, stats["merged"])
+
+
+class TestPolyphony(TestCase):
+    def test_oldest_note_is_stolen(self):
+        notes, stats = arrange([(1, 0.0, 100, 2.0), (2, 0.5, 100, 2.0), (3, 1.0, 100, 2.0)], max_polyphony=2)
+
+        # the first note is released when the third is struck
+        self.assertEqual([(1, 0.0, 100, 1.0), (2, 0.5, 100, 2.0), (3, 1.0, 100, 2.0)], notes)
+        self.assertEqual(1, stats["stolen"])
+
+    def test_quietest_notes_of_a_chord_are_left_out(self):
+        chord = [(address, 0.0, velocity, 1.0) for address, velocity in [(1, 50), (2, 127), (3, 90), (4, 10)]]
+        notes, stats = arrange(chord, max_polyphony=2)
+
+        self.assertEqual([2, 3], sorted(note[0] for note in notes))
+        self.assertEqual(2, stats["stolen"])
+
+    def test_current_budget(self):
+        # three notes at peak power are more than the budget, but held notes draw less
+        chord = [(address, 0.0, 127, 1.0) for address in range(3)]
+        notes, _ = arrange(chord, current_budget=2.5 * PEAK_CURRENT)
+        self.assertEqual(2, len(notes))
+
+        staggered = [(address, address * 0.2, 127, 1.0) for address in range(3)]
+        notes, stats = arrange(staggered, current_budget=2.5 * PEAK_CURRENT)
+        self.assertEqual(3, len(notes))
+        self.assertEqual(0, stats["stolen"])
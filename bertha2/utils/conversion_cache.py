@@ -0,0 +1,164 @@
+""" Remembers converted videos so a song that is requested again doesn't need to be converted again """
+
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+from bertha2.settings import CONVERSION_CACHE_INDEX_FILENAME, CONVERSION_CACHE_MAX_BYTES, CONVERTER_VERSION, \
+    TRANSCRIPTION_BACKEND
+from bertha2.utils.logs import initialize_module_logger
+
+logger = initialize_module_logger(__name__)
+
+
+PARTIAL_FILE_MARKER = ".part-"
+
+
+def get_partial_filename(filename):
+    # a new name every time, so writers of the same file can't write into each other's partial file. The extension
+    #   stays at the end, some tools (like ffmpeg) pick the format from it.
+    root, extension = os.path.splitext(filename)
+    return f"{root}{PARTIAL_FILE_MARKER}{os.getpid()}-{uuid.uuid4().hex[:8]}{extension}"
+
+
+def commit_partial_file(partial_filename, filename):
+    # os.replace is atomic, so the file either doesn't exist yet or is complete
+    os.replace(partial_filename, filename)
+
+
+def remove_partial_files(directory):
+    # left behind by writers that crashed, only safe while nothing is writing to the directory
+    for partial_filename in glob.glob(os.path.join(glob.escape(directory), f"*{PARTIAL_FILE_MARKER}*")):
+        try:
+            os.remove(partial_filename)
+        except OSError as e:
+            logger.warning(f"Could not remove partial file {partial_filename}. {e}")
+
+
+def write_json_atomically(filename, contents):
+    partial_filename = get_partial_filename(filename)
+    with open(partial_filename, "w", encoding="utf-8") as f:
+        json.dump(contents, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    commit_partial_file(partial_filename, filename)
+
+
+def get_cache_key(video_id):
+    # a new converter version or backend produces different MIDI files, so they can't share entries
+    return f"{video_id}:{TRANSCRIPTION_BACKEND}:{CONVERTER_VERSION}"
+
+
+def get_cache_file_stem(video_id):
+    # converted files are named after the whole key, so entries of other versions or backends never share files
+    return f"{video_id}-{TRANSCRIPTION_BACKEND}-{CONVERTER_VERSION}"
+
+
+class ConversionCache:
+    """
+    Index of converted videos, stored as JSON next to the converted files
+
+    Each entry holds the title of the video and the paths of its files (e.g. video, audio, midi). When the files
+    take up more than max_size_bytes, the least recently used entries are deleted, except the ones whose files are in
+    use. A file that another entry still points to (e.g. from an index written before files were named after the whole
+    key) is never deleted.
+    """
+
+    def __init__(self, index_filename=CONVERSION_CACHE_INDEX_FILENAME, max_size_bytes=CONVERSION_CACHE_MAX_BYTES,
+                 get_files_in_use=None):
+        """
+        :param get_files_in_use: Function that returns the set of files that are queued, being converted or being
+            played, only called when entries have to be evicted
+        """
+        self.index_filename = index_filename
+        self.max_size_bytes = max_size_bytes
+        self.get_files_in_use = get_files_in_use
+        self.lock = threading.Lock()
+        self.entries = self.load_index()
+
+    def load_index(self):
+        try:
+            with open(self.index_filename, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Conversion cache index could not be read, starting with an empty cache. {e}")
+            return {}
+
+    def save_index(self):
+        write_json_atomically(self.index_filename, self.entries)
+
+    def get(self, video_id):
+        """
+        :return: Entry with "title" and "files" keys, or None if the video hasn't been converted
+        """
+        with self.lock:
+            key = get_cache_key(video_id)
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            if not all(os.path.isfile(filename) for filename in entry["files"].values()):
+                logger.debug(f"Files of cached video {video_id} are missing, removing it from the cache")
+                del self.entries[key]
+                self.save_index()
+                return None
+
+            entry["last_used"] = time.time()
+            self.save_index()
+            return entry
+
+    def put(self, video_id, title, files):
+        """
+        :param files: Dict of the converted files, e.g. {"video": ..., "audio": ..., "midi": ...}
+        """
+        with self.lock:
+            self.entries[get_cache_key(video_id)] = {
+                "video_id": video_id,
+                "title": title,
+                "files": files,
+                "size": sum(os.path.getsize(filename) for filename in files.values()),
+                "last_used": time.time(),
+            }
+            self.evict(keep_key=get_cache_key(video_id))
+            self.save_index()
+
+    def get_size(self):
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def evict(self, keep_key=None):
+        total_size = self.get_size()
+        if total_size <= self.max_size_bytes:
+            return
+
+        files_in_use = self.get_files_in_use() if self.get_files_in_use is not None else set()
+        least_recently_used = sorted(self.entries, key=lambda key: self.entries[key]["last_used"])
+
+        for key in least_recently_used:
+            if total_size <= self.max_size_bytes:
+                break
+            if key == keep_key or not files_in_use.isdisjoint(self.entries[key]["files"].values()):
+                continue
+
+            entry = self.entries.pop(key)
+            total_size -= entry["size"]
+            logger.debug(f"Evicting {entry['video_id']} from the conversion cache")
+            files_of_other_entries = {filename for other_entry in self.entries.values()
+                                      for filename in other_entry["files"].values()}
+            remove_files(filename for filename in entry["files"].values() if filename not in files_of_other_entries)
+
+
+def remove_files(filenames):
+    for filename in filenames:
+        # files derived from this one, like compiled playback plans, go with it
+        for derived_filename in [filename] + glob.glob(f"{glob.escape(filename)}.*"):
+            try:
+                os.remove(derived_filename)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not remove {derived_filename} from the conversion cache. {e}")
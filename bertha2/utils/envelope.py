@@ -0,0 +1,81 @@
+""" Power envelopes of the solenoids, precomputed into lookup tables from a calibration file """
+
+import hashlib
+import json
+import math
+
+import numpy as np
+
+from bertha2.settings import SOLENOID_PEAK_TIME_S, ENVELOPE_BUCKET_S
+from bertha2.utils.logs import initialize_module_logger
+
+logger = initialize_module_logger(__name__)
+
+MAXIMUM_VELOCITY = 127
+DEFAULT_PROFILE = {
+    "minimum_power": 100,  # PWM that depresses a key at the lowest velocity
+    "maximum_power": 150,  # PWM at the highest velocity
+    "hold_power": 50,  # PWM that keeps a key depressed once it's down
+    "peak_time_s": SOLENOID_PEAK_TIME_S,  # how long a note is driven at peak power
+    "velocity_curve": 1.0,  # exponent of velocity / 127, above 1 makes soft notes softer
+}
+
+
+def load_calibration(filename, number_of_notes):
+    """
+    Reads the envelope profile of every solenoid
+
+    The file looks like {"default": {...}, "solenoids": {"12": {...}}}. A value that a solenoid doesn't set comes from
+    "default", and then from DEFAULT_PROFILE. Without a file, every solenoid uses DEFAULT_PROFILE.
+
+    :return: List of profile dicts, one for each solenoid address
+    """
+    try:
+        with open(filename, encoding="utf-8") as f:
+            calibration = json.load(f)
+    except FileNotFoundError:
+        return [dict(DEFAULT_PROFILE) for _ in range(number_of_notes)]
+
+    default_profile = {**DEFAULT_PROFILE, **calibration.get("default", {})}
+    solenoid_profiles = calibration.get("solenoids", {})
+    for address in solenoid_profiles:
+        if not 0 <= int(address) < number_of_notes:
+            logger.warning(f"Solenoid calibration has a profile for {address}, which isn't a solenoid")
+
+    return [{**default_profile, **solenoid_profiles.get(str(address), {})} for address in range(number_of_notes)]
+
+
+class EnvelopeTable:
+    """
+    The PWM of every solenoid for every velocity and time since its note started, computed once
+
+    table[address, velocity, bucket] applies from bucket * bucket_s after the note starts. The last bucket lasts until
+    the note ends. key changes whenever the table does, so plans compiled with another calibration aren't reused.
+    """
+
+    def __init__(self, profiles, bucket_s=ENVELOPE_BUCKET_S):
+        self.bucket_s = bucket_s
+        number_of_buckets = max(math.ceil(round(profile["peak_time_s"] / bucket_s, 6)) for profile in profiles) + 1
+        bucket_start_times = np.arange(number_of_buckets) * bucket_s
+        velocity_fractions = np.arange(MAXIMUM_VELOCITY + 1) / MAXIMUM_VELOCITY
+
+        table = np.empty((len(profiles), MAXIMUM_VELOCITY + 1, number_of_buckets), dtype=np.float64)
+        for address, profile in enumerate(profiles):
+            peak_power = profile["minimum_power"] + (profile["maximum_power"] - profile["minimum_power"]) * \
+                velocity_fractions ** profile["velocity_curve"]
+            table[address] = np.where(bucket_start_times < profile["peak_time_s"], peak_power[:, None],
+                                      profile["hold_power"])
+        self.table = np.clip(table, 0, 255).astype(np.uint8)
+
+        self.key = hashlib.sha1(self.table.tobytes() + repr(bucket_s).encode()).hexdigest()
+
+    def get_pwm(self, solenoid_address, velocity, elapsed_s):
+        bucket = min(int(elapsed_s / self.bucket_s + 1e-9), self.table.shape[2] - 1)
+        return int(self.table[solenoid_address, min(max(int(velocity), 0), MAXIMUM_VELOCITY), bucket])
+
+    def get_envelopes(self, solenoid_addresses, velocities):
+        """
+        :return: Array of the PWM of each note in every bucket, shape (number of notes, number of buckets)
+        """
+        velocities = np.clip(np.asarray(velocities, dtype=np.int64), 0, MAXIMUM_VELOCITY)
+        return self.table[np.asarray(solenoid_addresses, dtype=np.int64), velocities]
@@ -0,0 +1,166 @@
+""" Shares the queues fairly between viewers, with priority lanes for mods and subscribers and a rate limit on !play """
+
+import heapq
+import queue
+import time
+
+from bertha2.settings import PLAY_PRIORITY_BADGES, PLAY_DEFAULT_PRIORITY, PLAY_RATE_LIMITS, FAIR_QUEUE_MIN_COST_S, \
+    MAX_VIDEO_LENGTH_SECONDS
+from bertha2.utils.logs import initialize_module_logger
+from bertha2.utils.queue_state import record_schedule
+from bertha2.utils.supervisor import get_from_queue
+
+logger = initialize_module_logger(__name__)
+
+
+def get_priority(badges: dict) -> int:
+    # the best lane any of the viewer's badges gets them into
+    return min([PLAY_PRIORITY_BADGES[badge] for badge in badges if badge in PLAY_PRIORITY_BADGES],
+               default=PLAY_DEFAULT_PRIORITY)
+
+
+def get_item_details(item):
+    """
+    :return: (priority lane, username, cost in seconds) of an item. Items from before they had these are all from
+        one unknown viewer in the default lane, and cost as much as the longest video.
+    """
+    if not isinstance(item, dict):
+        return PLAY_DEFAULT_PRIORITY, None, MAX_VIDEO_LENGTH_SECONDS
+
+    priority = item.get("priority")
+    length = item.get("length")
+    return (PLAY_DEFAULT_PRIORITY if priority is None else priority, item.get("username"),
+            max(FAIR_QUEUE_MIN_COST_S, MAX_VIDEO_LENGTH_SECONDS if length is None else length))
+
+
+class FairQueue:
+    """
+    Hands out the items of the lowest priority lane first, and shares each lane between viewers by song length
+
+    This is start-time fair queuing. Each item gets a virtual start time when it's pushed: the later of the virtual
+    time, which is the start time of the last item popped (or its end, if nothing was waiting), and the end of the
+    viewer's previous item. Items end their length after they start, so a viewer who queues ten songs gets one played
+    for every song of each other viewer, and songs half as long get turns twice as often. Items with the same start
+    time are popped in the order they were pushed. Pushing and popping are O(log n).
+    """
+
+    def __init__(self):
+        self.heap = []  # (schedule key, virtual end time, item), the key is (priority lane, virtual start, push number)
+        self.virtual_time = 0.0
+        self.popped_end_time = 0.0  # the latest virtual end time of the items popped
+        self.end_times = {}  # username -> virtual end time of their last item
+        self.pushed = 0
+        self.prune_at = 1024  # number of end times at which the ones that have passed are dropped
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, item) -> tuple:
+        """
+        :return: The schedule key of the item, items are popped in the order of their keys
+        """
+        # nothing is waiting, so the item goes after the ones that were popped
+        if not self.heap:
+            self.virtual_time = max(self.virtual_time, self.popped_end_time)
+
+        priority, username, cost = get_item_details(item)
+        start_time = max(self.virtual_time, self.end_times.get(username, 0.0))
+        self.end_times[username] = start_time + cost
+
+        schedule_key = (priority, start_time, self.pushed)
+        self.pushed += 1
+        heapq.heappush(self.heap, (schedule_key, start_time + cost, item))
+        return schedule_key
+
+    def pop(self):
+        schedule_key, end_time, item = heapq.heappop(self.heap)
+        self.virtual_time = max(self.virtual_time, schedule_key[1])
+        self.popped_end_time = max(self.popped_end_time, end_time)
+
+        # viewers whose items have all ended start from the virtual time anyway, so they don't need to be kept
+        if len(self.end_times) >= self.prune_at:
+            self.end_times = {username: end_time for username, end_time in self.end_times.items()
+                              if end_time > self.virtual_time}
+            self.prune_at = max(1024, 2 * len(self.end_times))
+        return item
+
+
+class ScheduledQueue:
+    """
+    Takes every item waiting on a multiprocessing.Queue whenever one is asked for, and hands them out in the order of a
+    FairQueue
+
+    Used by the process that works on the queue, in place of the queue itself. The queue is read with get_from_queue
+    from the thread that asks for an item, so the process can be stopped or restarted by the supervisor at any time.
+    The schedule key of every item is recorded as it's taken, so the queue state shows the items in the order they'll
+    be worked on. Items that were taken aren't lost if the process is restarted, they're put back on the queue with the
+    ones in progress.
+    """
+
+    def __init__(self, q, queue_name, queue_event_q=None):
+        self.q = q
+        self.queue_name = queue_name
+        self.queue_event_q = queue_event_q
+        self.fair_queue = FairQueue()
+
+    def receive(self, item):
+        schedule_key = self.fair_queue.push(item)
+        # recorded before the item can be taken, so it's never scheduled after it's dequeued
+        record_schedule(self.queue_event_q, self.queue_name, item, schedule_key)
+
+    def get(self, timeout=None):
+        """
+        Like Queue.get, waits up to timeout seconds (forever if None) and raises queue.Empty if nothing arrived
+        """
+        if not self.fair_queue:
+            self.receive(get_from_queue(self.q, timeout))
+        # the rest of what's waiting, so the item handed out is the first of all of them
+        while True:
+            try:
+                self.receive(self.q.get_nowait())
+            except queue.Empty:
+                return self.fair_queue.pop()
+
+
+class PlayRateLimiter:
+    """
+    A token bucket for each viewer, so nobody can fill the queue in one go
+
+    In each priority lane with a limit in rate_limits, a viewer can make `burst` !play commands at once, and can make
+    another one every refill_s seconds after that.
+    """
+
+    def __init__(self, rate_limits=PLAY_RATE_LIMITS):
+        self.rate_limits = rate_limits  # priority lane -> (burst, refill_s)
+        self.buckets = {}  # username -> (tokens, time they were counted)
+        self.prune_at = 1024  # number of buckets at which the full ones are dropped
+
+    def take(self, username, priority, now=None) -> float:
+        """
+        Uses up one of the viewer's !play commands, if they have one
+
+        :return: 0 if they did, otherwise the seconds until they have one
+        """
+        if priority not in self.rate_limits:
+            return 0.0
+        burst, refill_s = self.rate_limits[priority]
+        now = time.monotonic() if now is None else now
+
+        if len(self.buckets) >= self.prune_at:
+            self.prune(now)
+
+        tokens, counted_at = self.buckets.get(username, (burst, now))
+        tokens = min(burst, tokens + (now - counted_at) / refill_s)
+        if tokens < 1:
+            self.buckets[username] = (tokens, now)
+            return (1 - tokens) * refill_s
+
+        self.buckets[username] = (tokens - 1, now)
+        return 0.0
+
+    def prune(self, now):
+        # a full bucket is the same as one that was never used. Every lane refills within its longest refill time.
+        longest_refill_s = max((burst * refill_s for burst, refill_s in self.rate_limits.values()), default=0)
+        self.buckets = {username: (tokens, counted_at) for username, (tokens, counted_at) in self.buckets.items()
+                        if now - counted_at < longest_refill_s}
+        self.prune_at = max(1024, 2 * len(self.buckets))
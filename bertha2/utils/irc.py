@@ -0,0 +1,112 @@
+""" Helpers for reading the IRC protocol that Twitch chat uses """
+
+MAX_IRC_LINE_BYTES = 16384  # Twitch lines with tags stay well below this
+
+
+class IrcLineReader:
+    """
+    Splits the raw bytes read from an IRC socket into complete lines
+
+    A read can hold several lines, or end in the middle of one. The unfinished end of a read is kept until the rest of
+    it arrives. Lines are only decoded once they're complete, so a character split across reads is decoded correctly.
+    """
+
+    def __init__(self, max_line_bytes=MAX_IRC_LINE_BYTES):
+        self.buffer = bytearray()
+        self.max_line_bytes = max_line_bytes
+
+    def feed(self, data: bytes) -> list:
+        """
+        :return: List of the lines completed by data, without their line endings
+        """
+        self.buffer += data
+        *lines, partial_line = self.buffer.split(b"\r\n")
+        self.buffer = bytearray(partial_line)
+
+        # a line this long can't be valid IRC, drop it instead of buffering forever
+        if len(self.buffer) > self.max_line_bytes:
+            self.buffer.clear()
+
+        return [line.decode("utf-8", errors="replace") for line in lines if line]
+
+
+# https://ircv3.net/specs/extensions/message-tags#escaping-values
+TAG_VALUE_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+
+def unescape_tag_value(value: str) -> str:
+    if "\\" not in value:
+        return value
+
+    unescaped = []
+    i = 0
+    while i < len(value):
+        character = value[i]
+        if character == "\\":
+            i += 1
+            if i == len(value):
+                break  # a lone backslash at the end is dropped
+            character = TAG_VALUE_ESCAPES.get(value[i], value[i])
+        unescaped.append(character)
+        i += 1
+    return "".join(unescaped)
+
+
+def parse_tags(tags: str) -> dict:
+    parsed_tags = {}
+    for tag in tags.split(";"):
+        key, _, value = tag.partition("=")
+        if key:
+            parsed_tags[key] = unescape_tag_value(value)
+    return parsed_tags
+
+
+def parse_irc_message(line: str) -> dict | None:
+    """
+    Parses one IRC line, with IRCv3 tags, in a single pass from left to right
+
+    Looks like this:
+    @badge-info=;badges=subscriber/12;...;user-type= :user!user@user.tmi.twitch.tv PRIVMSG #berthatwo :!play <link>
+
+    :return: Dict with "tags", "prefix", "command", "params" and "trailing" keys, or None if the line has no command
+    """
+    position = 0
+    tags = {}
+    prefix = None
+
+    if line.startswith("@"):
+        end = line.find(" ")
+        if end == -1:
+            return None
+        tags = parse_tags(line[1:end])
+        position = end + 1
+
+    while line.startswith(" ", position):
+        position += 1
+
+    if line.startswith(":", position):
+        end = line.find(" ", position)
+        if end == -1:
+            return None
+        prefix = line[position + 1:end]
+        position = end + 1
+
+    # everything after the first " :" is one parameter, spaces included
+    trailing_start = line.find(" :", position)
+    if trailing_start == -1:
+        middle, trailing = line[position:], None
+    else:
+        middle, trailing = line[position:trailing_start], line[trailing_start + 2:]
+
+    params = middle.split()
+    if not params:
+        return None
+    command = params.pop(0)
+
+    return {
+        "tags": tags,
+        "prefix": prefix,
+        "command": command,
+        "params": params,
+        "trailing": trailing,
+    }
@@ -0,0 +1,149 @@
+""" Records every change to the queues as it happens, so they can be rebuilt after a crash """
+
+import json
+import os
+import queue
+import threading
+
+from bertha2.settings import QUEUE_JOURNAL_FILENAME, QUEUE_JOURNAL_COMPACT_AFTER_EVENTS
+from bertha2.utils.conversion_cache import get_partial_filename
+from bertha2.utils.logs import initialize_module_logger
+from bertha2.utils.queue_state import QueueState, EVENT_ENQUEUE
+
+logger = initialize_module_logger(__name__)
+
+
+def fsync_directory(filename):
+    # makes a rename durable, not only the contents of the renamed file
+    directory_fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+class QueueJournal:
+    """
+    Append-only file of queue events, one JSON object per line
+
+    append() only hands the event to a writer thread. The writer writes everything that's waiting and then fsyncs once,
+    so events that arrive while a fsync is running share the next one. After compact_after_events events the journal
+    is rewritten to only hold the items that are still queued.
+    """
+
+    def __init__(self, filename=QUEUE_JOURNAL_FILENAME, compact_after_events=QUEUE_JOURNAL_COMPACT_AFTER_EVENTS):
+        self.filename = filename
+        self.compact_after_events = compact_after_events
+        self.state = QueueState()
+        self.events = queue.Queue()
+        self.events_since_compaction = 0
+        self.stats = {"events": 0, "fsyncs": 0, "compactions": 0}
+        self.file = None
+        self.writer_thread = None
+
+    def replay(self) -> QueueState:
+        """
+        Rebuilds the queues from the journal. Has to be called before open().
+        """
+        try:
+            with open(self.filename, encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return self.state
+
+        for line_number, line in enumerate(lines, 1):
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                # only the last line can be cut off by a crash, anything else means the file is damaged
+                if line_number == len(lines):
+                    logger.warning(f"Ignoring the unfinished last event of the queue journal")
+                else:
+                    logger.error(f"Queue journal line {line_number} could not be read, skipping it")
+                continue
+            self.state.apply(event)
+            self.events_since_compaction += 1
+
+        return self.state
+
+    def open(self):
+        # rewriting the journal first also drops a line that was cut off
+        self.compact()
+        self.writer_thread = threading.Thread(target=self.run_writer, name="queue-journal", daemon=True)
+        self.writer_thread.start()
+
+    def append(self, event):
+        self.events.put(event)
+
+    def flush(self):
+        # waits until everything appended so far is on disk
+        written = threading.Event()
+        self.events.put(written)
+        written.wait()
+
+    def close(self):
+        self.events.put(None)
+        self.writer_thread.join()
+        self.compact()
+        self.file.close()
+
+    def run_writer(self):
+        stopping = False
+        while not stopping:
+            batch = [self.events.get()]
+            while True:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+
+            markers = []
+            lines = []
+            for event in batch:
+                if event is None:
+                    stopping = True
+                elif isinstance(event, threading.Event):
+                    markers.append(event)
+                else:
+                    self.state.apply(event)
+                    lines.append(json.dumps(event, ensure_ascii=False) + "\n")
+
+            if lines:
+                try:
+                    self.write_lines(lines)
+                except Exception as e:
+                    logger.critical(f"Queue events could not be written to the journal. {e}")
+
+            for marker in markers:
+                marker.set()
+
+    def write_lines(self, lines):
+        self.file.writelines(lines)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.stats["events"] += len(lines)
+        self.stats["fsyncs"] += 1
+
+        self.events_since_compaction += len(lines)
+        if self.events_since_compaction >= self.compact_after_events:
+            self.compact()
+
+    def compact(self):
+        if self.file is not None:
+            self.file.close()
+
+        partial_filename = get_partial_filename(self.filename)
+        with open(partial_filename, "w", encoding="utf-8") as f:
+            for queue_name, items in self.state.queues.items():
+                for item_id, item in items.items():
+                    event = {"event": EVENT_ENQUEUE, "queue": queue_name, "id": item_id, "item": item}
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial_filename, self.filename)
+        fsync_directory(self.filename)
+
+        self.file = open(self.filename, "a", encoding="utf-8")
+        self.events_since_compaction = 0
+        self.stats["compactions"] += 1
+
@@ -1,32 +1,111 @@
 import logging
-from bertha2.settings import cli_args, LOG_FORMAT
+from logging.handlers import QueueHandler, QueueListener
+
+from bertha2.settings import get_cli_args, LOG_FORMAT, LOG_DEBUG_RATE_LIMITS
+
+# the loggers each debug flag enables debug level logging for
+DEBUG_FLAG_LOGGERS = {
+    "debug_visuals": "bertha2.visuals",
+    "debug_chat": "bertha2.chat",
+    "debug_hardware": "bertha2.hardware",
+    "debug_converter": "bertha2.converter",
+}
+
 
 def initialize_module_logger(module_name):
-    logger = logging.getLogger(module_name)
+    # its level is set when the process starts logging, so importing a module doesn't parse the command line arguments
+    return logging.getLogger(module_name)
 
-    # If the debug flag is set high, enable debug level logging
-    if "visuals" in module_name and cli_args.debug_visuals:
-        logging.getLogger(module_name).setLevel(logging.DEBUG)
-    elif "chat" in module_name and cli_args.debug_chat:
-        logging.getLogger(module_name).setLevel(logging.DEBUG)
-    elif "hardware" in module_name and cli_args.debug_hardware:
-        logging.getLogger(module_name).setLevel(logging.DEBUG)
-    elif "converter" in module_name and cli_args.debug_converter:
-        logging.getLogger(module_name).setLevel(logging.DEBUG)
 
-    return logger
+def set_log_levels():
+    # loggers are found by name, so this works for modules that haven't been imported yet
+    cli_args = get_cli_args()
+    logging.getLogger().setLevel(get_log_level())
+    for flag, logger_name in DEBUG_FLAG_LOGGERS.items():
+        if getattr(cli_args, flag):
+            logging.getLogger(logger_name).setLevel(logging.DEBUG)
 
 
-def initialize_root_logger(root_module):
-    # This is run before importing B2 modules so that they all have consistent log levels for all code run
+def get_log_level():
     # For more information on log levels: https://docs.python.org/3/library/logging.html#levels
+    cli_args = get_cli_args()
     if cli_args.log is None:  # If LOG isn't defined, set to info mode.
-        numeric_level = 20
-    else:
-        numeric_level = getattr(logging, cli_args.log.upper())
-    logging.basicConfig(level=numeric_level, format=LOG_FORMAT)  # NOTE: Without this, logs won't print in the console.
+        return logging.INFO
+    return getattr(logging, cli_args.log.upper())
+
+
+def initialize_root_logger(root_module):
+    # This is run by the main process before it starts logging, the other processes log through it
+    # NOTE: Without this, logs won't print in the console.
+    logging.basicConfig(format=LOG_FORMAT)
+    set_log_levels()
     return logging.getLogger(root_module)
 
 
+class DebugRateLimitFilter(logging.Filter):
+    """
+    Lets through at most rate_limits[logger name] debug records a second from each logger, the rest are dropped
+
+    Records above debug level, and records of loggers without a limit, always get through. The number of records that
+    were dropped is added to the next one that gets through.
+    """
+
+    def __init__(self, rate_limits):
+        super().__init__()
+        self.rate_limits = rate_limits
+        self.buckets = {}  # logger name -> (tokens, time they were counted)
+        self.dropped = {}
+
+    def get_rate_limit(self, logger_name):
+        for limited_name, rate_limit in self.rate_limits.items():
+            if logger_name == limited_name or logger_name.startswith(limited_name + "."):
+                return rate_limit
+        return None
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        rate_limit = self.get_rate_limit(record.name)
+        if rate_limit is None:
+            return True
+
+        # a token bucket that holds a second of records
+        tokens, counted_at = self.buckets.get(record.name, (rate_limit, record.created))
+        tokens = min(rate_limit, tokens + (record.created - counted_at) * rate_limit)
+        if tokens < 1:
+            self.buckets[record.name] = (tokens, record.created)
+            self.dropped[record.name] = self.dropped.get(record.name, 0) + 1
+            return False
+
+        self.buckets[record.name] = (tokens - 1, record.created)
+        dropped = self.dropped.pop(record.name, 0)
+        if dropped:
+            record.msg = f"{record.msg} ({dropped} debug messages dropped)"
+        return True
+
+
+def initialize_process_logging(log_q):
+    """
+    Sends every record of this process to the log listener of the main process, see create_log_listener
+
+    Only the message is put together here. Formatting it and writing it to the console happen in the main process, so
+    a slow terminal doesn't hold up the process that logs.
+    """
+    root_logger = logging.getLogger()
+    # a forked process starts with the handlers of the main process
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+
+    queue_handler = QueueHandler(log_q)
+    queue_handler.addFilter(DebugRateLimitFilter(LOG_DEBUG_RATE_LIMITS))
+    root_logger.addHandler(queue_handler)
+    set_log_levels()
+
+
+def create_log_listener(log_q):
+    # writes the records of every process with the handlers of the main process, from a thread of its own
+    return QueueListener(log_q, *logging.getLogger().handlers, respect_handler_level=True)
+
+
 def log_if_in_debug_mode(logger_object, module_name):
     logger_object.debug(f"Debug logging enabled for {module_name}.")
@@ -0,0 +1,276 @@
+""" Counters, gauges and histograms of where each process spends its time, collected and served by the main process """
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bertha2.settings import METRICS_REPORT_INTERVAL_S, METRICS_HOST, METRICS_PORT
+from bertha2.utils.logs import initialize_module_logger
+
+logger = initialize_module_logger(__name__)
+
+# in seconds, from a late solenoid transition to a slow download
+DEFAULT_BUCKETS_S = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+# Recording a sample only adds to a number in this process, so it can be done in the playback loop. A thread sends
+#   what changed to the main process every METRICS_REPORT_INTERVAL_S, see start_metrics_reporter.
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.value = 0.0
+        self.reported_value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def collect_change(self):
+        value = self.value
+        change = value - self.reported_value
+        self.reported_value = value
+        return change or None
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.value = 0.0
+        self.reported_value = None
+
+    def set(self, value):
+        self.value = value
+
+    def collect_change(self):
+        # a gauge is reported as it is, not as what it changed by
+        value = self.value
+        if value == self.reported_value:
+            return None
+        self.reported_value = value
+        return value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, description, labels, buckets=DEFAULT_BUCKETS_S):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one counts samples above every bucket
+        self.sum = 0.0
+        self.reported_counts = list(self.counts)
+        self.reported_sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        return HistogramTimer(self)
+
+    def collect_change(self):
+        counts, value_sum = list(self.counts), self.sum
+        if counts == self.reported_counts:
+            return None
+        change = ([count - reported for count, reported in zip(counts, self.reported_counts)],
+                  value_sum - self.reported_sum)
+        self.reported_counts, self.reported_sum = counts, value_sum
+        return change
+
+
+class HistogramTimer:
+    # with histogram.time(): observes how long the block took
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start_time)
+
+
+# the metrics of this process, by (name, labels)
+registered_metrics = {}
+registered_metrics_lock = threading.Lock()
+
+
+def get_metric(metric_class, name, description, labels, **kwargs):
+    key = (name, tuple(sorted(labels.items())))
+    with registered_metrics_lock:
+        if key not in registered_metrics:
+            registered_metrics[key] = metric_class(name, description, key[1], **kwargs)
+        return registered_metrics[key]
+
+
+def get_counter(name, description, **labels) -> Counter:
+    return get_metric(Counter, name, description, labels)
+
+
+def get_gauge(name, description, **labels) -> Gauge:
+    return get_metric(Gauge, name, description, labels)
+
+
+def get_histogram(name, description, buckets=DEFAULT_BUCKETS_S, **labels) -> Histogram:
+    return get_metric(Histogram, name, description, labels, buckets=buckets)
+
+
+def collect_changes():
+    """
+    :return: List of (kind, name, description, labels, buckets, change) tuples of every metric that changed since the
+        last call. change is what was added for counters and histograms, and the value for gauges.
+    """
+    with registered_metrics_lock:
+        metrics = list(registered_metrics.values())
+
+    changes = []
+    for metric in metrics:
+        change = metric.collect_change()
+        if change is not None:
+            changes.append((metric.kind, metric.name, metric.description, metric.labels,
+                            getattr(metric, "buckets", None), change))
+    return changes
+
+
+def report_metrics(metrics_q, interval_s):
+    while True:
+        time.sleep(interval_s)
+        changes = collect_changes()
+        if changes:
+            metrics_q.put(changes)
+
+
+def start_metrics_reporter(metrics_q, interval_s=METRICS_REPORT_INTERVAL_S):
+    # a forked process starts with the metrics of the main process, which are reported by the main process
+    with registered_metrics_lock:
+        registered_metrics.clear()
+
+    # a process that crashes loses at most interval_s of samples
+    threading.Thread(target=report_metrics, args=(metrics_q, interval_s), daemon=True).start()
+
+
+class MetricsCollector:
+    """
+    The metrics of every process added together, kept by the main process
+
+    The processes send what changed, so counters and histograms carry on from where they were when a process is
+    restarted. The metrics of the main process itself are collected whenever the metrics are read.
+    """
+
+    def __init__(self):
+        self.metrics = {}  # (name, labels) -> {"kind", "description", "buckets", "value"}
+        self.lock = threading.Lock()
+
+    def add(self, changes):
+        with self.lock:
+            for kind, name, description, labels, buckets, change in changes:
+                metric = self.metrics.get((name, labels))
+                if metric is None:
+                    metric = {"kind": kind, "description": description, "buckets": buckets, "value": None}
+                    self.metrics[(name, labels)] = metric
+
+                if kind == "gauge":
+                    metric["value"] = change
+                elif kind == "counter":
+                    metric["value"] = (metric["value"] or 0.0) + change
+                elif metric["value"] is None:
+                    metric["value"] = (list(change[0]), change[1])
+                else:
+                    counts, value_sum = metric["value"]
+                    metric["value"] = ([count + added for count, added in zip(counts, change[0])],
+                                       value_sum + change[1])
+
+    def receive(self, metrics_q):
+        # runs in a thread of the main process until None is put on metrics_q
+        for changes in iter(metrics_q.get, None):
+            self.add(changes)
+
+    def get_metrics(self):
+        self.add(collect_changes())
+        with self.lock:
+            return {key: dict(metric) for key, metric in self.metrics.items()}
+
+    def render_prometheus_text(self):
+        lines = []
+        described = set()
+        for (name, labels), metric in sorted(self.get_metrics().items()):
+            if name not in described:
+                lines.append(f"# HELP {name} {metric['description']}")
+                lines.append(f"# TYPE {name} {metric['kind']}")
+                described.add(name)
+
+            if metric["kind"] != "histogram":
+                lines.append(f"{name}{format_labels(labels)} {format_number(metric['value'])}")
+                continue
+
+            counts, value_sum = metric["value"]
+            cumulative_count = 0
+            for bucket, count in zip(list(metric["buckets"]) + ["+Inf"], counts):
+                cumulative_count += count
+                bucket_labels = labels + (("le", bucket if bucket == "+Inf" else format_number(bucket)),)
+                lines.append(f"{name}_bucket{format_labels(bucket_labels)} {cumulative_count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {format_number(value_sum)}")
+            lines.append(f"{name}_count{format_labels(labels)} {cumulative_count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f"{label}=\"{value}\"" for (label, _), value in zip(labels, escaped)) + "}"
+
+
+def format_number(value):
+    return repr(float(value))
+
+
+def start_metrics_server(collector: MetricsCollector, host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Serves the metrics in the Prometheus text format at http://host:port/metrics, from a thread
+
+    :return: The server, or None if the port couldn't be opened
+    """
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = collector.render_prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scraped every few seconds, so requests aren't logged
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    except OSError as e:
+        logger.warning(f"Could not serve metrics on {host}:{port}. {e}")
+        return None
+
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics at http://{host}:{server.server_port}/metrics")
+    return server
@@ -1,71 +1,168 @@
 import asyncio
+import threading
+import time
 
 import simpleobsws
 
-from bertha2.settings import OBS_WEBSOCKET_URL, VIDEO_WIDTH, VIDEO_HEIGHT
+from bertha2.settings import OBS_WEBSOCKET_URL, VIDEO_WIDTH, VIDEO_HEIGHT, OBS_REQUEST_TIMEOUT_S, \
+    OBS_RECONNECT_MIN_BACKOFF_S, OBS_RECONNECT_MAX_BACKOFF_S
 from bertha2.utils.logs import initialize_module_logger
 
 logger = initialize_module_logger(__name__)
 
 
-def create_obs_websocket_client():
+def create_obs_websocket_client(url=OBS_WEBSOCKET_URL):
     # Create an IdentificationParameters object (optional for connecting)
     parameters = simpleobsws.IdentificationParameters(ignoreNonFatalRequestChecks=False)
     # Every possible argument has been passed, but none are required. See lib code for defaults.
-    return simpleobsws.WebSocketClient(url=OBS_WEBSOCKET_URL, identification_parameters=parameters)
-
-
-obs_ws_client = create_obs_websocket_client()
-
-
-async def update_obs_source_properties(updated_source_properties):
-    # This will error if OBS isn't running
-    try:
-        await obs_ws_client.connect()  # Make the connection to obs-websocket
-        await obs_ws_client.wait_until_identified()  # Wait for the identification handshake to complete
-
-    except Exception as e:
-        logger.error("Couldn't connect to OBS, is it open?")
-        return {}
-
+    return simpleobsws.WebSocketClient(url=url, identification_parameters=parameters)
+
+
+class ObsClient:
+    """
+    A connection to obs-websocket that stays open between updates
+
+    The connection lives on an event loop in its own thread, so it can be used from code that isn't async. If OBS
+    isn't reachable, updates are dropped and reconnecting is tried again after a backoff that doubles on every failed
+    attempt, so a closed OBS doesn't slow down the caller.
+    """
+
+    def __init__(self, url=OBS_WEBSOCKET_URL, min_backoff_s=OBS_RECONNECT_MIN_BACKOFF_S,
+                 max_backoff_s=OBS_RECONNECT_MAX_BACKOFF_S, timeout_s=OBS_REQUEST_TIMEOUT_S):
+        self.url = url
+        self.min_backoff_s = min_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.timeout_s = timeout_s
+
+        self.backoff_s = min_backoff_s
+        self.next_connection_attempt = 0
+        self.connections = 0  # successful connections, including reconnections
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="obs-client", daemon=True)
+        self.thread.start()
+        # the client has to be created on the loop it's used from
+        self.ws_client = self.run(self.create_client())
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def create_client(self):
+        return create_obs_websocket_client(self.url)
+
+    def is_connected(self):
+        ws = self.ws_client.ws
+        return ws is not None and ws.open and self.ws_client.identified
+
+    async def connect(self):
+        if self.is_connected():
+            return
+
+        if time.monotonic() < self.next_connection_attempt:
+            raise ConnectionError(f"Waiting {self.next_connection_attempt - time.monotonic():.1f} s to reconnect")
+
+        try:
+            await self.disconnect()  # clears what's left of a connection that was lost
+            await asyncio.wait_for(self.ws_client.connect(), timeout=self.timeout_s)
+            if not await self.ws_client.wait_until_identified(timeout=self.timeout_s):
+                raise ConnectionError("obs-websocket didn't identify the client")
+        except Exception:
+            self.next_connection_attempt = time.monotonic() + self.backoff_s
+            self.backoff_s = min(self.backoff_s * 2, self.max_backoff_s)
+            raise
+
+        self.backoff_s = self.min_backoff_s
+        self.connections += 1
+        logger.debug(f"Connected to OBS at {self.url}")
+
+    async def disconnect(self):
+        try:
+            await self.ws_client.disconnect()
+        except Exception as e:
+            logger.debug(f"Could not close the OBS connection cleanly. {e}")
+
+    async def send_batch(self, requests):
+        try:
+            await self.connect()
+        except Exception as e:
+            logger.error(f"Couldn't connect to OBS, is it open? {e}")
+            return []
+
+        try:
+            # a RequestBatch is one round trip, however many sources are updated
+            return await self.ws_client.call_batch(requests, timeout=self.timeout_s, halt_on_failure=False)
+        except Exception as e:
+            logger.error(f"OBS connection was lost. {e}")
+            await self.disconnect()
+            return []
+
+    def call_batch(self, requests: list) -> list:
+        """
+        :param requests: List of simpleobsws.Request
+        :return: List of simpleobsws.RequestResponse in the same order, or an empty list if OBS couldn't be reached
+        """
+        if not requests:
+            return []
+
+        responses = self.run(self.send_batch(requests))
+        for request, response in zip(requests, responses):
+            if response.ok():  # Check if the request succeeded
+                logger.debug(f"Request succeeded! Response data: {response.responseData}")
+            else:
+                logger.warning(f"There was an error with {request.requestType} in OBS. "
+                               f"{response.requestStatus.comment}")
+        return responses
+
+    def close(self):
+        self.run(self.disconnect())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+# created the first time it's used, so importing this module doesn't start a thread
+obs_client = None
+
+
+def get_obs_client() -> ObsClient:
+    global obs_client
+    if obs_client is None:
+        obs_client = ObsClient()
+    return obs_client
+
+
+def create_text_source_request(text_source_id, text_value: str):
     # The type of the input is "text_ft2_source_v2"
-    request = simpleobsws.Request('SetInputSettings', updated_source_properties)
-    response = await obs_ws_client.call(request)  # Perform the request
-
-    if response.ok():  # Check if the request succeeded
-        logger.debug(f"Request succeeded! Response data: {response.responseData}")
-    else:
-        logger.warning(f"There was an error setting the text in OBS")
-
-    await obs_ws_client.disconnect()  # Disconnect from the websocket server cleanly
-
-    return response
-
-
-def update_obs_text_source_value(text_source_id, text_value: str):
-    updated_source_properties = {
+    return simpleobsws.Request('SetInputSettings', {
         'inputName': text_source_id,
         'inputSettings': {
             'text': text_value,
         }
-    }
-
-    loop = asyncio.get_event_loop()  # NOTE: Async function must be called like this.
-    return loop.run_until_complete(update_obs_source_properties(updated_source_properties))
+    })
 
 
-def update_obs_video_source_value(video_source_id, video_filepath: str):
+def create_video_source_request(video_source_id, video_filepath: str):
     # Use this as a reference for the different options available:
     #     https://github.com/Elektordi/obs-websocket-py/blob/e92960a475d3f1096a4ea41763cbc776b23f0a37/obswebsocket/requests.py#L1480
-
-    updated_source_properties = {
+    return simpleobsws.Request('SetInputSettings', {
         'inputName': video_source_id,
         'inputSettings': {
             'local_file': video_filepath,
             'width': VIDEO_WIDTH,
             'height': VIDEO_HEIGHT,
         }
-    }
+    })
+
+
+def update_obs_sources(requests: list) -> list:
+    # sends all of the updates together
+    return get_obs_client().call_batch(requests)
 
-    loop = asyncio.get_event_loop()  # NOTE: Async function must be called like this.
-    return loop.run_until_complete(update_obs_source_properties(updated_source_properties))
+
+def update_obs_text_source_value(text_source_id, text_value: str):
+    responses = update_obs_sources([create_text_source_request(text_source_id, text_value)])
+    return responses[0] if responses else {}
+
+
+def update_obs_video_source_value(video_source_id, video_filepath: str):
+    responses = update_obs_sources([create_video_source_request(video_source_id, video_filepath)])
+    return responses[0] if responses else {}
@@ -0,0 +1,118 @@
+""" Runs work through a chain of stages concurrently, while keeping results in submission order """
+
+import collections
+import concurrent.futures
+
+from bertha2.utils.logs import initialize_module_logger
+
+logger = initialize_module_logger(__name__)
+
+
+class OrderedPipeline:
+    """
+    Passes each submitted item through every stage, each stage running on its own executor
+
+    The output of a stage is the input of the next one, so different items can be in different stages at the same
+    time. Results are handed to publish_function strictly in the order the items were submitted, even when a later
+    item finishes first. An item that fails in any stage, or in publish_function, is handed to error_function instead,
+    in the same order.
+    """
+
+    def __init__(self, stages, publish_function, error_function, max_in_flight):
+        """
+        :param stages: List of (name, function, executor) tuples
+        :param publish_function: Function of (item, result) called for every finished item, in order
+        :param error_function: Function of (item, exception) called for every failed item, in order
+        :param max_in_flight: The most items that can be in the pipeline at once
+        """
+        self.stages = stages
+        self.publish_function = publish_function
+        self.error_function = error_function
+        self.max_in_flight = max_in_flight
+        self.in_flight = collections.deque()  # (item, future of the final result), in submission order
+
+    def submit(self, item) -> concurrent.futures.Future:
+        """
+        :return: Future of the result of the last stage, e.g. for submit_after
+        """
+        result_future = concurrent.futures.Future()
+        self.in_flight.append((item, result_future))
+        self.run_stage(0, item, result_future)
+        return result_future
+
+    def submit_result(self, item, result):
+        # for items that don't need any work (e.g. cached), but still have to wait for their turn to be published
+        result_future = concurrent.futures.Future()
+        result_future.set_result(result)
+        self.in_flight.append((item, result_future))
+
+    def submit_after(self, item, earlier_future: concurrent.futures.Future, function):
+        """
+        For items whose work an earlier item is already doing (e.g. the same video): the result is function(result of
+        the earlier item) once that's finished, or the same exception if it failed
+        """
+        result_future = concurrent.futures.Future()
+        self.in_flight.append((item, result_future))
+
+        def on_earlier_done(finished_future):
+            try:
+                result_future.set_result(function(finished_future.result()))
+            except Exception as e:
+                result_future.set_exception(e)
+
+        earlier_future.add_done_callback(on_earlier_done)
+
+    def run_stage(self, stage_index, value, result_future):
+        if stage_index == len(self.stages):
+            result_future.set_result(value)
+            return
+
+        name, function, executor = self.stages[stage_index]
+        try:
+            stage_future = executor.submit(function, value)
+        except Exception as e:  # the executor has been shut down
+            result_future.set_exception(e)
+            return
+
+        def on_stage_done(finished_future):
+            try:
+                next_value = finished_future.result()
+            except Exception as e:
+                logger.debug(f"Stage {name} failed. {e}")
+                result_future.set_exception(e)
+                return
+            self.run_stage(stage_index + 1, next_value, result_future)
+
+        stage_future.add_done_callback(on_stage_done)
+
+    def has_capacity(self):
+        return len(self.in_flight) < self.max_in_flight
+
+    def publish_ready(self):
+        # only the oldest items can be published, anything behind an unfinished item has to wait for it
+        while self.in_flight and self.in_flight[0][1].done():
+            item, result_future = self.in_flight.popleft()
+            exception = result_future.exception()
+            if exception is None:
+                try:
+                    self.publish_function(item, result_future.result())
+                    continue
+                except Exception as e:
+                    logger.error(f"Could not publish {item}. {e}")
+                    exception = e
+
+            # one item that can't be handled doesn't stop the ones behind it
+            try:
+                self.error_function(item, exception)
+            except Exception as e:
+                logger.error(f"Could not report the error of {item}. {e}")
+
+    def wait(self, timeout=None):
+        # waits until the oldest item is finished, and publishes everything that's ready
+        if self.in_flight:
+            concurrent.futures.wait([self.in_flight[0][1]], timeout=timeout)
+        self.publish_ready()
+
+    def join(self):
+        while self.in_flight:
+            self.wait()
@@ -0,0 +1,80 @@
+""" Stores compiled playback plans next to their MIDI files so replays don't need to parse MIDI again """
+
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+from bertha2.utils.logs import initialize_module_logger
+
+logger = initialize_module_logger(__name__)
+
+PLAN_DTYPE = np.dtype([("time", "<f8"), ("address", "<i2"), ("pwm", "u1")])
+PLAN_FILE_SUFFIX = ".plan.npy"
+
+
+def hash_file_contents(filename):
+    file_hash = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def get_plan_filename(midi_filename, content_hash):
+    return f"{midi_filename}.{content_hash[:16]}{PLAN_FILE_SUFFIX}"
+
+
+def create_plan(times, note_addresses, pwm_values):
+    plan = np.empty(len(times), dtype=PLAN_DTYPE)
+    plan["time"] = times
+    plan["address"] = note_addresses
+    plan["pwm"] = np.clip(np.asarray(pwm_values, dtype=np.float64), 0, 255).astype(np.uint8)
+    return plan
+
+
+def save_plan(plan_filename, plan):
+    # write to a temporary file first, so a crash can't leave a half-written plan behind
+    temporary_filename = f"{plan_filename}.{os.getpid()}.tmp"
+    with open(temporary_filename, "wb") as f:
+        np.save(f, plan)
+    os.replace(temporary_filename, plan_filename)
+
+
+def load_plan(plan_filename):
+    # memory-mapped, so only the parts of the plan that are played get read from disk
+    return np.load(plan_filename, mmap_mode="r")
+
+
+def remove_stale_plans(midi_filename, current_plan_filename):
+    # plans compiled from an older version of the MIDI file can never be used again
+    for plan_filename in glob.glob(f"{glob.escape(midi_filename)}.*{PLAN_FILE_SUFFIX}"):
+        if plan_filename != current_plan_filename:
+            try:
+                os.remove(plan_filename)
+            except OSError as e:
+                logger.warning(f"Could not remove stale playback plan {plan_filename}. {e}")
+
+
+def load_or_compile_plan(midi_filename, compile_function, compile_key=""):
+    """
+    Loads the playback plan of a MIDI file, compiling and storing it first if needed
+
+    :param midi_filename: Path to the MIDI file
+    :param compile_function: Function of (midi_filename) that returns (times, note_addresses, pwm_values)
+    :param compile_key: Anything else the plan depends on (like the solenoid calibration), as a string
+    :return: Structured array with "time", "address" and "pwm" fields, ordered by time
+    """
+    content_hash = hash_file_contents(midi_filename)
+    if compile_key:
+        content_hash = hashlib.sha1(f"{content_hash}:{compile_key}".encode()).hexdigest()
+    plan_filename = get_plan_filename(midi_filename, content_hash)
+
+    if not os.path.isfile(plan_filename):
+        logger.debug(f"Compiling playback plan for {midi_filename}")
+        save_plan(plan_filename, create_plan(*compile_function(midi_filename)))
+        remove_stale_plans(midi_filename, plan_filename)
+
+    return load_plan(plan_filename)
@@ -0,0 +1,270 @@
+""" The one up-to-date view of link_q and play_q, kept by the main process and shared with the other processes """
+
+import copy
+import queue
+import threading
+import time
+from multiprocessing import Queue
+
+from bertha2.utils.logs import initialize_module_logger
+from bertha2.utils.metrics import get_gauge, get_histogram
+
+logger = initialize_module_logger(__name__)
+
+# queue events, these are journaled
+EVENT_ENQUEUE = "enqueue"
+EVENT_DEQUEUE = "dequeue"
+EVENT_COMPLETE = "complete"
+QUEUE_EVENTS = (EVENT_ENQUEUE, EVENT_DEQUEUE, EVENT_COMPLETE)
+# what the hardware is doing, "playing", "cooldown" or "waiting"
+EVENT_STATUS = "status"
+# how long an item spent in a stage, only written to the trace log (see utils/tracing.py)
+EVENT_TRACE = "trace"
+# where an item was put in the order its queue is worked through (see utils/fair_queue.py), not journaled
+EVENT_SCHEDULE = "schedule"
+# an item put back at the end of its queue, by the main process when the process that had it is restarted. Not journaled
+EVENT_REQUEUE = "requeue"
+
+ITEM_QUEUED = "queued"
+ITEM_SCHEDULED = "scheduled"  # taken by the process that works on the queue, waiting for its turn
+ITEM_IN_PROGRESS = "in progress"  # being converted, for link_q, or being played, for play_q
+
+STATUS_WAITING = "waiting"
+
+ENTRY_ORDER = {ITEM_IN_PROGRESS: 0, ITEM_SCHEDULED: 1, ITEM_QUEUED: 2}
+
+
+def get_item_id(item):
+    # items saved before they had ids are a link, a file path or a request with a link, which are unique enough
+    if isinstance(item, dict):
+        return item.get("id", item.get("link"))
+    return item
+
+
+def record_queue_event(queue_event_q, event, queue_name, item):
+    """
+    Sends an event to the main process, which journals it and shares it with the other processes
+
+    :param queue_event_q: multiprocessing.Queue read by the main process, or None if nothing is listening
+    """
+    if queue_event_q is None:
+        return
+
+    # the time lets the main process trace how long the item waited in the queue
+    record = {"event": event, "queue": queue_name, "id": get_item_id(item), "time": time.time()}
+    if event == EVENT_ENQUEUE:
+        record["item"] = item
+    queue_event_q.put(record)
+
+
+def record_status(queue_event_q, status, cooldown_s=None):
+    if queue_event_q is None:
+        return
+
+    event = {"event": EVENT_STATUS, "status": status}
+    if cooldown_s is not None:
+        event["cooldown_s"] = cooldown_s
+    queue_event_q.put(event)
+
+
+def record_schedule(queue_event_q, queue_name, item, schedule_key):
+    if queue_event_q is None:
+        return
+
+    queue_event_q.put({"event": EVENT_SCHEDULE, "queue": queue_name, "id": get_item_id(item), "key": schedule_key})
+
+
+def record_trace(queue_event_q, item, stage, start_time, end_time=None):
+    """
+    :param start_time: time.time() when the item entered the stage
+    :param end_time: time.time() when it left the stage (now if None)
+    """
+    if queue_event_q is None:
+        return
+
+    queue_event_q.put({"event": EVENT_TRACE, "id": get_item_id(item), "stage": stage, "start": start_time,
+                       "end": time.time() if end_time is None else end_time})
+
+
+class QueueState:
+    """
+    The items of each queue that haven't been completed, in the order they'll be worked on
+
+    A dequeued item stays until it's completed, so an item that was being worked on when Bertha2 stopped is done again.
+    Scheduled items are in the order of their schedule keys, items that haven't been scheduled yet follow in the order
+    they were enqueued.
+    Events from different processes can arrive out of order, so an item can be completed before it's enqueued.
+    version counts the events that have been applied, two states with the same version are the same.
+    """
+
+    def __init__(self):
+        self.queues = {}  # queue name -> {item id: item}
+        self.item_states = {}  # (queue name, item id) -> ITEM_QUEUED or ITEM_IN_PROGRESS
+        self.completed_early = set()  # (queue name, item id)
+        self.schedule_keys = {}  # (queue name, item id) -> schedule key, of ITEM_SCHEDULED items
+        self.status = STATUS_WAITING
+        self.cooldown_s = None  # how long the "cooldown" status lasts
+        self.version = 0
+
+    def apply(self, event):
+        self.version += 1
+
+        if event["event"] == EVENT_STATUS:
+            self.status = event["status"]
+            self.cooldown_s = event.get("cooldown_s")
+            return
+
+        key = (event["queue"], event["id"])
+        items = self.queues.setdefault(event["queue"], {})
+
+        if event["event"] == EVENT_ENQUEUE:
+            if key in self.completed_early:
+                self.completed_early.discard(key)
+            else:
+                items[event["id"]] = event["item"]
+                self.item_states[key] = ITEM_QUEUED
+
+        elif event["event"] == EVENT_SCHEDULE:
+            # also items that are scheduled again, by a process that was restarted
+            if key in self.item_states:
+                self.item_states[key] = ITEM_SCHEDULED
+                self.schedule_keys[key] = tuple(event["key"])
+
+        elif event["event"] == EVENT_DEQUEUE:
+            if key in self.item_states:
+                self.item_states[key] = ITEM_IN_PROGRESS
+                self.schedule_keys.pop(key, None)
+
+        elif event["event"] == EVENT_REQUEUE:
+            if key in self.item_states:
+                items[event["id"]] = items.pop(event["id"])
+                self.item_states[key] = ITEM_QUEUED
+                self.schedule_keys.pop(key, None)
+
+        elif event["event"] == EVENT_COMPLETE:
+            if items.pop(event["id"], None) is None:
+                self.completed_early.add(key)
+            self.item_states.pop(key, None)
+            self.schedule_keys.pop(key, None)
+
+    def get_items(self, queue_name):
+        return list(self.queues.get(queue_name, {}).values())
+
+    def get_entries(self, queue_name):
+        """
+        :return: List of dicts with the "id", "state" and "item" of every item of the queue, in order
+        """
+        entries = [{"id": item_id, "state": self.item_states[(queue_name, item_id)], "item": item}
+                   for item_id, item in self.queues.get(queue_name, {}).items()]
+        # what's being worked on, then what's scheduled, then what the process hasn't taken yet
+        return sorted(entries, key=lambda entry: (ENTRY_ORDER[entry["state"]],
+                                                  self.schedule_keys.get((queue_name, entry["id"]), ())))
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+
+class QueueStateService:
+    """
+    Applies every queue event to the state, and sends it on to the subscribers
+
+    A subscriber gets a copy of the state when it subscribes, then every event after it with its version, so it can
+    keep an exact copy of the state without rebuilding it from what the processes do.
+    """
+
+    def __init__(self, state: QueueState):
+        self.state = state
+        self.subscriptions = []
+        self.lock = threading.Lock()
+
+    def subscribe(self) -> Queue:
+        """
+        :return: multiprocessing.Queue to give to a QueueStateSubscriber
+        """
+        subscription_q = Queue()
+        with self.lock:
+            subscription_q.put(("snapshot", self.state.copy()))
+            self.subscriptions.append(subscription_q)
+        return subscription_q
+
+    def unsubscribe(self, subscription_q: Queue):
+        with self.lock:
+            self.subscriptions.remove(subscription_q)
+
+    def get_in_progress_items(self, queue_name):
+        # items a process took from the queue but hasn't completed, including the ones still waiting for their turn
+        with self.lock:
+            return [entry["item"] for entry in self.state.get_entries(queue_name) if entry["state"] != ITEM_QUEUED]
+
+    def publish(self, event):
+        with self.lock:
+            self.state.apply(event)
+            for subscription_q in self.subscriptions:
+                subscription_q.put(("event", self.state.version, event))
+
+
+class QueueStateSubscriber:
+    """ A copy of the queue state in another process, kept up to date by a QueueStateService """
+
+    def __init__(self, subscription_q: Queue):
+        self.subscription_q = subscription_q
+        self.state = QueueState()
+
+    def receive(self, timeout=None) -> bool:
+        """
+        Applies the next change, waiting up to timeout seconds for it (forever if None)
+
+        :return: True if the state changed
+        """
+        try:
+            message = self.subscription_q.get(timeout=timeout)
+        except queue.Empty:
+            return False
+
+        if message[0] == "snapshot":
+            self.state = message[1]
+            return True
+
+        _, version, event = message
+        if version != self.state.version + 1:
+            logger.warning(f"Queue state skipped from version {self.state.version} to {version}")
+        self.state.apply(event)
+        self.state.version = version
+        return True
+
+
+def observe_queue_event(event, enqueued_at, queue_state: QueueState):
+    """
+    Records how long items wait in each queue before a process takes them, and how many items each queue holds
+
+    :param enqueued_at: Dict of (queue name, item id) -> time.monotonic() it was enqueued, kept between events
+    """
+    key = (event["queue"], event["id"])
+    if event["event"] == EVENT_ENQUEUE:
+        enqueued_at[key] = time.monotonic()
+    elif event["event"] == EVENT_DEQUEUE:
+        # items from before the last start weren't seen being enqueued
+        if key in enqueued_at:
+            get_histogram("bertha2_queue_wait_seconds", "Time from an item being enqueued to a process taking it",
+                          queue=event["queue"]).observe(time.monotonic() - enqueued_at.pop(key))
+    else:
+        enqueued_at.pop(key, None)
+
+    get_gauge("bertha2_queue_items", "Items in the queue that haven't been completed, including ones in progress",
+              queue=event["queue"]).set(len(queue_state.queues.get(event["queue"], {})))
+
+
+def forward_queue_events(queue_event_q, journal, queue_state_service: QueueStateService, trace_log=None):
+    # runs in a thread of the main process, every event sent by the other processes goes through here
+    enqueued_at = {}
+    for event in iter(queue_event_q.get, None):
+        if trace_log is not None:
+            trace_log.observe(event)
+        if event["event"] == EVENT_TRACE:
+            continue
+
+        if event["event"] in QUEUE_EVENTS:
+            journal.append(event)
+        queue_state_service.publish(event)
+        if event["event"] in QUEUE_EVENTS:
+            observe_queue_event(event, enqueued_at, queue_state_service.state)
@@ -0,0 +1,157 @@
+""" Plays note events from one time-ordered queue with a single clock loop """
+
+import asyncio
+import heapq
+
+import numpy as np
+
+# At equal deadlines, a note is released before it is re-struck
+NOTE_OFF = 0
+NOTE_HOLD = 1
+NOTE_ON = 2
+
+
+def build_event_queue(notes, power_function, peak_time):
+    """
+    Merges every note of a song into one priority queue of solenoid transitions
+
+    :param notes: Iterable of (note_address, start_time, velocity, hold_note_time) tuples
+    :param power_function: Function of (velocity, time_passed) that returns a PWM value
+    :param peak_time: Time (in seconds) after which the note drops from peak power to hold power
+    :return: Heap of (deadline, kind, voice, note_address, pwm_value) tuples
+    """
+    events = []
+
+    for voice, (note_address, start_time, velocity, hold_note_time) in enumerate(notes):
+        events.append((start_time, NOTE_ON, voice, note_address, power_function(velocity, 0)))
+
+        if hold_note_time > peak_time:
+            events.append((start_time + peak_time, NOTE_HOLD, voice, note_address,
+                           power_function(velocity, peak_time)))
+
+        events.append((start_time + hold_note_time, NOTE_OFF, voice, note_address, 0))
+
+    heapq.heapify(events)
+    return events
+
+
+def build_envelope_event_queue(notes, envelope_table, solenoid_addresses):
+    """
+    Like build_event_queue, but the power of every note is looked up in an EnvelopeTable for all notes at once
+
+    :param notes: List of (note_address, start_time, velocity, hold_note_time) tuples
+    :param envelope_table: EnvelopeTable of the solenoids
+    :param solenoid_addresses: Solenoid that plays each note, whose envelope is used
+    :return: Heap of (deadline, kind, voice, note_address, pwm_value) tuples
+    """
+    if not notes:
+        return []
+
+    note_addresses, start_times, velocities, hold_note_times = (list(column) for column in zip(*notes))
+    envelopes = envelope_table.get_envelopes(solenoid_addresses, velocities)
+    hold_note_times_array = np.asarray(hold_note_times)
+
+    events = [(start_time, NOTE_ON, voice, note_address, pwm_value) for voice, (note_address, start_time, pwm_value)
+              in enumerate(zip(note_addresses, start_times, envelopes[:, 0].tolist()))]
+
+    # a transition is only needed in the buckets where the envelope changes, and the note is still held
+    for bucket in range(1, envelopes.shape[1]):
+        change_time = bucket * envelope_table.bucket_s
+        changed = (envelopes[:, bucket] != envelopes[:, bucket - 1]) & (hold_note_times_array > change_time)
+        for voice in np.flatnonzero(changed).tolist():
+            events.append((start_times[voice] + change_time, NOTE_HOLD, voice, note_addresses[voice],
+                           int(envelopes[voice, bucket])))
+
+    events.extend((start_time + hold_note_time, NOTE_OFF, voice, note_address, 0) for voice, (note_address, start_time,
+                  hold_note_time) in enumerate(zip(note_addresses, start_times, hold_note_times)))
+
+    heapq.heapify(events)
+    return events
+
+
+def resolve_event_queue(events):
+    """
+    Drains the event queue into the transitions that actually reach the solenoids
+
+    An event only applies to a solenoid if the note that scheduled it is still the latest one struck on that
+    solenoid, so the release of a short note can't cut off an overlapping note on the same key.
+
+    :param events: Heap created by build_event_queue. It is consumed.
+    :return: Lists of (times, note_addresses, pwm_values), ordered by time
+    """
+    times, note_addresses, pwm_values = [], [], []
+    active_voices = {}
+
+    while events:
+        deadline, kind, voice, note_address, pwm_value = heapq.heappop(events)
+
+        if kind == NOTE_ON:
+            active_voices[note_address] = voice
+        elif active_voices.get(note_address) != voice:
+            continue
+
+        times.append(deadline)
+        note_addresses.append(note_address)
+        pwm_values.append(pwm_value)
+
+    return times, note_addresses, pwm_values
+
+
+def create_playback_stats():
+    return {
+        "events": 0,
+        "wakeups": 0,
+        "duration_s": 0.0,
+        "max_error_s": 0.0,
+        "total_error_s": 0.0,
+    }
+
+
+async def play_timeline(times, note_addresses, pwm_values, update_function, flush_function=None, stats=None,
+                        error_histogram=None):
+    """
+    Fires every solenoid transition at its deadline from a single loop
+
+    Transitions are timed against one start time, so lateness in one wakeup does not push back the following ones.
+    The sequences are only indexed, so they can be memory-mapped arrays that are never fully read into memory.
+
+    :param times: Deadlines (in seconds from the start of playback), in ascending order
+    :param note_addresses: Solenoid of each transition
+    :param pwm_values: PWM value of each transition
+    :param update_function: Function of (note_address, pwm_value) that drives a solenoid
+    :param flush_function: Optional function called once after all transitions that were due in a wakeup
+    :param stats: Optional dict from create_playback_stats that is filled in during playback
+    :param error_histogram: Optional utils.metrics.Histogram that the lateness of every wakeup is observed in
+    """
+    if stats is None:
+        stats = create_playback_stats()
+
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    index = 0
+    number_of_events = len(times)
+
+    while index < number_of_events:
+        delay = start_time + times[index] - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        stats["wakeups"] += 1
+
+        now = loop.time() - start_time
+        if error_histogram is not None:
+            # the first transition of a wakeup is the latest one
+            error_histogram.observe(now - times[index])
+        while index < number_of_events and times[index] <= now:
+            error = now - times[index]
+            stats["events"] += 1
+            stats["total_error_s"] += error
+            stats["max_error_s"] = max(stats["max_error_s"], error)
+
+            update_function(int(note_addresses[index]), int(pwm_values[index]))
+            index += 1
+
+        if flush_function is not None:
+            flush_function()
+
+    stats["duration_s"] = loop.time() - start_time
+    return stats
@@ -0,0 +1,172 @@
+""" Framing for the serial link between hardware.py and the firmware, and a simulated port for testing it
+
+Every frame carries all of the solenoid changes of one playback tick:
+
+    [FRAME_START] [sequence number] [number of pairs] [address, pwm] * number of pairs [CRC-8]
+
+The CRC-8 covers everything between FRAME_START and the checksum itself.
+"""
+
+import time
+
+FRAME_START = 0xFE
+CRC8_POLYNOMIAL = 0x07
+SERIAL_BAUDRATE = 115200
+BITS_PER_SERIAL_BYTE = 10  # 8 data bits, a start bit and a stop bit
+
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ CRC8_POLYNOMIAL) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+
+    return crc
+
+
+def encode_update_frame(sequence_number, changes):
+    """
+    :param sequence_number: Number of the frame, from 0 to 255. The firmware uses it to detect lost frames.
+    :param changes: List of (note_address, pwm_value) pairs
+    :return: Bytes of the frame
+    """
+    body = bytearray((sequence_number & 0xFF, len(changes)))
+    for note_address, pwm_value in changes:
+        body.append(note_address)
+        body.append(pwm_value)
+
+    return bytes((FRAME_START,)) + bytes(body) + bytes((crc8(body),))
+
+
+def decode_update_frames(data):
+    """
+    Reads every valid frame out of a byte stream, skipping anything corrupted like the firmware does
+
+    :return: List of (sequence_number, changes) tuples
+    """
+    frames = []
+    index = 0
+
+    while index < len(data):
+        if data[index] != FRAME_START or index + 2 >= len(data):
+            index += 1
+            continue
+
+        number_of_changes = data[index + 2]
+        end = index + 3 + 2 * number_of_changes
+        if end >= len(data) or crc8(data[index + 1:end]) != data[end]:
+            index += 1
+            continue
+
+        pairs = data[index + 3:end]
+        frames.append((data[index + 1], [(pairs[i], pairs[i + 1]) for i in range(0, len(pairs), 2)]))
+        index = end + 1
+
+    return frames
+
+
+class SimulatedSerial:
+    """
+    Stands in for serial.Serial and delivers written bytes no faster than the real link could
+
+    Each write is queued behind the bytes that are still being sent, so writing more than the baudrate can carry
+    shows up as growing latency, just like on the real hardware.
+    """
+
+    def __init__(self, baudrate=SERIAL_BAUDRATE, clock=time.perf_counter):
+        self.baudrate = baudrate
+        self.clock = clock
+        self.seconds_per_byte = BITS_PER_SERIAL_BYTE / baudrate
+        self.writes = []  # (write_time, delivery_time, data)
+        self.link_free_at = 0.0
+        self.is_open = True
+
+    def write(self, data):
+        write_time = self.clock()
+        self.link_free_at = max(write_time, self.link_free_at) + len(data) * self.seconds_per_byte
+        self.writes.append((write_time, self.link_free_at, bytes(data)))
+        return len(data)
+
+    def close(self):
+        self.is_open = False
+
+    def get_stats(self):
+        if not self.writes:
+            return {"writes": 0, "bytes": 0, "bytes_per_second": 0.0, "mean_latency_s": 0.0, "max_latency_s": 0.0}
+
+        number_of_bytes = sum(len(data) for _, _, data in self.writes)
+        latencies = [delivery_time - write_time for write_time, delivery_time, _ in self.writes]
+        duration = max(self.writes[-1][0] - self.writes[0][0], self.seconds_per_byte)
+
+        return {
+            "writes": len(self.writes),
+            "bytes": number_of_bytes,
+            "bytes_per_second": number_of_bytes / duration,
+            "mean_latency_s": sum(latencies) / len(latencies),
+            "max_latency_s": max(latencies),
+        }
+
+    def get_delivered_updates(self):
+        """
+        :return: List of (delivery_time, note_address, pwm_value) for every change the firmware would apply
+        """
+        updates = []
+        for _, delivery_time, data in self.writes:
+            for _, changes in decode_update_frames(data):
+                updates.extend((delivery_time, note_address, pwm_value) for note_address, pwm_value in changes)
+
+        return updates
+
+
+class VirtualPiano(SimulatedSerial):
+    """
+    A piano for playing without hardware: reads the frames written to it like the firmware, and records when each
+    solenoid is set to what
+
+    The clock can be replaced to play a song without waiting for it, and an infinite baudrate delivers every frame the
+    moment it's written.
+    """
+
+    def __init__(self, number_of_notes, baudrate=SERIAL_BAUDRATE, clock=time.perf_counter):
+        super().__init__(baudrate, clock)
+        self.solenoid_values = [0] * number_of_notes
+        self.events = []  # (delivery_time, note_address, pwm_value)
+        self.frames = 0
+        self.lost_frames = 0
+        self.next_sequence_number = None
+
+    def write(self, data):
+        written = super().write(data)
+        delivery_time = self.link_free_at
+
+        # the host writes whole frames, so a frame is never split between writes
+        for sequence_number, changes in decode_update_frames(data):
+            if self.next_sequence_number is not None:
+                self.lost_frames += (sequence_number - self.next_sequence_number) % 256
+            self.next_sequence_number = (sequence_number + 1) % 256
+            self.frames += 1
+
+            for note_address, pwm_value in changes:
+                if note_address >= len(self.solenoid_values):
+                    continue  # the firmware ignores solenoids it doesn't have
+                self.solenoid_values[note_address] = pwm_value
+                self.events.append((delivery_time, note_address, pwm_value))
+
+        return written
+
+    def get_note_onsets(self):
+        """
+        :return: List of (delivery_time, note_address) for every time a solenoid was turned on from off
+        """
+        onsets = []
+        values = [0] * len(self.solenoid_values)
+        for delivery_time, note_address, pwm_value in self.events:
+            if pwm_value > 0 and values[note_address] == 0:
+                onsets.append((delivery_time, note_address))
+            values[note_address] = pwm_value
+
+        return onsets
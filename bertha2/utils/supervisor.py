@@ -0,0 +1,262 @@
+""" Starts the processes of Bertha2, and restarts any that crash or stop responding """
+
+import importlib
+import queue
+import signal
+import threading
+import time
+from multiprocessing import Process, Value
+
+from bertha2.settings import SUPERVISOR_CHECK_INTERVAL_S, SUPERVISOR_HEARTBEAT_INTERVAL_S, \
+    SUPERVISOR_HEARTBEAT_TIMEOUT_S, SUPERVISOR_MIN_BACKOFF_S, SUPERVISOR_MAX_BACKOFF_S, SUPERVISOR_STABLE_AFTER_S, \
+    SUPERVISOR_REPORT_INTERVAL_S, SUPERVISOR_STOP_TIMEOUT_S, SUPERVISOR_SHUTDOWN_TIMEOUT_S, \
+    SUPERVISOR_QUEUE_POLL_INTERVAL_S
+from bertha2.utils.logs import initialize_module_logger, initialize_process_logging
+from bertha2.utils.metrics import get_counter, start_metrics_reporter
+
+logger = initialize_module_logger(__name__)
+
+
+def send_heartbeats(heartbeat, interval_s):
+    while True:
+        heartbeat.value = time.time()
+        time.sleep(interval_s)
+
+
+def exit_on_sigterm(signum, frame):
+    # unwinds the process like an exception, so a queue it's reading from is let go of
+    raise SystemExit(128 + signum)
+
+
+def get_from_queue(q, timeout=None, poll_interval_s=SUPERVISOR_QUEUE_POLL_INTERVAL_S):
+    """
+    Like Queue.get, for a multiprocessing.Queue read by a supervised process
+
+    Queue.get holds the queue's reader lock for as long as it waits, and a process that's killed while holding it never
+    lets go of it, so the process that replaces it can't read from the queue anymore. This only takes the lock to read
+    an item that's already there, and waits without it.
+    """
+    deadline = float("inf") if timeout is None else time.monotonic() + timeout
+    while True:
+        try:
+            return q.get_nowait()
+        except queue.Empty:
+            remaining_s = deadline - time.monotonic()
+            if remaining_s <= 0:
+                raise
+        time.sleep(min(poll_interval_s, remaining_s))
+
+
+def resolve_target(target):
+    """
+    :param target: Function, or "module:function" to import it in the process that runs it
+    """
+    if not isinstance(target, str):
+        return target
+    module_name, function_name = target.split(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def run_supervised(target, heartbeat, heartbeat_interval_s, args, log_q=None, metrics_q=None):
+    # Ctrl+C is handled by the main process, which stops the others
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+    if log_q is not None:
+        initialize_process_logging(log_q)
+    if metrics_q is not None:
+        start_metrics_reporter(metrics_q)
+
+    # the heartbeat stops if the process freezes, or hogs the interpreter without ever releasing it
+    threading.Thread(target=send_heartbeats, args=(heartbeat, heartbeat_interval_s), daemon=True).start()
+    resolve_target(target)(*args)
+
+
+class SupervisedProcess:
+    """
+    One process that is kept running
+
+    target can be "module:function", so the main process doesn't import what only the child needs (e.g. numpy for the
+    hardware, pyppeteer for the converter). The module is imported every time the process is started.
+
+    create_args is called every time the process is started, so a restarted process can be given new connections
+    (e.g. a new queue state subscription). The queues it's given live in the main process, so they keep their items
+    when the process is restarted, as long as the process reads them with get_from_queue. on_restart is called before a
+    restart, to put back what the process lost. If log_q is given, the process logs through it to the log listener of
+    the main process, and if metrics_q is given, it sends its metrics through it (see utils/metrics.py).
+
+    stop_event is a multiprocessing.Event the process checks to shut down by itself, if it has one (it has to be one of
+    its args as well). It's cleared every time the process is started.
+    """
+
+    def __init__(self, name, target, create_args, on_restart=None, daemon=True,
+                 heartbeat_timeout_s=SUPERVISOR_HEARTBEAT_TIMEOUT_S, log_q=None, metrics_q=None, stop_event=None,
+                 stop_timeout_s=SUPERVISOR_STOP_TIMEOUT_S):
+        self.name = name
+        self.target = target
+        self.create_args = create_args
+        self.on_restart = on_restart
+        self.daemon = daemon
+        self.heartbeat_timeout_s = heartbeat_timeout_s
+        self.log_q = log_q
+        self.metrics_q = metrics_q
+        self.stop_event = stop_event
+        self.stop_timeout_s = stop_timeout_s
+
+        self.heartbeat = Value("d", 0.0, lock=False)
+        self.process = None
+        self.restarts = 0
+        self.backoff_s = 0
+        self.next_start_time = 0
+        self.start_time = None
+        self.stopped_time = None
+        self.last_restart_duration_s = None
+
+    def start(self):
+        self.heartbeat.value = 0.0
+        if self.stop_event is not None:
+            self.stop_event.clear()
+        self.process = Process(target=run_supervised, name=self.name, daemon=self.daemon,
+                               args=(self.target, self.heartbeat, SUPERVISOR_HEARTBEAT_INTERVAL_S, self.create_args(),
+                                     self.log_q, self.metrics_q))
+        self.process.start()
+        self.start_time = time.monotonic()
+
+    def stop(self, timeout_s=None):
+        """
+        Asks the process to stop through its stop_event, then terminates it, then kills it, waiting timeout_s (or
+        stop_timeout_s) after each. Killing it is left for last, since it can't let go of anything it holds.
+        """
+        timeout_s = self.stop_timeout_s if timeout_s is None else timeout_s
+        if self.stop_event is not None:
+            self.stop_event.set()
+            self.process.join(timeout=timeout_s)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=timeout_s)
+        if self.process.is_alive():
+            logger.error(f"The {self.name} process didn't stop when it was terminated, killing it")
+            self.process.kill()
+            self.process.join(timeout=timeout_s)
+
+    def is_heartbeat_stale(self):
+        if self.heartbeat.value == 0.0:  # hasn't started beating yet
+            return time.monotonic() - self.start_time > self.heartbeat_timeout_s
+        return time.time() - self.heartbeat.value > self.heartbeat_timeout_s
+
+    def is_alive(self):
+        # a process waiting to be restarted has been closed
+        return self.stopped_time is None and self.process is not None and self.process.is_alive()
+
+    def get_uptime_s(self):
+        return time.monotonic() - self.start_time if self.is_alive() else 0
+
+
+class Supervisor:
+    """
+    Checks every SUPERVISOR_CHECK_INTERVAL_S that each process is alive and its heartbeat is recent
+
+    A process that died, or whose heartbeat stopped, is restarted. If it keeps failing, the time before each restart
+    doubles from SUPERVISOR_MIN_BACKOFF_S up to SUPERVISOR_MAX_BACKOFF_S. It's reset once a process stays up for
+    SUPERVISOR_STABLE_AFTER_S.
+    """
+
+    def __init__(self, supervised_processes, min_backoff_s=SUPERVISOR_MIN_BACKOFF_S,
+                 max_backoff_s=SUPERVISOR_MAX_BACKOFF_S, stable_after_s=SUPERVISOR_STABLE_AFTER_S):
+        self.supervised_processes = supervised_processes
+        self.min_backoff_s = min_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.stable_after_s = stable_after_s
+        self.start_time = None
+        self.last_report_time = None
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.last_report_time = self.start_time
+        for supervised_process in self.supervised_processes:
+            supervised_process.start()
+
+    def check(self):
+        now = time.monotonic()
+        for supervised_process in self.supervised_processes:
+            if supervised_process.stopped_time is not None:
+                # waiting for the backoff to pass before restarting it
+                if now >= supervised_process.next_start_time:
+                    self.restart(supervised_process)
+                continue
+
+            if not supervised_process.process.is_alive():
+                logger.error(f"The {supervised_process.name} process stopped "
+                             f"(exit code {supervised_process.process.exitcode})")
+            elif supervised_process.is_heartbeat_stale():
+                logger.error(f"The {supervised_process.name} process stopped responding, stopping it")
+                supervised_process.stop()
+            else:
+                if now - supervised_process.start_time > self.stable_after_s:
+                    supervised_process.backoff_s = 0
+                continue
+
+            supervised_process.stopped_time = now
+            supervised_process.next_start_time = now + supervised_process.backoff_s
+            supervised_process.backoff_s = min(max(supervised_process.backoff_s * 2, self.min_backoff_s),
+                                               self.max_backoff_s)
+            if now >= supervised_process.next_start_time:
+                self.restart(supervised_process)
+
+    def restart(self, supervised_process):
+        supervised_process.process.close()
+        if supervised_process.on_restart is not None:
+            try:
+                supervised_process.on_restart()
+            except Exception as e:
+                logger.error(f"Could not recover what the {supervised_process.name} process lost. {e}")
+        supervised_process.start()
+        supervised_process.restarts += 1
+        get_counter("bertha2_supervisor_restarts_total", "Processes restarted by the supervisor",
+                    process=supervised_process.name).inc()
+        supervised_process.last_restart_duration_s = supervised_process.start_time - supervised_process.stopped_time
+        supervised_process.stopped_time = None
+        logger.warning(f"Restarted the {supervised_process.name} process "
+                       f"({supervised_process.restarts} restarts so far, "
+                       f"next backoff {supervised_process.backoff_s:.2f} s)")
+
+    def stop(self, timeout_s=SUPERVISOR_SHUTDOWN_TIMEOUT_S):
+        # they're all asked to stop first, so they shut down at the same time
+        running_processes = [supervised_process for supervised_process in self.supervised_processes
+                             if supervised_process.is_alive()]
+        for supervised_process in running_processes:
+            if supervised_process.stop_event is not None:
+                supervised_process.stop_event.set()
+        for supervised_process in running_processes:
+            supervised_process.stop(timeout_s)
+
+    def get_report(self):
+        return {
+            "uptime_s": time.monotonic() - self.start_time,
+            "processes": {
+                supervised_process.name: {
+                    "alive": supervised_process.is_alive(),
+                    "uptime_s": supervised_process.get_uptime_s(),
+                    "restarts": supervised_process.restarts,
+                    "last_restart_duration_s": supervised_process.last_restart_duration_s,
+                }
+                for supervised_process in self.supervised_processes
+            },
+        }
+
+    def log_report(self):
+        report = self.get_report()
+        processes = ", ".join(f"{name}: {'up' if process['alive'] else 'down'} {process['uptime_s']:.0f} s, "
+                              f"{process['restarts']} restarts"
+                              for name, process in report["processes"].items())
+        logger.info(f"Up for {report['uptime_s']:.0f} s. {processes}")
+
+    def run(self, stop_event: threading.Event = None):
+        """
+        Supervises until stop_event is set (or forever)
+        """
+        while stop_event is None or not stop_event.is_set():
+            self.check()
+            if time.monotonic() - self.last_report_time > SUPERVISOR_REPORT_INTERVAL_S:
+                self.log_report()
+                self.last_report_time = time.monotonic()
+            time.sleep(SUPERVISOR_CHECK_INTERVAL_S)
@@ -0,0 +1,174 @@
+""" Estimates how hot each solenoid is, to cool down between songs only as long as the next song needs """
+
+import json
+import math
+import time
+
+import numpy as np
+
+from bertha2.settings import SOLENOID_THERMAL_TIME_CONSTANT_S, SOLENOID_HEAT_LIMIT, SOLENOID_COOLDOWN_S
+from bertha2.utils.conversion_cache import write_json_atomically
+from bertha2.utils.logs import initialize_module_logger
+
+logger = initialize_module_logger(__name__)
+
+MAXIMUM_PWM = 255
+
+
+def measure_song_heat(times, solenoid_addresses, pwm_values, number_of_notes,
+                      time_constant_s=SOLENOID_THERMAL_TIME_CONSTANT_S, heat_limit=SOLENOID_HEAT_LIMIT, end_time=None):
+    """
+    Works out the heat a song adds to each solenoid, as if they all started cold
+
+    A solenoid gains heat at its duty cycle (PWM / 255) and loses it in proportion to how hot it is, so heat is in
+    seconds at full power. The model is linear, so the heat a solenoid already has only has to decay on top of this.
+
+    :param solenoid_addresses: Solenoid of each transition, negative for ones that aren't played
+    :param end_time: Time to measure until (the end of the last transition if None)
+    :return: Dict with "end_heat", the heat of each solenoid when the song ends, "margins", the most heat each
+        solenoid can have when the song starts without going over heat_limit during it, and "duration_s"
+    """
+    if end_time is None:
+        end_time = times[-1] if len(times) else 0.0
+
+    heat = [0.0] * number_of_notes
+    duty = [0.0] * number_of_notes
+    updated_at = [0.0] * number_of_notes
+    margins = [math.inf] * number_of_notes
+
+    def update(address, now):
+        decay = math.exp(-(now - updated_at[address]) / time_constant_s)
+        # heat moves towards duty * time_constant_s, where gaining and losing heat balance out
+        heat[address] = duty[address] * time_constant_s + (heat[address] - duty[address] * time_constant_s) * decay
+        updated_at[address] = now
+        # heat only peaks at the end of a transition. Starting heat h has decayed to h * exp(-now / time_constant_s)
+        #   by then, so it can be at most this much for the peak to stay under the limit
+        margins[address] = min(margins[address], (heat_limit - heat[address]) * math.exp(now / time_constant_s))
+
+    for transition_time, address, pwm_value in zip(times, solenoid_addresses, pwm_values):
+        if transition_time > end_time:
+            break
+        address = int(address)
+        if address < 0:
+            continue
+        update(address, float(transition_time))
+        duty[address] = int(pwm_value) / MAXIMUM_PWM
+
+    for address in range(number_of_notes):
+        if margins[address] != math.inf:
+            update(address, float(end_time))
+
+    return {
+        "end_heat": np.array(heat),
+        "margins": np.array(margins),
+        "duration_s": float(end_time),
+    }
+
+
+class ThermalModel:
+    """
+    The heat of every solenoid, carried from song to song
+
+    Before a song, get_cooldown_s gives the shortest wait that keeps every solenoid it plays under the heat limit, so a
+    song on cool keys can start straight away. It's never longer than max_cooldown_s, the fixed cooldown it replaces.
+
+    If filename is given, the heat is saved to it with save() and loaded from it when the model is created, so a
+    restarted hardware process knows how hot the solenoids still are. Without a saved heat it isn't known, and the
+    first song gets the full max_cooldown_s.
+    """
+
+    def __init__(self, number_of_notes, time_constant_s=SOLENOID_THERMAL_TIME_CONSTANT_S,
+                 heat_limit=SOLENOID_HEAT_LIMIT, max_cooldown_s=SOLENOID_COOLDOWN_S, filename=None):
+        self.number_of_notes = number_of_notes
+        self.time_constant_s = time_constant_s
+        self.heat_limit = heat_limit
+        self.max_cooldown_s = max_cooldown_s
+        self.filename = filename
+
+        self.heat = np.zeros(number_of_notes)
+        self.updated_at = time.monotonic()
+        self.is_heat_known = filename is None or self.load()
+
+    def load(self) -> bool:
+        """
+        :return: True if the saved heat was loaded
+        """
+        try:
+            with open(self.filename, encoding="utf-8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read the saved solenoid heat. {e}")
+            return False
+
+        if len(saved["heat"]) != self.number_of_notes:
+            logger.warning(f"The saved solenoid heat is for {len(saved['heat'])} solenoids, not {self.number_of_notes}")
+            return False
+        self.heat = np.array(saved["heat"], dtype=float)
+        # saved in wall-clock time, since time.monotonic() can start over when the computer does
+        self.updated_at = time.monotonic() - (time.time() - saved["updated_at"])
+        return True
+
+    def save(self, song_heat=None, start_time=None):
+        """
+        :param song_heat: Dict from measure_song_heat of a song that's starting, saved as if it's played to the end so
+            the heat is never less than it really is if the process is stopped during the song
+        :param start_time: time.monotonic() when the song starts
+        """
+        if self.filename is None:
+            return
+        heat, updated_at = (self.heat, self.updated_at) if song_heat is None else \
+            self.get_heat_after_song(song_heat, start_time)
+        try:
+            write_json_atomically(self.filename, {"heat": heat.tolist(),
+                                                  "updated_at": time.time() - (time.monotonic() - updated_at)})
+        except OSError as e:
+            logger.warning(f"Could not save the solenoid heat. {e}")
+
+    def get_heat(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return self.heat * math.exp(-max(0.0, now - self.updated_at) / self.time_constant_s)
+
+    def measure_song_heat(self, times, solenoid_addresses, pwm_values, end_time=None):
+        return measure_song_heat(times, solenoid_addresses, pwm_values, self.number_of_notes,
+                                 self.time_constant_s, self.heat_limit, end_time)
+
+    def get_cooldown_s(self, song_heat, now=None):
+        """
+        :param song_heat: Dict from measure_song_heat of the next song
+        :return: Seconds to wait before starting the song
+        """
+        if not self.is_heat_known:
+            return self.max_cooldown_s
+
+        heat = self.get_heat(now)
+        margins = song_heat["margins"]
+
+        if (margins <= 0).any():
+            # the song goes over the limit even on cold solenoids, waiting is all that can be done
+            logger.warning(f"The next song heats solenoids {np.flatnonzero(margins <= 0).tolist()} past the limit")
+            return self.max_cooldown_s
+
+        with np.errstate(divide="ignore"):
+            cooldowns = self.time_constant_s * np.log(heat / margins)
+        cooldown_s = float(np.max(cooldowns, initial=0.0))
+        return min(max(cooldown_s, 0.0), self.max_cooldown_s)
+
+    def get_heat_after_song(self, song_heat, start_time):
+        """
+        :return: (heat of every solenoid, time.monotonic() it's measured at) at the end of the song
+        """
+        heat = self.get_heat(start_time) * math.exp(-song_heat["duration_s"] / self.time_constant_s) + \
+            song_heat["end_heat"]
+        return heat, start_time + song_heat["duration_s"]
+
+    def add_song(self, song_heat, start_time):
+        """
+        :param song_heat: Dict from measure_song_heat of what was played
+        :param start_time: time.monotonic() when the song started
+        """
+        self.heat, self.updated_at = self.get_heat_after_song(song_heat, start_time)
+        # the cooldown before this song was the full one, from here on the heat is known
+        self.is_heat_known = True
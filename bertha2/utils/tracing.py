@@ -0,0 +1,151 @@
+""" Records how long every item spends in each stage from !play to playback, and reports where viewers' wait goes
+
+Every item keeps the id chat gave it through both queues, so the id is its trace id. A trace is a line of JSON per
+stage, {"id", "stage", "start", "end"}, with times from time.time() so they can be compared across processes. The
+main process writes the spans the queue events imply (e.g. "play_q_wait", from enqueue to dequeue) and the spans the
+processes send (e.g. "download"). Run this module to get the latency percentiles of each stage:
+    python -m bertha2.utils.tracing [trace files]
+"""
+
+import json
+import os
+
+from bertha2.settings import TRACE_LOG_FILENAME, TRACE_LOG_MAX_BYTES
+from bertha2.utils.logs import initialize_module_logger
+from bertha2.utils.queue_state import EVENT_ENQUEUE, EVENT_DEQUEUE, EVENT_COMPLETE, EVENT_TRACE, QUEUE_EVENTS
+
+logger = initialize_module_logger(__name__)
+
+# from a viewer's !play to the song starting, which is what viewers wait for
+REQUEST_TO_PLAYBACK_STAGE = "request_to_playback"
+PLAYBACK_STAGE = "playback"
+
+
+class TraceLog:
+    """
+    Appends the spans of every item to a JSONL file, written by the thread that forwards queue events
+
+    Once the file is larger than max_bytes, it's renamed to filename + ".1" (replacing the one before) and a new one
+    is started.
+    """
+
+    def __init__(self, filename=TRACE_LOG_FILENAME, max_bytes=TRACE_LOG_MAX_BYTES):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.queue_times = {}  # (queue name, item id) -> [time it was enqueued, time it was dequeued]
+        self.file = None
+
+    def open(self):
+        self.file = open(self.filename, "a", encoding="utf-8")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write_span(self, trace_id, stage, start_time, end_time):
+        if self.file is None:
+            return
+
+        span = {"id": trace_id, "stage": stage, "start": round(start_time, 6), "end": round(end_time, 6)}
+        self.file.write(json.dumps(span, ensure_ascii=False) + "\n")
+        # a few lines a song, so every line is flushed
+        self.file.flush()
+
+        if self.file.tell() > self.max_bytes:
+            self.file.close()
+            os.replace(self.filename, self.filename + ".1")
+            self.open()
+
+    def observe(self, event):
+        if event["event"] == EVENT_TRACE:
+            self.write_span(event["id"], event["stage"], event["start"], event["end"])
+            return
+
+        # events from processes that were running before they had times can't be traced
+        if event["event"] not in QUEUE_EVENTS or "time" not in event:
+            return
+
+        key = (event["queue"], event["id"])
+        if event["event"] == EVENT_ENQUEUE:
+            self.queue_times[key] = [event["time"], None]
+        elif event["event"] == EVENT_DEQUEUE:
+            # items from before the last start weren't seen being enqueued
+            if key in self.queue_times:
+                self.queue_times[key][1] = event["time"]
+                self.write_span(event["id"], f"{event['queue']}_wait", self.queue_times[key][0], event["time"])
+        elif event["event"] == EVENT_COMPLETE:
+            enqueued_at, dequeued_at = self.queue_times.pop(key, (None, None))
+            if dequeued_at is not None:
+                self.write_span(event["id"], f"{event['queue']}_work", dequeued_at, event["time"])
+
+
+def read_spans(filenames):
+    spans = []
+    for filename in filenames:
+        try:
+            with open(filename, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        spans.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue  # cut off by a crash
+        except FileNotFoundError:
+            logger.warning(f"Trace log {filename} doesn't exist")
+    return spans
+
+
+def get_stage_durations(spans):
+    """
+    :return: Dict of stage -> sorted list of durations in seconds, with REQUEST_TO_PLAYBACK_STAGE for every item that
+        started playing
+    """
+    durations = {}
+    first_start_times = {}
+    playback_start_times = {}
+    for span in spans:
+        durations.setdefault(span["stage"], []).append(span["end"] - span["start"])
+        first_start_times[span["id"]] = min(first_start_times.get(span["id"], span["start"]), span["start"])
+        if span["stage"] == PLAYBACK_STAGE:
+            playback_start_times[span["id"]] = span["start"]
+
+    for trace_id, playback_start_time in playback_start_times.items():
+        durations.setdefault(REQUEST_TO_PLAYBACK_STAGE, []).append(playback_start_time - first_start_times[trace_id])
+
+    for stage_durations in durations.values():
+        stage_durations.sort()
+    return durations
+
+
+def get_percentile(sorted_values, percentile):
+    # nearest rank
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile))]
+
+
+def format_report(durations):
+    lines = [f"{'stage':22s} {'count':>6s} {'mean':>9s} {'p50':>9s} {'p95':>9s} {'p99':>9s} {'max':>9s}"]
+    # the stages that take longest first
+    for stage, stage_durations in sorted(durations.items(), key=lambda item: -sum(item[1]) / len(item[1])):
+        lines.append(f"{stage:22s} {len(stage_durations):6d} {sum(stage_durations) / len(stage_durations):8.2f}s "
+                     + " ".join(f"{get_percentile(stage_durations, percentile):8.2f}s"
+                                for percentile in (0.5, 0.95, 0.99))
+                     + f" {stage_durations[-1]:8.2f}s")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="bertha2.utils.tracing",
+                                     description="Reports the latency of every stage from !play to playback")
+    parser.add_argument("filenames", nargs="*",
+                        help="trace logs to read (by default the current one and the one it replaced)")
+    args = parser.parse_args()
+
+    filenames = args.filenames or [filename for filename in [TRACE_LOG_FILENAME + ".1", TRACE_LOG_FILENAME]
+                                   if os.path.exists(filename)]
+    durations = get_stage_durations(read_spans(filenames))
+    if not durations:
+        print("No traces yet")
+    else:
+        print(format_report(durations))
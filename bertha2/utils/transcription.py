@@ -0,0 +1,202 @@
+""" Transcribes audio into MIDI files that Bertha2 can play """
+
+import subprocess
+from abc import ABC, abstractmethod
+
+import mido
+import numpy as np
+
+from bertha2.settings import STARTING_NOTE, NUMBER_OF_NOTES, TRANSCRIPTION_SAMPLE_RATE
+from bertha2.utils.logs import initialize_module_logger
+
+logger = initialize_module_logger(__name__)
+
+FRAME_LENGTH = 4096  # ~186 ms at 22050 Hz, long enough to tell apart semitones at the bottom of the keyboard
+HOP_LENGTH = 512  # ~23 ms between frames
+ACTIVATION_THRESHOLD = 0.2  # fraction of the loudest pitch in the song a pitch needs to be heard
+FRAME_RELATIVE_THRESHOLD = 0.5  # fraction of the loudest pitch in the same frame a pitch needs to be heard
+ONSET_THRESHOLD = 0.15  # rise in loudness between frames that counts as a new strike of a held pitch
+MINIMUM_NOTE_FRAMES = 3
+HARMONIC_SUPPRESSION = 0.6  # how much of a pitch's loudness is removed from its 2nd and 3rd harmonics
+# frames transformed at once, so memory doesn't grow with the length of the song (about 25 MB at a time)
+SALIENCE_BLOCK_FRAMES = 256
+
+MIDI_TICKS_PER_BEAT = 480
+MIDI_TEMPO = 500000  # the default MIDI tempo, 120 bpm
+
+
+class TranscriptionBackend(ABC):
+    """
+    Turns an audio file into a MIDI file
+
+    Backends that can also transcribe decoded mono PCM straight from memory are SampleTranscriptionBackends.
+    Backends are looked up by name, see converter.get_transcription_backend
+    """
+    name = None
+    accepts_samples = False
+
+    @abstractmethod
+    def transcribe(self, audio_filename, midi_filename):
+        pass
+
+
+class SampleTranscriptionBackend(TranscriptionBackend):
+    accepts_samples = True
+
+    @abstractmethod
+    def transcribe_samples(self, samples, sample_rate, midi_filename):
+        pass
+
+
+class SpectralTranscriptionBackend(SampleTranscriptionBackend):
+    """ Offline transcription from onset detection and pitch estimation on a semitone spectrogram """
+    name = "spectral"
+
+    def __init__(self, sample_rate=TRANSCRIPTION_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+
+    def transcribe(self, audio_filename, midi_filename):
+        return self.transcribe_samples(decode_audio_file(audio_filename, self.sample_rate), self.sample_rate,
+                                       midi_filename)
+
+    def transcribe_samples(self, samples, sample_rate, midi_filename):
+        notes = transcribe_samples(samples, sample_rate)
+        write_midi_file(notes, midi_filename)
+        logger.debug(f"Transcribed {len(notes)} notes into {midi_filename}")
+        return notes
+
+
+def run_ffmpeg_decoder(input_filename, sample_rate, input_data=None):
+    # ffmpeg decodes straight to mono 32-bit float PCM on stdout
+    completed_process = subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", input_filename, "-f", "f32le", "-ac", "1", "-ar", str(sample_rate), "-"],
+        input=input_data, stdout=subprocess.PIPE, check=True
+    )
+    return np.frombuffer(completed_process.stdout, dtype=np.float32)
+
+
+def decode_audio_file(audio_filename, sample_rate=TRANSCRIPTION_SAMPLE_RATE):
+    return run_ffmpeg_decoder(str(audio_filename), sample_rate)
+
+
+def decode_audio_data(audio_data, sample_rate=TRANSCRIPTION_SAMPLE_RATE):
+    # the encoded audio is piped into ffmpeg, so nothing is written to disk
+    return run_ffmpeg_decoder("pipe:0", sample_rate, input_data=audio_data)
+
+
+def get_midi_note_frequencies(first_note=STARTING_NOTE, number_of_notes=NUMBER_OF_NOTES):
+    return 440.0 * 2.0 ** ((np.arange(first_note, first_note + number_of_notes) - 69) / 12)
+
+
+def create_semitone_filterbank(sample_rate, frame_length=FRAME_LENGTH):
+    """
+    Maps STFT bins onto the playable notes with triangular weights one semitone wide
+
+    :return: Matrix of shape (number of bins, number of notes)
+    """
+    bin_frequencies = np.fft.rfftfreq(frame_length, d=1 / sample_rate)
+    bin_frequencies[0] = bin_frequencies[1]  # avoid log(0), the DC bin is far from every note anyway
+
+    semitone_distance = 12 * np.log2(bin_frequencies[:, None] / get_midi_note_frequencies()[None, :])
+    return np.maximum(0.0, 1.0 - np.abs(semitone_distance))
+
+
+def compute_note_salience(samples, sample_rate):
+    """
+    :return: Matrix of shape (number of frames, number of notes) with the loudness of each note, from 0 to 1, as
+        float32
+    """
+    samples = np.asarray(samples, dtype=np.float32)
+    if len(samples) < FRAME_LENGTH:
+        samples = np.pad(samples, (0, FRAME_LENGTH - len(samples)))
+
+    # a view of the samples, the frames are only copied a block at a time
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_LENGTH)[::HOP_LENGTH]
+    window = np.hanning(FRAME_LENGTH).astype(np.float32)
+    filterbank = create_semitone_filterbank(sample_rate).astype(np.float32)
+
+    salience = np.empty((len(frames), filterbank.shape[1]), dtype=np.float32)
+    for start in range(0, len(frames), SALIENCE_BLOCK_FRAMES):
+        block = frames[start:start + SALIENCE_BLOCK_FRAMES]
+        salience[start:start + len(block)] = np.abs(np.fft.rfft(block * window, axis=1)) @ filterbank
+
+    # the 2nd and 3rd harmonics of a note land 12 and 19 semitones above it, and shouldn't be heard as notes
+    suppressed = salience.copy()
+    suppressed[:, 12:] -= HARMONIC_SUPPRESSION * salience[:, :-12]
+    suppressed[:, 19:] -= HARMONIC_SUPPRESSION * salience[:, :-19]
+    salience = np.sqrt(np.maximum(suppressed, 0.0))
+
+    loudest = salience.max()
+    return salience / loudest if loudest > 0 else salience
+
+
+def find_active_notes(salience):
+    """
+    :return: Boolean matrix of shape (number of frames, number of notes) of the notes that are sounding
+    """
+    # a sounding note is louder than its neighbouring semitones, which only pick up leakage from it
+    padded = np.pad(salience, ((0, 0), (1, 1)))
+    is_peak = (salience >= padded[:, :-2]) & (salience >= padded[:, 2:])
+
+    loud_in_song = salience > ACTIVATION_THRESHOLD
+    loud_in_frame = salience > FRAME_RELATIVE_THRESHOLD * salience.max(axis=1, keepdims=True)
+    return is_peak & loud_in_song & loud_in_frame
+
+
+def transcribe_samples(samples, sample_rate=TRANSCRIPTION_SAMPLE_RATE):
+    """
+    Finds the notes in mono PCM audio, restricted to the notes Bertha2 can play
+
+    :return: List of (midi_note, start_time, velocity, duration) tuples, ordered by start time
+    """
+    salience = compute_note_salience(samples, sample_rate)
+    seconds_per_frame = HOP_LENGTH / sample_rate
+    frame_center = FRAME_LENGTH / 2 / sample_rate  # a frame hears a note once it fills about half of the window
+
+    # (notes, frames), padded with a silent frame on both sides so every note starts and ends
+    active = np.pad(find_active_notes(salience).T, ((0, 0), (1, 1)))
+    rise = np.pad(np.diff(salience.T, axis=1, prepend=0.0), ((0, 0), (1, 1)))
+    strike = active[:, 1:-1] & (rise[:, 1:-1] > ONSET_THRESHOLD)
+
+    starts = active[:, 1:-1] & (~active[:, :-2] | strike)
+    next_starts = np.pad(starts[:, 1:], ((0, 0), (0, 1)))
+    ends = active[:, 1:-1] & (~active[:, 2:] | next_starts)
+
+    # starts and ends alternate within each note's row, so they pair up in order
+    start_notes, start_frames = np.nonzero(starts)
+    _, end_frames = np.nonzero(ends)
+    number_of_frames = end_frames - start_frames + 1
+
+    long_enough = number_of_frames >= MINIMUM_NOTE_FRAMES
+    start_notes, start_frames, number_of_frames = \
+        start_notes[long_enough], start_frames[long_enough], number_of_frames[long_enough]
+
+    peak_frames = np.minimum(start_frames + 1, salience.shape[0] - 1)
+    velocities = np.clip(np.round(salience[peak_frames, start_notes] * 127), 1, 127).astype(int)
+
+    order = np.argsort(start_frames, kind="stable")
+    return [(int(STARTING_NOTE + start_notes[i]), float(start_frames[i] * seconds_per_frame + frame_center),
+             int(velocities[i]), float(number_of_frames[i] * seconds_per_frame)) for i in order]
+
+
+def write_midi_file(notes, midi_filename):
+    """
+    :param notes: List of (midi_note, start_time, velocity, duration) tuples
+    """
+    events = []
+    for note, start_time, velocity, duration in notes:
+        events.append((start_time, 1, mido.Message("note_on", note=note, velocity=velocity)))
+        events.append((start_time + duration, 0, mido.Message("note_off", note=note, velocity=0)))
+    events.sort(key=lambda event: (event[0], event[1]))
+
+    track = mido.MidiTrack()
+    track.append(mido.MetaMessage("set_tempo", tempo=MIDI_TEMPO))
+    last_tick = 0
+    for event_time, _, message in events:
+        tick = int(round(mido.second2tick(event_time, MIDI_TICKS_PER_BEAT, MIDI_TEMPO)))
+        track.append(message.copy(time=tick - last_tick))
+        last_tick = tick
+
+    midi_file = mido.MidiFile(ticks_per_beat=MIDI_TICKS_PER_BEAT)
+    midi_file.tracks.append(track)
+    midi_file.save(midi_filename)
@@ -0,0 +1,118 @@
+""" Looks up and remembers the YouTube metadata that decides if a video can be played """
+
+import json
+import threading
+import time
+
+from pytube import YouTube
+from pytube.extract import video_id
+
+from bertha2.settings import VIDEO_METADATA_CACHE_FILENAME, VIDEO_METADATA_CACHE_TTL_S, MAX_VIDEO_LENGTH_SECONDS
+from bertha2.utils.conversion_cache import write_json_atomically
+from bertha2.utils.logs import initialize_module_logger
+
+logger = initialize_module_logger(__name__)
+
+
+def fetch_video_metadata(link: str) -> dict:
+    """
+    Makes the network requests for one video, so it shouldn't be called from an event loop
+
+    :return: Dict with "video_id", "title", "length", "age_restricted", "available" and "unavailable_reason" keys
+    """
+    yt = YouTube(link)
+
+    try:
+        # this will return None if it's available, and an error if it's not
+        yt.check_availability()
+        available, unavailable_reason = True, None
+    except Exception as e:
+        # Will raise an exception if members only, live stream. etc.
+        available, unavailable_reason = False, str(e) or type(e).__name__
+
+    return {
+        "video_id": yt.video_id,
+        "title": yt.title if available else None,
+        "length": yt.length if available else None,
+        "age_restricted": yt.age_restricted if available else None,
+        "available": available,
+        "unavailable_reason": unavailable_reason,
+    }
+
+
+def get_invalid_reason(metadata: dict) -> str | None:
+    """
+    :return: Why the video can't be played, or None if it can
+    """
+    if not metadata["available"]:
+        return f"it's unavailable ({metadata['unavailable_reason']})"
+    if metadata["age_restricted"]:
+        return "it's age restricted"
+    if metadata["length"] >= MAX_VIDEO_LENGTH_SECONDS:
+        return "it's too long"
+    return None
+
+
+class VideoMetadataCache:
+    """
+    Metadata of recently checked videos, keyed by video ID, that expires after ttl_s seconds
+
+    When a filename is given, the cache is saved to it after every lookup, so other processes (like the converter)
+    can read what chat already fetched.
+    """
+
+    def __init__(self, filename=VIDEO_METADATA_CACHE_FILENAME, ttl_s=VIDEO_METADATA_CACHE_TTL_S,
+                 fetch_function=fetch_video_metadata):
+        self.filename = filename
+        self.ttl_s = ttl_s
+        self.fetch_function = fetch_function
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        if self.filename is None:
+            return {}
+
+        try:
+            with open(self.filename, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Video metadata cache could not be read, starting with an empty cache. {e}")
+            return {}
+
+    def save(self):
+        if self.filename is not None:
+            write_json_atomically(self.filename, self.entries)
+
+    def get(self, link: str) -> dict | None:
+        """
+        :return: The cached metadata of the video, or None if it isn't cached or has expired
+        """
+        key = video_id(link)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None and self.filename is not None:
+                # another process may have looked it up since this cache was loaded
+                self.entries = self.load()
+                entry = self.entries.get(key)
+
+            if entry is None or time.time() - entry["fetched_at"] > self.ttl_s:
+                return None
+            return entry["metadata"]
+
+    def get_or_fetch(self, link: str) -> dict:
+        metadata = self.get(link)
+        if metadata is not None:
+            return metadata
+
+        metadata = self.fetch_function(link)
+        with self.lock:
+            now = time.time()
+            self.entries[video_id(link)] = {"fetched_at": now, "metadata": metadata}
+            # expired entries are only removed here, so the file can't grow forever
+            self.entries = {key: entry for key, entry in self.entries.items()
+                            if now - entry["fetched_at"] <= self.ttl_s}
+            self.save()
+        return metadata
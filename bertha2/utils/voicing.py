@@ -0,0 +1,107 @@
+""" Fits the notes of a song onto the solenoids once, when its playback plan is compiled """
+
+from bertha2.settings import MAX_POLYPHONY, SOLENOID_CURRENT_BUDGET, DUPLICATE_NOTE_WINDOW_S
+from bertha2.utils.envelope import EnvelopeTable
+
+OCTAVE = 12
+MAXIMUM_PWM = 255
+
+
+def get_octave_candidates(note_address, number_of_notes):
+    """
+    :return: Every solenoid that plays the same pitch class as note_address, nearest octave first
+    """
+    lowest = note_address % OCTAVE
+    candidates = list(range(lowest, number_of_notes, OCTAVE))
+    return sorted(candidates, key=lambda candidate: (abs(candidate - note_address), candidate))
+
+
+def create_voicing_stats():
+    return {
+        "notes": 0,
+        "folded": 0,  # moved to another octave
+        "merged": 0,  # struck on a solenoid that was struck at the same time
+        "stolen": 0,  # cut short, or dropped, to stay within the polyphony and current budget
+    }
+
+
+def fold_and_merge_notes(notes, number_of_notes, duplicate_window_s, stats):
+    # notes outside the solenoids are moved by whole octaves. The nearest octave whose solenoid is free is used, so
+    #   a chord folded onto the keyboard doesn't pile onto the same key
+    arranged = []
+    latest_by_address = {}  # solenoid -> the last note placed on it
+
+    for note_address, start_time, velocity, hold_note_time in sorted(notes, key=lambda note: (note[1], note[0])):
+        address = note_address
+        if not 0 <= note_address < number_of_notes:
+            candidates = get_octave_candidates(note_address, number_of_notes)
+            address = next((candidate for candidate in candidates
+                            if candidate not in latest_by_address or latest_by_address[candidate][3] <= start_time),
+                           candidates[0])
+            stats["folded"] += 1
+
+        note = [address, start_time, velocity, start_time + hold_note_time]
+        previous = latest_by_address.get(address)
+        if previous is not None and start_time - previous[1] <= duplicate_window_s:
+            # the solenoid can only be struck once, so the notes become one
+            previous[2] = max(previous[2], velocity)
+            previous[3] = max(previous[3], note[3])
+            stats["merged"] += 1
+            continue
+
+        latest_by_address[address] = note
+        arranged.append(note)
+
+    return arranged
+
+
+def limit_polyphony(notes, envelope_table: EnvelopeTable, max_polyphony, current_budget, stats):
+    # voice stealing: when a note would go over the budget, the note struck longest ago is released. In a chord, the
+    #   quietest notes are the ones left out.
+    active = []
+
+    def get_current(note, now):
+        return envelope_table.get_pwm(note[0], note[2], now - note[1]) / MAXIMUM_PWM
+
+    for note in notes:
+        start_time = note[1]
+        active = [active_note for active_note in active if active_note[3] > start_time]
+
+        while active:
+            current = sum(get_current(active_note, start_time) for active_note in active) + get_current(note, start_time)
+            if len(active) < max_polyphony and current <= current_budget:
+                break
+
+            victim = min(active + [note], key=lambda candidate: (candidate[1], candidate[2]))
+            victim[3] = start_time
+            stats["stolen"] += 1
+            if victim is note:
+                break
+            active.remove(victim)
+
+        if note[3] > start_time:
+            active.append(note)
+
+    return notes
+
+
+def arrange_notes(notes, envelope_table: EnvelopeTable, number_of_notes, max_polyphony=MAX_POLYPHONY,
+                  current_budget=SOLENOID_CURRENT_BUDGET, duplicate_window_s=DUPLICATE_NOTE_WINDOW_S):
+    """
+    Folds every note onto a solenoid, merges notes struck together on the same one, and keeps the number of
+    solenoids on at once, and the current they draw, within what the power supply can deliver
+
+    :param notes: List of (note_address, start_time, velocity, hold_note_time) tuples, addresses can be out of range
+    :param current_budget: Most current all solenoids can draw together, in solenoids at full power
+    :return: List of (solenoid_address, start_time, velocity, hold_note_time) tuples ordered by start time, and the
+        stats of what was changed
+    """
+    stats = create_voicing_stats()
+    stats["notes"] = len(notes)
+
+    arranged = fold_and_merge_notes(notes, number_of_notes, duplicate_window_s, stats)
+    arranged = limit_polyphony(arranged, envelope_table, max_polyphony, current_budget, stats)
+
+    # notes that were stolen before they started aren't played at all
+    return [(address, start_time, velocity, end_time - start_time)
+            for address, start_time, velocity, end_time in arranged if end_time > start_time], stats
@@ -2,25 +2,89 @@
 
 """ Updates OBS to reflect the current state of the program """
 
-from multiprocessing import connection
+import functools
+import math
+import os
+import re
+import time
 
-from bertha2.settings import CUSS_WORDS, SOLENOID_COOLDOWN_S, \
+from bertha2.settings import get_cuss_words, SOLENOID_COOLDOWN_S, \
         MAX_VIDEO_TITLE_LENGTH_QUEUE, NO_VIDEO_PLAYING_TEXT, \
         STATUS_TEXT_OBS_SOURCE_ID, PLAYING_VIDEO_OBS_SOURCE_ID, \
-        VISUALS_NONEMPTY_QUEUE_HEADER_MESSAGE, VISUALS_EMPTY_QUEUE_NEXT_UP_MESSAGE, DEFAULT_VISUALS_STATE
+        VISUALS_NONEMPTY_QUEUE_HEADER_MESSAGE, VISUALS_EMPTY_QUEUE_NEXT_UP_MESSAGE, DEFAULT_VISUALS_STATE, \
+        VISUALS_FRAME_WINDOW_S
 from bertha2.utils.logs import initialize_module_logger, log_if_in_debug_mode
-from bertha2.utils.obs import update_obs_text_source_value, update_obs_video_source_value
+from bertha2.utils.metrics import get_counter, get_histogram
+from bertha2.utils.obs import create_text_source_request, create_video_source_request, update_obs_sources
+from bertha2.utils.queue_state import QueueState, QueueStateSubscriber
 
 logger = initialize_module_logger(__name__)
 
 visuals_state = DEFAULT_VISUALS_STATE
 
-def filter_cuss_words_from_title(title: str):
-    new_title = title
-    for word in CUSS_WORDS:
-        new_title = new_title.replace(word, "****")
+# the input settings OBS was last sent for each source, so unchanged sources aren't sent again
+displayed_obs_sources = {}
+render_stats = {
+    "state_changes": 0,  # changes received from the queue state service
+    "renders": 0,
+    "sent": 0,  # source updates sent to OBS
+    "suppressed": 0,  # source updates that weren't sent, because OBS already shows them
+}
 
-    return new_title
+# endings a listed word can have and still be filtered, the ending itself is shown
+CUSS_WORD_SUFFIXES = ("s", "es", "ed", "er", "ers", "ing", "in", "y")
+
+
+def create_trie_pattern(trie):
+    # a regex that matches the words of the trie, where words that start the same share their start.
+    #   Python's re tries every word of a plain "word1|word2|..." pattern at every position, this only tries the
+    #   words that start with what has been matched so far.
+    is_word = "" in trie
+    branches = [re.escape(character) + create_trie_pattern(subtrie)
+                for character, subtrie in sorted(trie.items()) if character]
+    if not branches:
+        return ""
+
+    pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    # greedy, so the longest word is matched
+    return f"(?:{pattern})?" if is_word else pattern
+
+
+def compile_cuss_word_pattern(words):
+    # compiled once for the whole list. A listed word matches a whole word, or the start of one that only goes on with
+    #   one of CUSS_WORD_SUFFIXES, so "fucking" becomes "****ing" but "assume" is left alone.
+    trie = {}
+    for word in words:
+        word = word.strip().lower()
+        if not word:
+            continue
+        node = trie
+        for character in word:
+            node = node.setdefault(character, {})
+        node[""] = {}  # marks the end of a word
+
+    if not trie:
+        return None
+    suffixes = "|".join(re.escape(suffix) for suffix in CUSS_WORD_SUFFIXES)
+    return re.compile(rf"(?<!\w){create_trie_pattern(trie)}(?=(?:{suffixes})?(?!\w))", re.IGNORECASE)
+
+
+# compiled the first time a title is filtered, so importing visuals doesn't read the word list
+cuss_word_pattern = None
+
+
+def get_cuss_word_pattern():
+    global cuss_word_pattern
+    if cuss_word_pattern is None:
+        cuss_word_pattern = compile_cuss_word_pattern(get_cuss_words())
+    return cuss_word_pattern
+
+
+def filter_cuss_words_from_title(title: str, pattern=None):
+    pattern = pattern or get_cuss_word_pattern()
+    if pattern is None:
+        return title
+    return pattern.sub("****", title)
 
 
 def shorten_title(title: str):
@@ -30,6 +94,7 @@ def shorten_title(title: str):
     return title
 
 
+@functools.lru_cache(maxsize=1024)  # titles of queued videos are shown on every refresh, they're only filtered once
 def process_title(title: str):
     title = filter_cuss_words_from_title(title)
     title = shorten_title(title)
@@ -63,17 +128,17 @@ def update_playing_next():
     queued_video_titles = convert_list_of_objects_into_list_of_strings(visuals_state["queued_video_metadata_objects"], "title")
 
     visuals_state["currently_displayed_next_up"] = create_playing_next_string(queued_video_titles)
-    update_obs_text_source_value('queue', visuals_state["currently_displayed_next_up"])
 
     visuals_state["does_next_up_need_update"] = False
 
     logger.debug(f"Refreshed 'Next Up'.")
+    return [create_text_source_request('queue', visuals_state["currently_displayed_next_up"])]
 
 
 def update_status_text():
     if visuals_state["is_bertha_on_cooldown"]:
         visuals_state[
-            "currently_displayed_status_text"] = f"Bertha2 is cooling down for the next {SOLENOID_COOLDOWN_S} seconds, please wait."
+            "currently_displayed_status_text"] = f"Bertha2 is cooling down for the next {math.ceil(visuals_state['cooldown_s'])} seconds, please wait."
         visuals_state["currently_playing_video_path"] = ""
 
     elif visuals_state["queued_video_metadata_objects"] != []:  # if there are videos in the queue
@@ -87,83 +152,121 @@ def update_status_text():
         visuals_state["currently_displayed_status_text"] = NO_VIDEO_PLAYING_TEXT
         visuals_state["currently_playing_video_path"] = ""
 
-    update_obs_text_source_value(STATUS_TEXT_OBS_SOURCE_ID, visuals_state["currently_displayed_status_text"])
-    update_obs_video_source_value(PLAYING_VIDEO_OBS_SOURCE_ID, visuals_state["currently_playing_video_path"])
-
     visuals_state["does_status_text_need_update"] = False
 
+    return [
+        create_text_source_request(STATUS_TEXT_OBS_SOURCE_ID, visuals_state["currently_displayed_status_text"]),
+        create_video_source_request(PLAYING_VIDEO_OBS_SOURCE_ID, visuals_state["currently_playing_video_path"]),
+    ]
+
 
 def update_onscreen_visuals_from_state():
     logger.debug("updating visuals")
+    obs_requests = []
 
     # update next up
     if visuals_state["does_next_up_need_update"]:
-        update_playing_next()
+        obs_requests += update_playing_next()
 
     # update status text at the bottom of the screen
     if visuals_state["does_status_text_need_update"]:
-        update_status_text()
-
-
-def update_visuals_state_with_new_video(converted_video_metadata_object):
-    visuals_state["queued_video_metadata_objects"].append(converted_video_metadata_object)
-    visuals_state["does_next_up_need_update"] = True
-
-
-def update_visuals_state_with_new_bertha_status(bertha_playing_status):
-    logger.debug(f"bertha_playing_status: {bertha_playing_status}")
-
-    if bertha_playing_status == "playing":
-        visuals_state["is_video_currently_playing"] = True
-        visuals_state["is_bertha_on_cooldown"] = False
-
-    elif bertha_playing_status == "cooldown":
-        visuals_state["is_video_currently_playing"] = False
-        visuals_state["is_bertha_on_cooldown"] = True
-
-        if len(visuals_state["queued_video_metadata_objects"]) > 0:  # this should always be true
-            visuals_state["queued_video_metadata_objects"].pop(0)  # remove the video that has just been played
-
-    elif bertha_playing_status == "waiting":
-        visuals_state["is_video_currently_playing"] = False
-        visuals_state["is_bertha_on_cooldown"] = False
+        obs_requests += update_status_text()
+
+    send_changed_obs_sources(obs_requests)
+    render_stats["renders"] += 1
+    get_counter("bertha2_visuals_renders_total", "Times the visuals were brought up to date").inc()
+
+
+def send_changed_obs_sources(obs_requests):
+    changed_requests = []
+    for request in obs_requests:
+        if displayed_obs_sources.get(request.requestData["inputName"]) == request.requestData["inputSettings"]:
+            render_stats["suppressed"] += 1
+        else:
+            changed_requests.append(request)
+
+    # every changed source is sent to OBS in one batch
+    if changed_requests:
+        batch_seconds = get_histogram("bertha2_obs_batch_seconds", "Round trip of each batch of updates sent to OBS")
+        with batch_seconds.time():
+            responses = update_obs_sources(changed_requests)
+    else:
+        responses = []
+    render_stats["sent"] += len(changed_requests)
+
+    # sources that OBS didn't update are sent again next time
+    updated = 0
+    for request, response in zip(changed_requests, responses):
+        if response.ok():
+            displayed_obs_sources[request.requestData["inputName"]] = request.requestData["inputSettings"]
+            updated += 1
+
+    description = "Source updates by what became of them, unchanged sources aren't sent"
+    get_counter("bertha2_visuals_sources_total", description, result="updated").inc(updated)
+    get_counter("bertha2_visuals_sources_total", description, result="failed").inc(len(changed_requests) - updated)
+    get_counter("bertha2_visuals_sources_total", description, result="unchanged") \
+        .inc(len(obs_requests) - len(changed_requests))
+
+    logger.debug(f"Sent {len(changed_requests)} of {len(obs_requests)} sources to OBS. {render_stats}")
+
+
+def get_video_metadata_object(play_item):
+    # items queued before play_q held dicts are just the path of the MIDI file
+    if isinstance(play_item, dict):
+        return {"title": play_item["title"], "filepath": play_item.get("video", "")}
+    return {"title": os.path.splitext(os.path.basename(play_item))[0], "filepath": ""}
+
+
+def update_visuals_state_from_queue_state(queue_state: QueueState):
+    # visuals_state only holds what's shown, it's derived from the queue state instead of being kept in step with it
+    visuals_state["queued_video_metadata_objects"] = [
+        get_video_metadata_object(entry["item"]) for entry in queue_state.get_entries("play_q")
+    ]
+    visuals_state["is_video_currently_playing"] = queue_state.status == "playing"
+    visuals_state["is_bertha_on_cooldown"] = queue_state.status == "cooldown"
+    # the hardware works out how long each cooldown has to be
+    visuals_state["cooldown_s"] = queue_state.cooldown_s if queue_state.cooldown_s is not None else SOLENOID_COOLDOWN_S
 
-    # always update next up and status text
+    # sources that didn't change aren't sent again, see send_changed_obs_sources
     visuals_state["does_next_up_need_update"] = True
     visuals_state["does_status_text_need_update"] = True
 
 
-def visuals_process_loop(multiprocessing_connection_list):
-
-    # if either (blocking) connection receives something, proceed.
-    for current_connection in connection.wait(multiprocessing_connection_list, timeout=None):
+def receive_queue_state_changes(subscriber: QueueStateSubscriber, timeout):
+    if subscriber.receive(timeout=timeout):
+        render_stats["state_changes"] += 1
 
-        if current_connection == multiprocessing_connection_list[0]:
 
-            converted_video_metadata_object = current_connection.recv()  # receive object (containing video title and video filepath) from converter process
-            update_visuals_state_with_new_video(converted_video_metadata_object)
+def visuals_process_loop(subscriber: QueueStateSubscriber, frame_window_s=VISUALS_FRAME_WINDOW_S):
 
-        elif current_connection == multiprocessing_connection_list[1]:
+    # wait until the queue state changes
+    receive_queue_state_changes(subscriber, timeout=None)
 
-            bertha_playing_status = current_connection.recv()  # this will be received once the hardware is done playing the video
-            update_visuals_state_with_new_bertha_status(bertha_playing_status)
+    # anything else that arrives within the frame window is shown in the same render,
+    #   so a burst of changes becomes one OBS update
+    frame_deadline = time.monotonic() + frame_window_s
+    while (remaining_s := frame_deadline - time.monotonic()) > 0:
+        receive_queue_state_changes(subscriber, timeout=remaining_s)
 
+    update_visuals_state_from_queue_state(subscriber.state)
     update_onscreen_visuals_from_state()
 
 
-def visuals_process(converter_visuals_conn, hardware_visuals_conn,):
+def visuals_process(queue_state_subscription_q):
 
     log_if_in_debug_mode(logger, __name__)
 
-    multiprocessing_connection_list = [converter_visuals_conn, hardware_visuals_conn]
+    # the first change is a copy of the whole queue state, so the queue is shown right after a restart too
+    subscriber = QueueStateSubscriber(queue_state_subscription_q)
+    receive_queue_state_changes(subscriber, timeout=None)
 
-    # initialize onscreen visuals from default state
+    # initialize onscreen visuals from the queue state
+    update_visuals_state_from_queue_state(subscriber.state)
     update_onscreen_visuals_from_state()
 
     while True:
 
-        visuals_process_loop(multiprocessing_connection_list)
-
+        visuals_process_loop(subscriber)
 
 
 